@@ -171,7 +171,17 @@ function App() {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         credentials: 'omit',
-        body: JSON.stringify({ query: text }),
+        // The server chains follow-ups by the conversation id it issued (null
+        // starts a new one); the recent history is only used by a server
+        // instance that has not seen this conversation
+        body: JSON.stringify({
+          query: text,
+          conversation_id: current.serverConversationId || null,
+          history: transcriptBefore
+            .filter((m) => m.role !== 'System')
+            .slice(-12)
+            .map((m) => ({ role: m.role, text: m.text })),
+        }),
       });
 
       if (!res.ok) {
@@ -193,6 +203,7 @@ function App() {
       // 3) append bot message
       updateConversation(convId, (conv) => {
         conv.messages = [...conv.messages, ragMsg];
+        if (data.conversation_id) conv.serverConversationId = data.conversation_id;
         conv.updatedAt = Date.now();
         return conv;
       });
@@ -0,0 +1,263 @@
+"""
+Answer cache for repeated questions.
+Entries are keyed by the normalized query, the corpus epoch and a
+fingerprint of the prompt/model configuration, and expire by TTL and LRU.
+Each entry remembers the Dropbox documents its context came from and the
+query's terms, so an incremental corpus update only drops the answers it
+can actually affect.
+
+Backends:
+  memory - per-process OrderedDict (default)
+  sqlite - local file shared by all workers on the box (RAG_ANSWER_CACHE_PATH)
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Set
+
+from search_index import tokenize
+
+PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+
+def normalize_query(query: str) -> str:
+    """Case-, punctuation- and whitespace-insensitive form of a question."""
+    return " ".join(PUNCTUATION_RE.sub(" ", query.lower()).split())
+
+
+def query_dependencies(query: str, sources: Iterable[str]) -> Set[str]:
+    """Invalidation tags for an answer: 'doc:<path>' per source, 'term:<t>' per query term."""
+    deps = {f"doc:{path}" for path in sources if path}
+    deps.update(f"term:{term}" for term in tokenize(query))
+    return deps
+
+
+class MemoryBackend:
+    """In-process LRU store with a reverse index from dependency tag to keys."""
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires_at, value, deps)
+        self._by_dep: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str, now: float):
+        """Returns (value, status) with status 'hit', 'miss' or 'expired'."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, "miss"
+            if entry[0] <= now:
+                self._drop(key)
+                return None, "expired"
+            self._entries.move_to_end(key)
+            return entry[1], "hit"
+
+    def set(self, key: str, value: Dict, deps: Set[str], expires_at: float) -> int:
+        """Store an entry; returns how many LRU entries were evicted to make room."""
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (expires_at, value, deps)
+            for dep in deps:
+                self._by_dep.setdefault(dep, set()).add(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                evicted += 1
+            return evicted
+
+    def invalidate(self, deps: Optional[Set[str]]) -> int:
+        """Drop entries tagged with any of deps (None = everything)."""
+        with self._lock:
+            if deps is None:
+                count = len(self._entries)
+                self._entries.clear()
+                self._by_dep.clear()
+                return count
+            keys = set()
+            for dep in deps:
+                keys |= self._by_dep.get(dep, set())
+            for key in keys:
+                self._drop(key)
+            return len(keys)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _drop(self, key: str) -> None:
+        _, _, deps = self._entries.pop(key)
+        for dep in deps:
+            keys = self._by_dep.get(dep)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_dep[dep]
+
+
+class SQLiteBackend:
+    """
+    Store in a local SQLite file so every uvicorn worker on the machine
+    shares one cache. WAL mode lets workers read while another writes.
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS answers (
+                    key TEXT PRIMARY KEY, value TEXT NOT NULL,
+                    expires_at REAL NOT NULL, last_used REAL NOT NULL);
+                CREATE TABLE IF NOT EXISTS answer_deps (
+                    key TEXT NOT NULL, dep TEXT NOT NULL);
+                CREATE INDEX IF NOT EXISTS answer_deps_dep ON answer_deps(dep);
+                CREATE INDEX IF NOT EXISTS answer_deps_key ON answer_deps(key);
+                CREATE INDEX IF NOT EXISTS answers_last_used ON answers(last_used);
+            """)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str, now: float):
+        conn = self._conn()
+        row = conn.execute("SELECT value, expires_at FROM answers WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, "miss"
+        if row[1] <= now:
+            self._delete(conn, [key])
+            return None, "expired"
+        conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]), "hit"
+
+    def set(self, key: str, value: Dict, deps: Set[str], expires_at: float) -> int:
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM answer_deps WHERE key = ?", (key,))
+            conn.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)",
+                         (key, json.dumps(value), expires_at, now))
+            conn.executemany("INSERT INTO answer_deps VALUES (?, ?)", [(key, dep) for dep in deps])
+            (count,) = conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+            evict = max(0, count - self.max_entries)
+            if evict:
+                victims = [r[0] for r in conn.execute(
+                    "SELECT key FROM answers ORDER BY last_used LIMIT ?", (evict,))]
+                self._delete(conn, victims)
+        return evict
+
+    def invalidate(self, deps: Optional[Set[str]]) -> int:
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if deps is None:
+                (count,) = conn.execute("SELECT COUNT(*) FROM answers").fetchone()
+                conn.execute("DELETE FROM answers")
+                conn.execute("DELETE FROM answer_deps")
+                return count
+            deps = list(deps)
+            keys = set()
+            for i in range(0, len(deps), 500):
+                batch = deps[i:i + 500]
+                marks = ",".join("?" * len(batch))
+                keys.update(r[0] for r in conn.execute(
+                    f"SELECT DISTINCT key FROM answer_deps WHERE dep IN ({marks})", batch))
+            self._delete(conn, list(keys))
+            return len(keys)
+
+    def __len__(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+
+    def _delete(self, conn, keys) -> None:
+        conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in keys])
+        conn.executemany("DELETE FROM answer_deps WHERE key = ?", [(k,) for k in keys])
+
+
+class AnswerCache:
+    """
+    Cache of generate_answer() results.
+
+    Args:
+        backend: MemoryBackend or SQLiteBackend
+        ttl: seconds an answer stays valid
+        config_fingerprint: hash of everything besides the query that
+            shapes an answer (model, prompt, tools); changing it misses
+    """
+
+    def __init__(self, backend, ttl: float = 3600, config_fingerprint: str = ""):
+        self.backend = backend
+        self.ttl = ttl
+        self.config_fingerprint = config_fingerprint
+        self.epoch = ""  # corpus epoch, updated by on_corpus_change
+        self.counters = {"hits": 0, "misses": 0, "expired": 0, "stores": 0,
+                         "evictions": 0, "invalidations": 0}
+
+    def key(self, query: str) -> str:
+        raw = f"{normalize_query(query)}\0{self.epoch}\0{self.config_fingerprint}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, query: str) -> Optional[Dict]:
+        value, status = self.backend.get(self.key(query), time.time())
+        if status == "hit":
+            self.counters["hits"] += 1
+        else:
+            self.counters["misses"] += 1
+            if status == "expired":
+                self.counters["expired"] += 1
+        return value
+
+    def set(self, query: str, result: Dict, sources: Iterable[str] = ()) -> None:
+        """Cache an answer along with the Dropbox paths its context came from."""
+        deps = query_dependencies(query, sources)
+        self.counters["evictions"] += self.backend.set(self.key(query), result, deps, time.time() + self.ttl)
+        self.counters["stores"] += 1
+
+    def on_corpus_change(self, corpus, changed_paths, changed_terms) -> None:
+        """
+        Corpus listener (see dropbox_rag.on_corpus_change).
+        A full reload moves to the new epoch and clears the cache; an
+        incremental update drops only answers built from a changed or
+        deleted document, or whose query shares a term with new content.
+        """
+        if changed_paths is None:
+            if corpus.epoch != self.epoch:
+                self.epoch = corpus.epoch
+                self.counters["invalidations"] += self.backend.invalidate(None)
+            return
+        deps = {f"doc:{path}" for path in changed_paths}
+        deps.update(f"term:{term}" for term in changed_terms or ())
+        self.counters["invalidations"] += self.backend.invalidate(deps)
+
+    def stats(self) -> Dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return dict(self.counters, entries=len(self.backend),
+                    hit_rate=round(self.counters["hits"] / lookups, 4) if lookups else 0.0)
+
+
+def create_answer_cache(config_fingerprint: str) -> Optional[AnswerCache]:
+    """Build the cache from RAG_ANSWER_CACHE* env vars; None when disabled."""
+    kind = os.getenv("RAG_ANSWER_CACHE", "memory").lower()
+    ttl = float(os.getenv("RAG_ANSWER_CACHE_TTL", "3600"))
+    size = int(os.getenv("RAG_ANSWER_CACHE_SIZE", "1000"))
+    if kind in ("", "off", "none", "false", "0"):
+        return None
+    if kind == "sqlite":
+        path = os.getenv("RAG_ANSWER_CACHE_PATH") or os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "answer_cache.sqlite3")
+        backend = SQLiteBackend(path, max_entries=size)
+    else:
+        backend = MemoryBackend(max_entries=size)
+    return AnswerCache(backend, ttl=ttl, config_fingerprint=config_fingerprint)
@@ -0,0 +1,339 @@
+"""
+Benchmark suite for ingestion, retrieval and the end-to-end /rag path.
+Everything runs offline: synthetic help articles are served by
+fake_dropbox.FakeDropbox and the model by mock_llm_server.
+
+  ingest  - load_documents() time and the memory the loaded corpus holds
+  search  - search_documents() latency percentiles per retrieval mode
+  e2e     - concurrent /rag requests against main.app
+
+Results are written as JSON so runs on two commits can be compared:
+
+    python benchmark.py --sizes 1000,10000 --json before.json
+    git checkout my-branch
+    python benchmark.py --sizes 1000,10000 --json after.json --compare before.json
+
+--compare prints the change of every timing/throughput metric and exits
+with status 1 if any got worse by more than --max-regression.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Deterministic request path: caches would turn the e2e run into a cache benchmark
+os.environ.setdefault("OPENAI_API_KEY", "mock")
+os.environ.setdefault("RAG_ANSWER_CACHE", "off")
+os.environ.setdefault("RAG_SEMANTIC_CACHE", "off")
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from load_test import percentile, run_load
+
+FOLDER = "/rag_sources"
+
+PRODUCTS = [
+    "eduroam", "VPN", "myCourses", "Outlook", "Teams", "Zoom", "Duo", "OneDrive", "Slack",
+    "Adobe Creative Cloud", "MATLAB", "SIS", "Tiger Center", "printing", "lab computers",
+    "Google Drive", "Canvas", "password", "email", "Wi-Fi", "Box", "SPSS", "Kronos", "Linux shell",
+]
+ACTIONS = [
+    "reset", "install", "configure", "connect to", "troubleshoot", "update", "sign in to",
+    "share files with", "recover", "uninstall", "request access to", "enable",
+]
+DEVICES = ["Windows", "macOS", "iPhone", "Android", "Chromebook", "Linux", "lab machine"]
+SENTENCES = [
+    "Open {product} and choose Settings from the menu.",
+    "On {device}, make sure the operating system is up to date before you {action} {product}.",
+    "If {product} shows an error, sign out, restart the {device} and try again.",
+    "Students and staff can {action} {product} with their RIT username and password.",
+    "Contact the Service Center if you cannot {action} {product} after following these steps.",
+    "Two-factor authentication with Duo is required the first time you {action} {product}.",
+    "Lab computers already have {product}; personal {device} devices need the installer from the portal.",
+    "The {product} quota and retention policy are listed on the ITS website.",
+    "Clear the browser cache if the {product} page does not load on {device}.",
+    "Administrators can {action} {product} for a whole department through a service request.",
+]
+
+
+def synthetic_corpus(n_docs: int, seed: int = 0, paragraphs=(2, 8)):
+    """
+    n_docs markdown help articles ({path: bytes}), a few hundred bytes to a
+    few KB each. The same (n_docs, seed) always produces the same corpus.
+    Returns (files, titles), titles being the article questions for queries.
+    """
+    rng = random.Random(seed)
+    files, titles = {}, []
+    for i in range(n_docs):
+        product, action, device = rng.choice(PRODUCTS), rng.choice(ACTIONS), rng.choice(DEVICES)
+        title = f"How to {action} {product} on {device}"
+        sections = [f"# {title}\n\nArticle KB{i:06d}."]
+        for p in range(rng.randint(*paragraphs)):
+            words = dict(product=rng.choice([product, product, rng.choice(PRODUCTS)]),
+                         action=rng.choice([action, rng.choice(ACTIONS)]), device=rng.choice(DEVICES))
+            body = " ".join(rng.choice(SENTENCES).format(**words) for _ in range(rng.randint(2, 6)))
+            sections.append(f"## Step {p + 1}\n\n{body}" if p % 3 == 0 else body)
+        files[f"{FOLDER}/kb/{i % 100:02d}/kb_{i:06d}.md"] = "\n\n".join(sections).encode("utf-8")
+        titles.append(title)
+    return files, titles
+
+
+def make_queries(titles, n: int, seed: int = 1):
+    """Questions in the shape users ask them: article titles, partial and reworded."""
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        title = rng.choice(titles)
+        shape = rng.random()
+        if shape < 0.5:
+            queries.append(title.replace("How to", "How do I") + "?")
+        elif shape < 0.8:
+            queries.append(" ".join(title.split()[2:]))  # "reset VPN on macOS"
+        else:
+            queries.append(f"{rng.choice(PRODUCTS)} {rng.choice(ACTIONS)} not working")
+    return queries
+
+
+@contextlib.contextmanager
+def quiet(enabled: bool = True):
+    """Silence per-file and per-query logging while timing."""
+    if not enabled:
+        yield
+        return
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def latency_summary(latencies):
+    return {
+        "queries": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "qps": round(len(latencies) / sum(latencies), 1),
+    }
+
+
+def new_instance(files):
+    from dropbox_rag import DropboxRAG
+    from fake_dropbox import FakeDropbox
+
+    instance = DropboxRAG(dbx=FakeDropbox(files, page_size=2000))
+    instance.folder_path = FOLDER
+    instance.retrieval_mode = "keyword"
+    return instance
+
+
+def bench_ingest(files, measure_memory: bool = True, verbose: bool = False):
+    """Time load_documents(); then load again under tracemalloc for the retained size."""
+    instance = new_instance(files)
+    gc.collect()
+    with quiet(not verbose):
+        started = time.perf_counter()
+        loaded = instance.load_documents()
+        elapsed = time.perf_counter() - started
+    corpus = instance.corpus
+    result = {
+        "documents": loaded,
+        "chunks": len(corpus.chunks),
+        "terms": len(corpus.index.postings),
+        "source_bytes": sum(len(data) for data in files.values()),
+        "load_s": round(elapsed, 3),
+        "docs_per_s": round(loaded / elapsed, 1),
+    }
+    if measure_memory:
+        # tracemalloc slows allocation down, so it gets its own load
+        del instance, corpus
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        traced = new_instance(files)
+        with quiet(not verbose):
+            traced.load_documents()
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result.update(memory_bytes=current - baseline, peak_memory_bytes=peak - baseline,
+                      memory_bytes_per_doc=round((current - baseline) / max(loaded, 1)))
+        del traced
+    return result
+
+
+def bench_search(instance, queries, modes, verbose: bool = False):
+    results = {}
+    for mode in modes:
+        instance.retrieval_mode = mode
+        entry = {}
+        if mode != "keyword" and instance.corpus.vectors is None:
+            with quiet(not verbose):
+                started = time.perf_counter()
+                instance._index_vectors(instance.corpus)
+            entry["vector_index_s"] = round(time.perf_counter() - started, 3)
+        with quiet(not verbose):
+            for query in queries[:20]:  # warm-up
+                instance.search_documents(query)
+            latencies = []
+            for query in queries:
+                started = time.perf_counter()
+                instance.search_documents(query)
+                latencies.append(time.perf_counter() - started)
+        entry.update(latency_summary(latencies))
+        results[mode] = entry
+    instance.retrieval_mode = "keyword"
+    return results
+
+
+def bench_e2e(instance, queries, n_requests: int, concurrency: int, latency: float, port: int):
+    """Concurrent /rag requests against main.app with the corpus installed and a mock model."""
+    import dropbox_rag
+    from mock_llm_server import app as mock_llm
+    from mock_llm_server import serve_in_background
+    from openai import AsyncOpenAI
+
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{port}/v1"
+    server = serve_in_background(port, latency)
+    import main as api
+    import rag
+
+    dropbox_rag._dropbox_rag_instance = instance
+    # The async client's connection pool belongs to the loop that runs the load
+    rag.async_client = AsyncOpenAI(base_url=os.environ["OPENAI_BASE_URL"])
+    calls_before = mock_llm.state.requests
+    try:
+        with quiet():
+            result = asyncio.run(run_load(api.app, n_requests, concurrency, queries=queries))
+    finally:
+        server.should_exit = True
+    result.update(mock_latency_s=latency, llm_calls=mock_llm.state.requests - calls_before,
+                  overhead_p50_s=round(result["p50_s"] - latency, 3))
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+# (metric name suffix, whether bigger is better), most specific first
+_DIRECTIONS = [("per_s", True), ("qps", True), ("_rps", True), ("bytes_per_doc", False),
+               ("_bytes", False), ("_ms", False), ("_s", False)]
+
+
+def _direction(name: str):
+    if name.endswith("mock_latency_s"):
+        return None  # a parameter, not a measurement
+    for suffix, higher_is_better in _DIRECTIONS:
+        if name.endswith(suffix):
+            return higher_is_better
+    return None  # counts and parameters are not compared
+
+
+def compare(baseline, current, max_regression: float):
+    """Print per-metric change against a baseline run; returns the regressed metric names."""
+    before = dict(_flatten(baseline["results"]))
+    regressed = []
+    print(f" Comparing with {baseline.get('commit') or 'baseline'} (regression limit {max_regression:.0%})")
+    for name, value in _flatten(current["results"]):
+        higher_is_better = _direction(name)
+        old = before.get(name)
+        if higher_is_better is None or not old:
+            continue
+        change = (value - old) / old
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > max_regression:
+            regressed.append(name)
+            flag = "  <-- regression"
+        print(f"   {name:<45} {old:>12} -> {value:<12} {change:+.1%}{flag}")
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000", help="comma-separated corpus sizes (documents)")
+    parser.add_argument("--queries", type=int, default=500, help="search queries per corpus size")
+    parser.add_argument("--modes", default="keyword", help="retrieval modes to time: keyword,vector,hybrid")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc load")
+    parser.add_argument("--no-e2e", action="store_true", help="skip the /rag load run")
+    parser.add_argument("--requests", type=int, default=200, help="e2e /rag requests")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.2, help="mock LLM latency in seconds")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier run")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="allowed slowdown, 0.2 = 20%%")
+    parser.add_argument("--verbose", action="store_true", help="keep ingestion/search logging")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    modes = [m for m in args.modes.split(",") if m]
+    report = {
+        "commit": git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("json", "compare")},
+        "results": {},
+    }
+    instance = queries = None
+    for size in sizes:
+        print(f" Corpus of {size} documents")
+        files, titles = synthetic_corpus(size, seed=args.seed)
+        queries = make_queries(titles, args.queries, seed=args.seed + 1)
+        entry = {"ingest": bench_ingest(files, not args.no_memory, args.verbose)}
+        print(f"   ingest {json.dumps(entry['ingest'])}")
+        instance = new_instance(files)
+        with quiet(not args.verbose):
+            instance.load_documents()
+        del files
+        entry["search"] = bench_search(instance, queries, modes, args.verbose)
+        for mode, stats in entry["search"].items():
+            print(f"   search[{mode}] {json.dumps(stats)}")
+        report["results"][f"docs_{size}"] = entry
+
+    if not args.no_e2e and instance is not None:
+        print(f" /rag load: {args.requests} requests, concurrency {args.concurrency}, "
+              f"{sizes[-1]} documents, mock LLM {args.latency}s")
+        report["results"]["e2e"] = bench_e2e(instance, queries, args.requests, args.concurrency,
+                                             args.latency, args.port)
+        print(f"   {json.dumps(report['results']['e2e'])}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f" Wrote {args.json}")
+    if args.compare:
+        with open(args.compare) as f:
+            regressed = compare(json.load(f), report, args.max_regression)
+        if regressed:
+            print(f"❌ {len(regressed)} metric(s) regressed")
+            sys.exit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+Document chunking.
+The one place where chunk size, overlap and splitting strategy are
+configured. Chunks are described by character offsets into the source
+text so the text itself is never copied into the chunk table.
+"""
+import os
+import re
+from typing import List, Tuple
+
+PARAGRAPH_RE = re.compile(r"\S.*?(?=\s*\n\s*\n|\s*\Z)", re.S)
+HEADING_RE = re.compile(r"#{1,6}\s|<h[1-6][\s>]", re.I)
+
+STRATEGIES = ("paragraph", "heading")
+
+
+class Chunker:
+    """
+    Splits text into (start, end) character spans.
+
+    Strategies:
+      paragraph - pack whole paragraphs up to `size` characters
+      heading   - like paragraph, but a heading always starts a new chunk
+    `overlap` repeats up to that many trailing characters (whole
+    paragraphs) of the previous chunk at the start of the next one.
+    """
+
+    def __init__(self, size: int = None, overlap: int = None, strategy: str = None):
+        self.size = size or int(os.getenv("RAG_CHUNK_SIZE", "500"))
+        self.overlap = overlap if overlap is not None else int(os.getenv("RAG_CHUNK_OVERLAP", "0"))
+        self.strategy = strategy or os.getenv("RAG_CHUNK_STRATEGY", "paragraph")
+        if self.strategy not in STRATEGIES:
+            raise ValueError(f"Unknown chunk strategy {self.strategy!r}, expected one of {STRATEGIES}")
+
+    def describe(self) -> str:
+        """Short config string, e.g. for stats and snapshot headers."""
+        return f"{self.strategy}:{self.size}:{self.overlap}"
+
+    def split(self, content: str) -> List[Tuple[int, int]]:
+        """Return chunk spans for content, in document order."""
+        spans = []
+        current: List[Tuple[int, int]] = []  # paragraph spans in the open chunk
+        current_len = 0
+
+        for start, end in self._paragraphs(content):
+            is_heading = self.strategy == "heading" and HEADING_RE.match(content, start)
+            if current and (is_heading or current_len + (end - start) > self.size):
+                spans.append((current[0][0], current[-1][1]))
+                current = [] if is_heading else self._overlap_tail(current, self.size - (end - start))
+                current_len = sum(e - s for s, e in current)
+            current.append((start, end))
+            current_len += end - start
+
+        if current:
+            spans.append((current[0][0], current[-1][1]))
+        return spans
+
+    def _paragraphs(self, content: str):
+        """Yield stripped paragraph spans; oversized paragraphs are windowed at whitespace."""
+        for m in PARAGRAPH_RE.finditer(content):
+            start, end = m.start(), m.end()
+            while end - start > self.size:
+                cut = start + self.size
+                ws = content.rfind(" ", start, cut)
+                if ws > start:
+                    cut = ws
+                yield start, cut
+                start = cut
+                while start < end and content[start].isspace():
+                    start += 1
+            if start < end:
+                yield start, end
+
+    def _overlap_tail(self, paragraphs: List[Tuple[int, int]], room: int) -> List[Tuple[int, int]]:
+        """Trailing paragraphs of a finished chunk that fit the overlap budget and the room left."""
+        tail = []
+        budget = min(self.overlap, room)
+        for start, end in reversed(paragraphs[1:]):
+            if end - start > budget:
+                break
+            tail.insert(0, (start, end))
+            budget -= end - start
+        return tail
@@ -0,0 +1,147 @@
+"""
+Context assembly for the answer prompt.
+Turns ranked retrieval hits into the chunks that are actually sent to the
+model, within a token budget:
+  1. near-duplicate chunks (e.g. the same paragraph on two similar help
+     pages) are dropped, keeping the better-ranked copy
+  2. consecutive chunks of the same document are merged into one passage
+  3. passages are kept in relevance order until the budget is spent
+
+Tokens are counted locally: with tiktoken when it is installed and its
+encoding is available, otherwise with a close offline estimate.
+"""
+import math
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from search_index import tokenize
+
+PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def _estimate_tokens(text: str) -> int:
+    """BPE-like estimate: one token per punctuation mark, ~4 characters per word piece."""
+    return sum(math.ceil(len(piece) / 4) for piece in PIECE_RE.findall(text))
+
+
+def _load_tokenizer() -> Callable[[str], int]:
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("o200k_base")
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:  # not installed, or the encoding file cannot be fetched offline
+        return _estimate_tokens
+
+
+count_tokens = _load_tokenizer()
+
+
+def _shingles(text: str, size: int = 3) -> frozenset:
+    words = tokenize(text)
+    if len(words) < size:
+        return frozenset([tuple(words)])
+    return frozenset(zip(*(words[i:] for i in range(size))))
+
+
+def _similarity(a: frozenset, b: frozenset) -> float:
+    """Overlap coefficient, so a chunk contained in a longer one counts as a duplicate."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+
+class ContextPacker:
+    """
+    Args:
+        budget: maximum context tokens (RAG_CONTEXT_TOKENS)
+        duplicate_threshold: shingle overlap above which a chunk is a near-duplicate
+        render: how a hit is shown to the model; its tokens are what is counted
+    """
+
+    def __init__(self, budget: int = 3000, duplicate_threshold: float = 0.8,
+                 render: Optional[Callable[[Dict], str]] = None):
+        self.budget = budget
+        self.duplicate_threshold = duplicate_threshold
+        self.render = render or (lambda hit: hit['text'])
+        self.totals = {'requests': 0, 'tokens_in': 0, 'tokens_out': 0, 'tokens_saved': 0,
+                       'duplicates': 0, 'merged': 0, 'over_budget': 0}
+        self._lock = threading.Lock()
+
+    def pack(self, hits: List[Dict]) -> Tuple[List[Dict], Dict]:
+        """Packed hits (best first) and a report of what was dropped or merged."""
+        tokens_in = sum(count_tokens(self.render(hit)) for hit in hits)
+        kept, duplicates = self._deduplicate(hits)
+        passages, merged = self._merge_adjacent(kept)
+
+        packed, used, over_budget = [], 0, 0
+        for passage in passages:
+            tokens = count_tokens(self.render(passage))
+            if used + tokens > self.budget:
+                over_budget += 1
+                continue
+            packed.append(passage)
+            used += tokens
+
+        report = {'tokens_in': tokens_in, 'tokens_out': used, 'tokens_saved': tokens_in - used,
+                  'duplicates': duplicates, 'merged': merged, 'over_budget': over_budget}
+        with self._lock:
+            self.totals['requests'] += 1
+            for key, value in report.items():
+                self.totals[key] += value
+        return packed, report
+
+    def _deduplicate(self, hits: List[Dict]) -> Tuple[List[Dict], int]:
+        kept, seen = [], []
+        for hit in hits:
+            shingles = _shingles(hit['text'])
+            if any(_similarity(shingles, other) >= self.duplicate_threshold for other in seen):
+                continue
+            kept.append(hit)
+            seen.append(shingles)
+        return kept, len(hits) - len(kept)
+
+    @staticmethod
+    def _merge_adjacent(hits: List[Dict]) -> Tuple[List[Dict], int]:
+        """
+        Merge runs of consecutive chunks of one document (consecutive chunk
+        ids, see Corpus) into a passage placed at its best-ranked member.
+        """
+        by_chunk = {hit['chunk_id']: hit for hit in hits if hit.get('chunk_id') is not None}
+        absorbed = set()
+        passages = []
+        for hit in hits:
+            chunk_id = hit.get('chunk_id')
+            if chunk_id is None:
+                passages.append(hit)
+                continue
+            if chunk_id in absorbed:
+                continue
+            first = chunk_id
+            while first - 1 in by_chunk and by_chunk[first - 1]['path'] == hit['path']:
+                first -= 1
+            last = chunk_id
+            while last + 1 in by_chunk and by_chunk[last + 1]['path'] == hit['path']:
+                last += 1
+            if first == last:
+                passages.append(hit)
+                continue
+            run = [by_chunk[c] for c in range(first, last + 1)]
+            absorbed.update(range(first, last + 1))
+            passages.append(dict(hit, text=_join_spans(run), start=run[0]['start'], end=run[-1]['end'],
+                                 chunk_ids=list(range(first, last + 1))))
+        return passages, len(hits) - len(passages)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self.totals, budget=self.budget)
+
+
+def _join_spans(run: List[Dict]) -> str:
+    """Text of consecutive chunks, without repeating overlapping characters."""
+    text, end = run[0]['text'], run[0]['end']
+    for hit in run[1:]:
+        overlap = max(0, end - hit['start'])
+        text += hit['text'][overlap:] if overlap else "\n\n" + hit['text']
+        end = hit['end']
+    return text
@@ -0,0 +1,112 @@
+"""
+Conversation state for follow-up questions on /rag.
+A turn is chained to the previous one instead of resending the transcript:
+  - with the previous turn's response id (previous_response_id), the
+    provider keeps the earlier turns; only the new question (and new
+    context, if any) is sent
+  - without one (first turn on this worker, expired state, or a chain the
+    provider no longer knows), a compacted transcript goes in instead
+A follow-up that stays on the conversation's topic (shares at least
+`overlap` of its keywords with it, or adds none) reuses the previous
+turn's chunks instead of retrieving again.
+
+Conversation ids are issued here (random, unguessable); an id this worker
+did not issue, or whose state expired, starts a new conversation under a
+new id instead of being adopted, so a client cannot pick another user's
+id to continue their chain.
+
+State is per process, bounded (max_entries, least recently used first)
+and expires after `ttl` seconds; the client sends the recent history with
+every turn, so a turn served by another worker still has context.
+"""
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+from titles import keywords
+
+
+class Conversation:
+    """What the next turn needs: response id, topic, last context and a short history."""
+    __slots__ = ('id', 'response_id', 'topic', 'hits', 'turns', 'transcript_tokens', 'history', 'updated')
+
+    def __init__(self, id: str, max_messages: int = 12):
+        self.id = id
+        self.response_id: Optional[str] = None
+        self.topic: frozenset = frozenset()
+        self.hits: Optional[List[Dict]] = None  # Packed hits of the last retrieval
+        self.turns = 0
+        self.transcript_tokens = 0  # What resending the whole transcript would cost
+        self.history = deque(maxlen=max_messages)  # {'role', 'text'} as the UI sends them
+        self.updated = time.monotonic()
+
+
+class ConversationStore:
+    """
+    Conversations by id, plus per-turn counters: how turns were chained
+    and input tokens sent against a full transcript resend.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 3600, overlap: float = 0.5,
+                 max_messages: int = 12):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.overlap = overlap
+        self.max_messages = max_messages
+        self.counters = {'first': 0, 'chained': 0, 'compacted': 0, 'reused_context': 0,
+                         'input_tokens_full': 0, 'input_tokens_sent': 0}
+        self._entries: "OrderedDict[str, Conversation]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: Optional[str]) -> Conversation:
+        """The conversation's state, or a fresh one under a new id if it is unknown or expired."""
+        with self._lock:
+            conversation = self._entries.get(conversation_id) if conversation_id else None
+            if conversation is not None and time.monotonic() - conversation.updated > self.ttl:
+                del self._entries[conversation_id]
+                conversation = None
+        return conversation or Conversation(secrets.token_urlsafe(18), self.max_messages)
+
+    def same_topic(self, conversation: Conversation, query: str) -> bool:
+        """Whether a follow-up can be answered from the previous turn's chunks."""
+        if not conversation.hits:
+            return False
+        new_words = keywords(query)
+        return not new_words or len(new_words & conversation.topic) / len(new_words) >= self.overlap
+
+    def save(self, conversation: Conversation, mode: str, reused_context: bool,
+             input_tokens_full: int, input_tokens_sent: int) -> None:
+        """Record a finished turn (mode: first, chained or compacted)."""
+        conversation.turns += 1
+        conversation.updated = time.monotonic()
+        with self._lock:
+            self.counters[mode] += 1
+            self.counters['reused_context'] += reused_context
+            self.counters['input_tokens_full'] += input_tokens_full
+            self.counters['input_tokens_sent'] += input_tokens_sent
+            self._entries[conversation.id] = conversation
+            self._entries.move_to_end(conversation.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self.counters)
+            active = len(self._entries)
+        full = counters['input_tokens_full']
+        return dict(counters, active=active,
+                    input_tokens_saved_ratio=round(1 - counters['input_tokens_sent'] / full, 4) if full else 0.0)
+
+    def collect(self):
+        """Turn and input token counters for /metrics."""
+        stats = self.stats()
+        yield ("rag_conversation_turns_total", "counter", "Conversation turns by how they were chained",
+               [({"mode": mode}, stats[mode]) for mode in ("first", "chained", "compacted")])
+        yield ("rag_conversation_reused_context_total", "counter",
+               "Follow-up turns answered from the previous turn's chunks", [({}, stats['reused_context'])])
+        yield ("rag_conversation_input_tokens_total", "counter",
+               "Conversation input tokens: sent, and what resending the full transcript would have sent",
+               [({"kind": "full"}, stats['input_tokens_full']), ({"kind": "sent"}, stats['input_tokens_sent'])])
+        yield ("rag_conversations_active", "gauge", "Conversations with state on this worker", [({}, stats['active'])])
@@ -0,0 +1,198 @@
+"""
+Corpus snapshot: loaded documents, their chunk table and the search index.
+A snapshot is never modified while it is being searched. Updates are
+applied to a copy() and published by swapping the reference, so every
+query sees one consistent version of the corpus.
+
+Text and chunk rows live in compact append-only stores shared by all
+copies (see corpus_store.py); a copy only owns its documents dict, its
+chunk liveness bitmap and its index.
+"""
+import hashlib
+import sys
+from typing import Dict, Iterable, List, Set
+
+from chunking import Chunker
+from corpus_store import ChunkTable, ChunkView, Document, TextBuffer, byte_offsets
+from search_index import BM25Index, MappedPostings, tokenize
+
+# Rewrite the shared stores once replaced text outweighs live text by this much
+COMPACT_MIN_BYTES = 1 << 20
+
+
+class Corpus:
+    """
+    documents - path -> Document (name, size, content_hash, text location, chunk ids)
+    chunks    - chunk id -> Chunk (doc path, start/end character offsets
+                into the document's text). A document's chunks always have
+                consecutive ids in text order, so chunk ids n and n + 1 of
+                one document are adjacent.
+    text      - TextBuffer holding every document's UTF-8 text once
+    table     - ChunkTable: chunk offsets and precomputed tokens (term ids);
+                chunks restored from a snapshot have none, see chunk_terms
+    index     - BM25 inverted index over chunk ids
+    vectors   - optional dense index over chunk ids (vector_index.VectorIndex);
+                a copy() shares it until the updater replaces it
+    version   - bumped on every published change
+    epoch     - content fingerprint of the last full load; incremental
+                updates keep it, so it only changes when the whole
+                corpus is replaced (identical folders give identical epochs)
+    """
+
+    def __init__(self, chunker: Chunker, text: TextBuffer = None, table: ChunkTable = None):
+        self.chunker = chunker
+        self.documents: Dict[str, Document] = {}
+        self.text = text if text is not None else TextBuffer()
+        self.table = table if table is not None else ChunkTable()
+        self.chunks = ChunkView(self.table, bytearray())
+        self.index = BM25Index()
+        self.vectors = None
+        self.version = 0
+        self.epoch = ""
+        self.text_bytes = 0  # Live text; the rest of the buffer belongs to replaced documents
+
+    def copy(self) -> "Corpus":
+        """Copy-on-write clone to apply an update to."""
+        clone = Corpus(self.chunker, self.text, self.table)
+        clone.documents = dict(self.documents)
+        clone.chunks = ChunkView(self.table, bytearray(self.chunks.live))
+        clone.index = self.index.copy()
+        clone.vectors = self.vectors
+        clone.version = self.version + 1
+        clone.epoch = self.epoch
+        clone.text_bytes = self.text_bytes
+        if len(self.text) - self.text_bytes > max(self.text_bytes, COMPACT_MIN_BYTES):
+            clone._compact()
+        return clone
+
+    def _compact(self) -> None:
+        """Move this copy onto fresh stores holding only its own documents."""
+        text = TextBuffer()
+        for path, doc in self.documents.items():
+            offset = text.append(self.text.get(doc.offset, doc.length))
+            self.documents[path] = Document(doc.path, doc.name, doc.size, doc.content_hash,
+                                            offset, doc.length, doc.first_chunk, doc.n_chunks)
+        self.text = text
+        self.table = self.table.compacted(self.chunks.live)
+        self.chunks = ChunkView(self.table, self.chunks.live)
+
+    def add_document(self, doc: Dict) -> None:
+        """
+        Chunk and index a document ({'path', 'name', 'content', 'size',
+        'content_hash'}), replacing any previous version at the same path.
+        """
+        self.remove_document(doc['path'])
+        content = doc['content']
+        encoded = content.encode("utf-8")
+        spans = list(self.chunker.split(content))
+        to_bytes = byte_offsets(content, [o for span in spans for o in span])
+        tokens = [tokenize(content[start:end]) for start, end in spans]
+        path = doc['path']
+        first = self.table.append(path, spans, [(to_bytes[s], to_bytes[e]) for s, e in spans], tokens)
+        live = self.chunks.live
+        live.extend(b"\0" * (first - len(live)))
+        live.extend(b"\1" * len(spans))
+        for offset, chunk_tokens in enumerate(tokens):
+            self.index.add(first + offset, chunk_tokens)
+        self.documents[path] = Document(path, doc['name'], doc['size'], doc.get('content_hash'),
+                                        self.text.append(encoded), len(encoded), first, len(spans))
+        self.text_bytes += len(encoded)
+
+    def remove_document(self, path: str) -> bool:
+        """Drop a document and its chunks. Returns False if it was not loaded."""
+        doc = self.documents.get(path)
+        if doc is None:
+            return False
+        live = self.chunks.live
+        for chunk_id in doc.chunk_ids:
+            self.index.remove(chunk_id, self.chunk_terms(chunk_id))
+            live[chunk_id] = 0
+        del self.documents[path]
+        self.text_bytes -= doc.length
+        return True
+
+    def remove_prefix(self, folder: str) -> List[str]:
+        """Drop every document under a deleted folder. Returns the removed paths."""
+        prefix = folder.rstrip("/") + "/"
+        removed = [p for p in self.documents if p.startswith(prefix)]
+        for path in removed:
+            self.remove_document(path)
+        return removed
+
+    def chunk_text(self, chunk_id: int) -> str:
+        """Original text of a chunk, decoded from its slice of the text buffer only."""
+        table = self.table
+        doc = self.documents[table.path(chunk_id)]
+        start = table.byte_starts[chunk_id]
+        return self.text.decode(doc.offset + start, table.byte_ends[chunk_id] - start)
+
+    def document_text(self, path: str) -> str:
+        doc = self.documents[path]
+        return self.text.decode(doc.offset, doc.length)
+
+    def paths_by_content_hash(self) -> Dict[str, str]:
+        """Dropbox content_hash -> a path holding that content, for documents that have one."""
+        return {doc.content_hash: path for path, doc in self.documents.items() if doc.content_hash}
+
+    def chunk_terms(self, chunk_id: int) -> tuple:
+        """Indexed tokens of a chunk, re-derived from its text if not stored."""
+        tokens = self.table.tokens(chunk_id)
+        if tokens is None:
+            tokens = tuple(tokenize(self.chunk_text(chunk_id)))
+        return tokens
+
+    def document_terms(self, path: str) -> Set[str]:
+        """All indexed terms of a loaded document."""
+        terms = set()
+        for chunk_id in self.documents[path].chunk_ids:
+            terms.update(self.chunk_terms(chunk_id))
+        return terms
+
+    def search(self, query: str, top_k: int = 5) -> List[Dict]:
+        """Top chunks for a query as {'chunk', 'doc', 'score', 'text'} hits."""
+        return self.hits_for(self.index.search(query, top_k=top_k))
+
+    def hits_for(self, ranked) -> List[Dict]:
+        """Hit dicts for a ranking of (chunk_id, score, ...) tuples."""
+        hits = []
+        for chunk_id, score, *_ in ranked:
+            chunk = self.chunks[chunk_id]
+            hits.append({
+                'chunk': chunk,
+                'doc': self.documents[chunk.doc],
+                'score': score,
+                'text': self.chunk_text(chunk_id),
+            })
+        return hits
+
+    def memory_usage(self) -> Dict:
+        """Approximate bytes held by this snapshot, by part, and per document."""
+        documents = sys.getsizeof(self.documents) + sum(
+            sys.getsizeof(doc) + sys.getsizeof(doc.name) for doc in self.documents.values())
+        postings = self.index.postings
+        decoded = postings.decoded() if isinstance(postings, MappedPostings) else postings.values()
+        index = (sys.getsizeof(postings) + sum(sys.getsizeof(p) for p in decoded)
+                 + sys.getsizeof(self.index.doc_lengths))
+        usage = {
+            'mapped': self.text.mapped_bytes,  # Shared by every process attached to the snapshot
+            'text': len(self.text) - self.text.mapped_bytes,
+            'live_text': self.text_bytes,
+            'documents': documents,
+            'chunks': self.table.nbytes() + len(self.chunks.live),
+            'index': index,
+        }
+        usage['total'] = usage['text'] + documents + usage['chunks'] + index
+        usage['bytes_per_document'] = round(usage['total'] / len(self.documents)) if self.documents else 0
+        return usage
+
+    @classmethod
+    def build(cls, chunker: Chunker, documents: Iterable[Dict]) -> "Corpus":
+        """Fresh corpus from a full document load."""
+        corpus = cls(chunker)
+        for doc in documents:
+            corpus.add_document(doc)
+        fingerprint = hashlib.sha256()
+        for path in sorted(corpus.documents):
+            fingerprint.update(f"{path}\0{corpus.documents[path].content_hash}\n".encode())
+        corpus.epoch = fingerprint.hexdigest()[:16]
+        return corpus
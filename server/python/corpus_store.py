@@ -0,0 +1,241 @@
+"""
+Compact storage behind Corpus.
+Document text is kept once, UTF-8 encoded, in an append-only TextBuffer
+(which can wrap a memory-mapped snapshot section without copying it).
+Chunks are rows of flat arrays in a ChunkTable: offsets into their
+document plus the chunk's indexed tokens as ids into a shared vocabulary.
+Documents and chunks handed out to callers are small __slots__ records.
+A table loaded from a snapshot keeps its rows in the mapping too, so
+processes attached to the same snapshot share them (see snapshot.py).
+
+TextBuffer and ChunkTable are append-only and shared by every copy of a
+corpus, so a copy-on-write update only appends; which documents and
+chunks belong to a snapshot is decided by its own documents dict and
+chunk liveness bitmap (ChunkView).
+"""
+import threading
+from array import array
+from collections.abc import Mapping
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+
+class Document:
+    """A loaded file: metadata plus the location of its text in the corpus TextBuffer."""
+    __slots__ = ('path', 'name', 'size', 'content_hash', 'offset', 'length', 'first_chunk', 'n_chunks')
+
+    def __init__(self, path: str, name: str, size: int, content_hash: Optional[str],
+                 offset: int, length: int, first_chunk: int = 0, n_chunks: int = 0):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.content_hash = content_hash
+        self.offset = offset  # Byte offset of the text in the buffer
+        self.length = length  # Encoded length in bytes
+        self.first_chunk = first_chunk
+        self.n_chunks = n_chunks
+
+    @property
+    def chunk_ids(self) -> range:
+        """A document's chunks have consecutive ids (see Corpus)."""
+        return range(self.first_chunk, self.first_chunk + self.n_chunks)
+
+    def __repr__(self) -> str:
+        return f"Document({self.path!r}, {self.length} bytes, {self.n_chunks} chunks)"
+
+
+class Chunk:
+    """A chunk of a document; start/end are character offsets into its text."""
+    __slots__ = ('id', 'doc', 'start', 'end')
+
+    def __init__(self, id: int, doc: str, start: int, end: int):
+        self.id = id
+        self.doc = doc
+        self.start = start
+        self.end = end
+
+    def __repr__(self) -> str:
+        return f"Chunk({self.id}, {self.doc!r}, {self.start}:{self.end})"
+
+
+class TextBuffer:
+    """
+    Append-only UTF-8 text. `base` is an optional read-only buffer (e.g. a
+    memoryview of a mapped snapshot); appended text goes to a bytearray
+    after it, so offsets stay valid for every reader.
+    """
+
+    def __init__(self, base=b""):
+        self._base = base
+        self._base_len = len(base)
+        self._tail = bytearray()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._base_len + len(self._tail)
+
+    @property
+    def mapped_bytes(self) -> int:
+        """Bytes served from the base buffer rather than this process's heap."""
+        return self._base_len if isinstance(self._base, memoryview) else 0
+
+    def append(self, data: bytes) -> int:
+        """Store data and return its offset."""
+        with self._lock:
+            offset = len(self)
+            self._tail += data
+            return offset
+
+    def get(self, offset: int, length: int) -> bytes:
+        if offset >= self._base_len:
+            offset -= self._base_len
+            # Slicing copies; a memoryview would block appends while it is alive
+            return bytes(self._tail[offset:offset + length])
+        return bytes(self._base[offset:offset + length])
+
+    def decode(self, offset: int, length: int) -> str:
+        if offset >= self._base_len:
+            offset -= self._base_len
+            return self._tail[offset:offset + length].decode("utf-8")
+        return str(self._base[offset:offset + length], "utf-8")
+
+
+def byte_offsets(text: str, offsets: Iterable[int]) -> Dict[int, int]:
+    """UTF-8 byte offset of each character offset, in one pass over text."""
+    if text.isascii():
+        return {o: o for o in offsets}
+    result = {}
+    position = encoded = 0
+    for offset in sorted(set(offsets)):
+        encoded += len(text[position:offset].encode("utf-8"))
+        position = offset
+        result[offset] = encoded
+    return result
+
+
+class ChunkTable:
+    """
+    Chunk rows shared by all copies of a corpus; row i is chunk id i.
+    Per row: document (index into `paths`), character and byte offsets
+    within the document, and a run of term ids (the chunk's tokens in
+    order). Rows are only appended, under a lock, so the rows of one
+    document always get consecutive ids.
+
+    The first `mapped_rows` rows may be memoryviews of a snapshot; they
+    have no stored tokens and are copied into arrays only if the table
+    is appended to.
+    """
+
+    def __init__(self):
+        self.paths: List[str] = []
+        self.doc_index = array("I")
+        self.starts = array("I")
+        self.ends = array("I")
+        self.byte_starts = array("I")
+        self.byte_ends = array("I")
+        self.mapped_rows = 0
+        self.term_offsets = array("Q", [0])  # Per row from mapped_rows on
+        self.term_ids = array("I")
+        self.vocabulary: Dict[str, int] = {}
+        self.terms: List[str] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def mapped(cls, paths: List[str], doc_index, starts, ends, byte_starts, byte_ends) -> "ChunkTable":
+        """Table over existing u32 buffers (e.g. snapshot sections), without copying them."""
+        table = cls()
+        table.paths = paths
+        table.doc_index, table.starts, table.ends = doc_index, starts, ends
+        table.byte_starts, table.byte_ends = byte_starts, byte_ends
+        table.mapped_rows = len(doc_index)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.doc_index)
+
+    def path(self, chunk_id: int) -> str:
+        return self.paths[self.doc_index[chunk_id]]
+
+    def _thaw(self) -> None:
+        for name in ("doc_index", "starts", "ends", "byte_starts", "byte_ends"):
+            column = getattr(self, name)
+            if not isinstance(column, array):
+                setattr(self, name, array("I", column))
+
+    def append(self, path: str, spans: Sequence[Tuple[int, int]],
+               byte_spans: Sequence[Tuple[int, int]], tokens: Sequence[Sequence[str]]) -> int:
+        """Add a document's chunks; returns the id of the first."""
+        with self._lock:
+            self._thaw()
+            first = len(self.doc_index)
+            doc = len(self.paths)
+            self.paths.append(path)
+            vocabulary = self.vocabulary
+            for (start, end), (byte_start, byte_end), chunk_tokens in zip(spans, byte_spans, tokens):
+                self.doc_index.append(doc)
+                self.starts.append(start)
+                self.ends.append(end)
+                self.byte_starts.append(byte_start)
+                self.byte_ends.append(byte_end)
+                for token in chunk_tokens:
+                    term_id = vocabulary.get(token)
+                    if term_id is None:
+                        term_id = vocabulary[token] = len(self.terms)
+                        self.terms.append(token)
+                    self.term_ids.append(term_id)
+                self.term_offsets.append(len(self.term_ids))
+            return first
+
+    def tokens(self, chunk_id: int) -> Optional[tuple]:
+        """Stored tokens of a chunk, or None if they were not stored."""
+        row = chunk_id - self.mapped_rows
+        if row < 0:
+            return None
+        terms = self.terms
+        return tuple(terms[i] for i in self.term_ids[self.term_offsets[row]:self.term_offsets[row + 1]])
+
+    def compacted(self, live: bytearray) -> "ChunkTable":
+        """Copy keeping ids and offsets of every row, but only the term runs of live ones."""
+        table = ChunkTable()
+        table.paths = list(self.paths)
+        for name in ("doc_index", "starts", "ends", "byte_starts", "byte_ends"):
+            setattr(table, name, array("I", getattr(self, name)[:len(live)]))
+        table.mapped_rows = self.mapped_rows
+        table.vocabulary = dict(self.vocabulary)
+        table.terms = list(self.terms)
+        for row in range(len(live) - self.mapped_rows):
+            if live[self.mapped_rows + row]:
+                table.term_ids.extend(self.term_ids[self.term_offsets[row]:self.term_offsets[row + 1]])
+            table.term_offsets.append(len(table.term_ids))
+        return table
+
+    def nbytes(self) -> int:
+        """Approximate heap memory held by the rows (mapped rows and shared path strings excluded)."""
+        columns = (self.doc_index, self.starts, self.ends, self.byte_starts, self.byte_ends,
+                   self.term_offsets, self.term_ids)
+        return sum(c.itemsize * len(c) for c in columns if isinstance(c, array)) + 8 * len(self.paths)
+
+
+class ChunkView(Mapping):
+    """
+    Chunk id -> Chunk for the rows a corpus snapshot contains. Chunk
+    records are built on access; `live` marks the snapshot's rows.
+    """
+
+    def __init__(self, table: ChunkTable, live: bytearray):
+        self.table = table
+        self.live = live
+
+    def __getitem__(self, chunk_id: int) -> Chunk:
+        if not (0 <= chunk_id < len(self.live) and self.live[chunk_id]):
+            raise KeyError(chunk_id)
+        table = self.table
+        return Chunk(chunk_id, table.path(chunk_id), table.starts[chunk_id], table.ends[chunk_id])
+
+    def __contains__(self, chunk_id) -> bool:
+        return isinstance(chunk_id, int) and 0 <= chunk_id < len(self.live) and self.live[chunk_id] == 1
+
+    def __iter__(self):
+        return (chunk_id for chunk_id, flag in enumerate(self.live) if flag)
+
+    def __len__(self) -> int:
+        return self.live.count(1)
@@ -2,26 +2,149 @@
 Dropbox RAG Integration
 Loads documents from Dropbox and provides search functionality for RAG.
 """
+import itertools
 import os
-import re
-from typing import List, Dict
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Dict, Optional
 import dropbox
-from dropbox.exceptions import AuthError, ApiError
+from dropbox.exceptions import AuthError, ApiError, RateLimitError
 from dotenv import load_dotenv
+from chunking import Chunker
+from corpus import Corpus
+from corpus_store import Document
+from extraction import Extractor, file_format
+from snapshot import DEFAULT_SNAPSHOT_PATH, SnapshotError, load_snapshot, save_cursor, save_snapshot
+from hybrid_search import Fused, HybridSearch
+from metrics import REGISTRY
+from vector_index import VectorIndex
 
 # Load environment variables
 load_dotenv()
 
+# Callbacks run after the corpus changes: callback(corpus, changed_paths, changed_terms).
+# changed_paths/changed_terms are None when the whole corpus was replaced.
+_corpus_listeners = []
+
+def on_corpus_change(callback) -> None:
+    """Register a callback for corpus updates (e.g. to invalidate caches)."""
+    _corpus_listeners.append(callback)
+
+STUB_DOCUMENTS = (
+    "Document 1: This is a placeholder document. Please configure Dropbox.",
+    "Document 2: Add your scraped content to Dropbox to use real documents.",
+)
+NO_RESULTS = "No relevant documents found in Dropbox for this query."
+LOADING = "The Dropbox document index is still loading, so no documents are available for this query yet."
+RETRIEVAL_MODES = ("keyword", "vector", "hybrid")
+INDEX_MODES = ("local", "shared", "attach")
+
+def _parse_deadlines(spec: str) -> Dict[str, float]:
+    """'vector=400,keyword=100' (milliseconds) -> {'vector': 0.4, 'keyword': 0.1}"""
+    deadlines = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, ms = item.partition("=")
+        deadlines[name.strip()] = float(ms) / 1000
+    return deadlines
+
+class FileTooLarge(Exception):
+    """A download exceeded RAG_MAX_FILE_MB."""
+
+class _ByteBudget:
+    """
+    Caps the bytes of concurrent downloads: reserve() waits until the file
+    fits. A file larger than the whole budget runs alone.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, n: int):
+        n = min(n, self.limit)
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_use + n <= self.limit)
+            self.in_use += n
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= n
+                self._cond.notify_all()
+
+def format_hit(hit: Dict) -> str:
+    """Render a search hit the way it is shown to the model."""
+    return f"[From {hit['name']}]\n{hit['text']}"
+
 class DropboxRAG:
     """Manages document retrieval from Dropbox for RAG queries."""
     
-    def __init__(self):
-        """Initialize Dropbox client and document cache."""
+    def __init__(self, dbx=None):
+        """
+        Initialize Dropbox client and document cache.
+        Pass `dbx` to use an existing client (e.g. fake_dropbox.FakeDropbox)
+        instead of connecting with DROPBOX_ACCESS_TOKEN.
+        """
         self.access_token = os.getenv("DROPBOX_ACCESS_TOKEN")
         self.folder_path = os.getenv("DROPBOX_FOLDER_PATH", "/RAG_Sources")
-        self.dbx = None
-        self.documents = []  # Cache of loaded documents
+        self.max_workers = int(os.getenv("DROPBOX_MAX_WORKERS", "8"))
+        self.max_retries = int(os.getenv("DROPBOX_MAX_RETRIES", "5"))
+        # Downloads are streamed in blocks; larger files are skipped, and the sizes of
+        # files downloading at once stay within the budget (peak ingest memory)
+        self.max_file_bytes = int(float(os.getenv("RAG_MAX_FILE_MB", "100")) * 1024 * 1024)
+        self.download_block_bytes = int(os.getenv("RAG_DOWNLOAD_BLOCK_KB", "256")) * 1024
+        self.download_budget = _ByteBudget(int(float(os.getenv("RAG_DOWNLOAD_BUDGET_MB", "256")) * 1024 * 1024))
+        self.dbx = dbx
+        self.chunker = Chunker()  # Chunk size/overlap/strategy from RAG_CHUNK_* env vars
+        self.corpus = Corpus(self.chunker)  # Current snapshot; replaced, never mutated in place
+        # keyword = BM25 only; vector also embeds every chunk at ingestion (RAG_EMBEDDER);
+        # hybrid runs both concurrently and fuses the rankings
+        self.retrieval_mode = os.getenv("RAG_RETRIEVAL_MODE", "keyword").lower()
+        self.hybrid = HybridSearch(
+            deadline=float(os.getenv("RAG_RETRIEVER_DEADLINE_MS", "250")) / 1000,
+            deadlines=_parse_deadlines(os.getenv("RAG_RETRIEVER_DEADLINES", "")),
+            candidates=int(os.getenv("RAG_HYBRID_CANDIDATES", "20")),
+        )
+        self.embedding_batch_size = int(os.getenv("RAG_EMBEDDING_BATCH_SIZE", "256"))
+        self.embedder = None  # Created on first use, see _index_vectors()
+        self.extractor = Extractor()  # HTML/JSON/CSV -> readable text
+        self._reusable = (None, {})  # (corpus, content_hash -> path) whose texts a load may reuse
+        self.cursor = None  # files_list_folder cursor for incremental refresh
+        self.snapshot_path = None  # When set, the corpus is persisted here after every update
+        # local = this process loads and refreshes its own corpus; shared = one process
+        # per snapshot path (the leader) loads and publishes it, the others attach to
+        # the published file read-only; attach = only ever attach (see snapshot.py build --watch)
+        self.index_mode = os.getenv("RAG_INDEX_MODE", "local").lower()
+        if self.index_mode not in INDEX_MODES:
+            raise ValueError(f"RAG_INDEX_MODE must be one of {INDEX_MODES}, got {self.index_mode!r}")
+        self.index_poll_seconds = float(os.getenv("RAG_INDEX_POLL_SECONDS", "2"))
+        self.role = "leader"  # or "follower": serves the published snapshot, never writes it
+        self.index_swaps = 0  # Published snapshots swapped in by a follower
+        self._leader_file = None
+        self._published = None  # (inode, size, mtime) of the snapshot the corpus came from
+        self._saved = None  # (corpus, header created_at) last written to or loaded from snapshot_path
+        self._watch_thread = None
+        self._watch_stop = threading.Event()
+        self._reconcile_thread = None  # Leader catching up with Dropbox after a snapshot load
         self.initialized = False
+        self.progress = {'listed': 0, 'loaded': 0, 'failed': 0, 'skipped': 0}  # Updated while loading
+        self._progress_lock = threading.Lock()
+        self._update_lock = threading.Lock()  # Serializes loads/refreshes
+        self._longpoll_thread = None
+        self._longpoll_stop = threading.Event()
+        
+        if dbx is not None:
+            self.initialized = True
+            return
+        
+        if self.index_mode == "attach":
+            return  # Reads the published snapshot only; no Dropbox access needed
         
         if not self.access_token or self.access_token == "your_dropbox_access_token_here":
             print("  Warning: DROPBOX_ACCESS_TOKEN not set in .env file")
@@ -43,49 +166,54 @@ class DropboxRAG:
     def load_documents(self) -> int:
         """
         Load all documents from Dropbox folder into memory cache.
-        Returns the number of documents loaded.
+        Downloads run on a bounded thread pool (DROPBOX_MAX_WORKERS) and
+        start as soon as each listing page arrives, so listing and
+        downloading overlap. Returns the number of documents loaded.
         """
         if not self.initialized:
             print("  Dropbox not initialized, skipping document load")
             return 0
         
+        with self._update_lock:
+            return self._load_all()
+    
+    def _load_all(self) -> int:
         try:
             print(f" Loading documents from Dropbox folder: {self.folder_path}")
-            self.documents = []
+            started = time.time()
+            self.progress = {'listed': 0, 'loaded': 0, 'failed': 0, 'skipped': 0}
+            entries = []
             
             # List all files in the folder recursively
-            result = self.dbx.files_list_folder(self.folder_path, recursive=True)
-            
-            file_count = 0
+            result = self._with_retry(self.dbx.files_list_folder, self.folder_path, recursive=True)
             while True:
                 for entry in result.entries:
                     # Only process text files
-                    if isinstance(entry, dropbox.files.FileMetadata):
-                        if self._is_text_file(entry.name):
-                            try:
-                                # Download file content
-                                _, response = self.dbx.files_download(entry.path_lower)
-                                content = response.content.decode('utf-8')
-                                
-                                # Store document with metadata
-                                self.documents.append({
-                                    'path': entry.path_lower,
-                                    'name': entry.name,
-                                    'content': content,
-                                    'size': entry.size,
-                                })
-                                file_count += 1
-                                print(f"   ✓ Loaded: {entry.name} ({entry.size} bytes)")
-                            except Exception as e:
-                                print(f"   ✗ Failed to load {entry.name}: {e}")
+                    if isinstance(entry, dropbox.files.FileMetadata) and self._is_text_file(entry.name):
+                        self.progress['listed'] += 1
+                        entries.append(entry)
                 
                 # Check if there are more files
                 if not result.has_more:
                     break
-                result = self.dbx.files_list_folder_continue(result.cursor)
+                result = self._with_retry(self.dbx.files_list_folder_continue, result.cursor)
+            cursor = result.cursor
             
-            print(f" Loaded {file_count} documents from Dropbox")
-            return file_count
+            # Each document goes into the corpus as soon as it (and the ones before
+            # it) arrived, in path order so the corpus is deterministic
+            entries.sort(key=lambda entry: entry.path_lower)
+            with self._reusing(self.corpus), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                corpus = Corpus.build(self.chunker, self._downloads_in_order(pool, entries))
+            corpus.version = self.corpus.version + 1
+            self._index_vectors(corpus)
+            self.corpus = corpus
+            self.cursor = cursor
+            self._notify(None, None)
+            self.save_snapshot()
+            elapsed = time.time() - started
+            print(f" Loaded {len(corpus.documents)} documents from Dropbox "
+                  f"({len(corpus.chunks)} chunks indexed, {self.progress['failed']} failed, {elapsed:.1f}s)")
+            return len(corpus.documents)
             
         except ApiError as e:
             if e.error.is_path() and e.error.get_path().is_not_found():
@@ -98,15 +226,299 @@ class DropboxRAG:
             print(f" Error loading documents: {e}")
             return 0
     
+    def _downloads_in_order(self, pool: ThreadPoolExecutor, entries: List) -> Iterator[Dict]:
+        """
+        Downloaded documents in the order of `entries`. At most
+        2 * max_workers are downloading or waiting to be indexed at once,
+        so besides the corpus itself only that window of document texts
+        is held; a failed or skipped file is left out.
+        """
+        pending = iter(entries)
+        window = deque(pool.submit(self._download_entry, entry)
+                       for entry in itertools.islice(pending, 2 * self.max_workers))
+        while window:
+            doc = window.popleft().result()
+            entry = next(pending, None)
+            if entry is not None:
+                window.append(pool.submit(self._download_entry, entry))
+            if doc is not None:
+                yield doc
+    
+    @contextmanager
+    def _reusing(self, corpus: Corpus):
+        """While loading, files with the same content as a document of `corpus` reuse its text."""
+        self._reusable = (corpus, corpus.paths_by_content_hash())
+        try:
+            yield
+        finally:
+            self._reusable = (None, {})
+
+    def _download_entry(self, entry) -> Optional[Dict]:
+        """
+        Download, decode and extract one file (runs on a worker thread).
+        The body is streamed in RAG_DOWNLOAD_BLOCK_KB blocks straight into
+        the extractor, so only the extracted text is held whole. A file
+        whose content is already in the corpus (a reload or a moved file)
+        takes that document's text and is not downloaded.
+        """
+        if entry.size > self.max_file_bytes:
+            self._skip_large(entry.name, entry.size)
+            return None
+        try:
+            corpus, paths = self._reusable
+            known = paths.get(entry.content_hash) if entry.content_hash else None
+            if known is not None and file_format(known) == file_format(entry.name):
+                content = self.extractor.reused(entry.name, entry.size, corpus.document_text(known))
+            else:
+                with self.download_budget.reserve(entry.size):
+                    _, response = self._with_retry(self.dbx.files_download, entry.path_lower)
+                    try:
+                        content, _ = self.extractor.extract(entry.name, self._read_blocks(response))
+                    finally:
+                        response.close()
+        except FileTooLarge as e:
+            self._skip_large(entry.name, e.args[0])
+            return None
+        except Exception as e:
+            self._count_progress('failed')
+            print(f"   ✗ Failed to load {entry.name}: {e}")
+            return None
+        
+        done = self._count_progress('loaded')
+        if done % 100 == 0:
+            print(f"   ✓ Loaded {done}/{self.progress['listed']} listed files")
+        return {
+            'path': entry.path_lower,
+            'name': entry.name,
+            'content': content,
+            'size': entry.size,
+            'content_hash': entry.content_hash,
+        }
+    
+    def _read_blocks(self, response):
+        read = 0
+        for block in response.iter_content(chunk_size=self.download_block_bytes):
+            read += len(block)
+            if read > self.max_file_bytes:
+                raise FileTooLarge(read)  # Listed size was stale; stop reading
+            yield block
+    
+    def _skip_large(self, name: str, size: int) -> None:
+        self._count_progress('skipped')
+        print(f"   ✗ Skipping {name}: {size / 1024 / 1024:.1f} MB is over "
+              f"RAG_MAX_FILE_MB ({self.max_file_bytes / 1024 / 1024:.0f} MB)")
+    
+    def _count_progress(self, key: str) -> int:
+        with self._progress_lock:
+            self.progress[key] += 1
+            return self.progress['loaded'] + self.progress['failed'] + self.progress['skipped']
+    
+    def _with_retry(self, call, *args, **kwargs):
+        """
+        Call a Dropbox API method, retrying rate-limit errors with
+        exponential backoff (or the server-provided backoff) plus jitter.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                return call(*args, **kwargs)
+            except RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = e.backoff if e.backoff is not None else min(30.0, 0.5 * 2 ** attempt)
+                time.sleep(delay + random.uniform(0, 0.25))
+    
+    def load_snapshot(self, path: Optional[str] = None, build_vectors: bool = True) -> bool:
+        """
+        Replace the corpus with an on-disk snapshot (see snapshot.py).
+        The snapshot's cursor is kept, so a following refresh() only
+        fetches what changed in Dropbox since it was written. With
+        build_vectors=False a missing or stale vector file leaves the
+        corpus without vectors instead of embedding it here.
+        """
+        path = path or self.snapshot_path
+        if not path or not os.path.exists(path):
+            return False
+        started = time.time()
+        published = _file_signature(path)
+        try:
+            corpus, header = load_snapshot(path, self.chunker, folder_path=self.folder_path)
+        except SnapshotError as e:
+            print(f"  Ignoring corpus snapshot: {e}")
+            return False
+        with self._update_lock:
+            if self.vectors_enabled:
+                corpus.vectors = VectorIndex.load(self._vectors_path(path), corpus, self._get_embedder())
+                if corpus.vectors is None and build_vectors:
+                    self._index_vectors(corpus)
+            self.corpus = corpus
+            self.cursor = header.get('cursor')
+            self._published = published
+            if path == self.snapshot_path:
+                self._saved = (corpus, header['created_at'])
+            self._notify(None, None)
+        print(f" Loaded corpus snapshot {path}: {len(corpus.documents)} documents, "
+              f"{len(corpus.chunks)} chunks in {(time.time() - started) * 1000:.0f} ms")
+        return True
+    
+    def save_snapshot(self, path: Optional[str] = None) -> bool:
+        """
+        Persist the current corpus and cursor; no-op unless a path is
+        configured or in a follower. Vectors are written first, so a
+        follower that sees the new snapshot also finds matching vectors.
+        When the corpus is the one already in the snapshot, only the
+        cursor is written: the snapshot file (which followers watch) is
+        left alone.
+        """
+        path = path or self.snapshot_path
+        if not path or self.role != "leader":
+            return False
+        try:
+            corpus = self.corpus
+            if path == self.snapshot_path and self._saved is not None and self._saved[0] is corpus:
+                save_cursor(path, self.cursor, self._saved[1])
+                return True
+            if corpus.vectors is not None:
+                corpus.vectors.save(self._vectors_path(path), corpus)
+            header = save_snapshot(corpus, path, cursor=self.cursor, folder_path=self.folder_path)
+            if path == self.snapshot_path:
+                self._published = _file_signature(path)
+                self._saved = (corpus, header['created_at'])
+            return True
+        except (OSError, SnapshotError) as e:
+            print(f"  Could not write corpus snapshot {path}: {e}")
+            return False
+    
+    @staticmethod
+    def _vectors_path(snapshot_path: str) -> str:
+        return snapshot_path + ".vectors.npy"
+    
+    @property
+    def vectors_enabled(self) -> bool:
+        """Whether chunks are embedded at ingestion (any mode besides keyword)."""
+        return self.retrieval_mode != "keyword"
+    
+    def _get_embedder(self):
+        if self.embedder is None:
+            from embeddings import get_embedder
+            self.embedder = get_embedder()
+        return self.embedder
+    
+    def _index_vectors(self, corpus: Corpus, previous: Optional[Corpus] = None) -> None:
+        """
+        Attach a vector index to a corpus before it is published. With the
+        previous snapshot, only chunks that are new since then are embedded.
+        """
+        if not self.vectors_enabled:
+            return
+        if previous is not None and previous.vectors is not None:
+            corpus.vectors = previous.vectors.updated(corpus, self.embedding_batch_size)
+        else:
+            corpus.vectors = VectorIndex.build(corpus, self._get_embedder(), self.embedding_batch_size)
+    
+    def _notify(self, changed_paths, changed_terms) -> None:
+        for callback in list(_corpus_listeners):
+            try:
+                callback(self.corpus, changed_paths, changed_terms)
+            except Exception as e:
+                print(f"  Corpus change listener failed: {e}")
+    
+    @property
+    def documents(self) -> List[Document]:
+        """Document records of the current snapshot (text via corpus.document_text())."""
+        return list(self.corpus.documents.values())
+    
     def _is_text_file(self, filename: str) -> bool:
         """Check if file is a supported text format."""
         text_extensions = ['.txt', '.md', '.html', '.json', '.csv']
         return any(filename.lower().endswith(ext) for ext in text_extensions)
     
+    def search(self, query: str, max_results: int = 5, mode: Optional[str] = None) -> List[Dict]:
+        """
+        Ranked chunk hits for a query, best first:
+        {'chunk_id', 'path', 'name', 'text', 'score', 'start', 'end', 'retrieval'}
+        (start/end are character offsets into the document; retrieval is
+        the mode that produced the score).
+        mode is 'keyword' (BM25), 'vector' (embedding similarity) or
+        'hybrid' (both, fused by reciprocal rank; hits also carry
+        'retrievers': {name: rank} and 'fused_retrievers', how many
+        rankings were fused) and defaults to RAG_RETRIEVAL_MODE.
+        When a hybrid retriever timed out or failed, the hits are marked
+        'degraded' and the list's `missing` names the retrievers left out.
+        Vector falls back to keyword when the corpus has no vector index.
+        Empty when nothing matches or no documents are loaded.
+        """
+        corpus = self.corpus  # One snapshot for the whole query
+        mode = self._check_mode(mode)
+        if mode == "hybrid":
+            retrievers = {'keyword': corpus.index.search}
+            if corpus.vectors is not None:
+                retrievers['vector'] = corpus.vectors.search
+            ranked = self.hybrid.search(query, retrievers, top_k=max_results)
+        elif mode == "vector" and corpus.vectors is not None:
+            ranked = corpus.vectors.search(query, top_k=max_results)
+        else:
+            # Only the postings for the query terms are touched
+            mode = "keyword"
+            ranked = corpus.index.search(query, top_k=max_results)
+        return self._hit_dicts(corpus, ranked, mode)
+    
+    def search_many(self, queries: List[str], max_results: int = 5, mode: Optional[str] = None) -> List[List[Dict]]:
+        """
+        search() for a batch of queries in one pass over the index: BM25
+        scores each distinct query term once, and the vector index scores
+        all queries with matrix-matrix products. Returns hits per query.
+        """
+        corpus = self.corpus
+        mode = self._check_mode(mode)
+        if mode == "hybrid":
+            retrievers = {'keyword': corpus.index.search_many}
+            if corpus.vectors is not None:
+                retrievers['vector'] = corpus.vectors.search_many
+            rankings = self.hybrid.search_many(queries, retrievers, top_k=max_results)
+        elif mode == "vector" and corpus.vectors is not None:
+            rankings = corpus.vectors.search_many(queries, top_k=max_results)
+        else:
+            mode = "keyword"
+            rankings = corpus.index.search_many(queries, top_k=max_results)
+        return [self._hit_dicts(corpus, ranked, mode) for ranked in rankings]
+    
+    def _check_mode(self, mode: Optional[str]) -> str:
+        mode = mode or self.retrieval_mode
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+        return mode
+    
+    @staticmethod
+    def _hit_dicts(corpus: Corpus, ranked, mode: str) -> List[Dict]:
+        hits = []
+        for hit, ranking in zip(corpus.hits_for(ranked), ranked):
+            hits.append({
+                'chunk_id': hit['chunk'].id,
+                'path': hit['doc'].path,
+                'name': hit['doc'].name,
+                'text': hit['text'],
+                'score': hit['score'],
+                'start': hit['chunk'].start,
+                'end': hit['chunk'].end,
+                'retrieval': mode,  # Which scale 'score' is on
+            })
+            if len(ranking) > 2:  # Hybrid: (chunk_id, rrf score, {retriever: rank})
+                hits[-1]['retrievers'] = ranking[2]
+                # RRF scores add up over the retrievers fused (see routing.py)
+                hits[-1]['fused_retrievers'] = len(getattr(ranked, 'fused', ())) or len(ranking[2])
+        missing = getattr(ranked, 'missing', ())
+        if missing:
+            # A retriever timed out or failed: the ranking is incomplete
+            for hit in hits:
+                hit['degraded'] = True
+            return Fused(hits, missing)
+        return hits
+    
     def search_documents(self, query: str, max_results: int = 5) -> List[str]:
         """
         Search through cached documents for relevant content.
-        Uses simple keyword matching (can be enhanced with embeddings later).
+        Ranks pre-built chunks with BM25 over the inverted index, by
+        embedding similarity, or both fused (see search()).
         
         Args:
             query: Search query
@@ -115,110 +527,414 @@ class DropboxRAG:
         Returns:
             List of relevant document chunks
         """
-        if not self.documents:
+        if not self.corpus.documents:
             print("  No documents loaded, using stub documents")
-            return [
-                "Document 1: This is a placeholder document. Please configure Dropbox.",
-                "Document 2: Add your scraped content to Dropbox to use real documents."
-            ]
+            return list(STUB_DOCUMENTS)
         
-        # Normalize query
-        query_lower = query.lower()
-        query_words = set(re.findall(r'\w+', query_lower))
-        
-        # Score each document based on keyword matches
-        scored_docs = []
-        for doc in self.documents:
-            content_lower = doc['content'].lower()
-            
-            # Calculate relevance score
-            score = 0
-            for word in query_words:
-                # Count occurrences of each query word
-                score += content_lower.count(word)
-            
-            if score > 0:
-                # Split into chunks (paragraphs)
-                chunks = self._split_into_chunks(doc['content'])
-                
-                # Score each chunk
-                for chunk in chunks:
-                    chunk_lower = chunk.lower()
-                    chunk_score = sum(chunk_lower.count(word) for word in query_words)
-                    
-                    if chunk_score > 0:
-                        scored_docs.append({
-                            'chunk': chunk,
-                            'score': chunk_score,
-                            'source': doc['name']
-                        })
-        
-        # Sort by score and return top results
-        scored_docs.sort(key=lambda x: x['score'], reverse=True)
-        
-        results = []
-        for item in scored_docs[:max_results]:
-            results.append(f"[From {item['source']}]\n{item['chunk']}")
+        results = [format_hit(hit) for hit in self.search(query, max_results)]
         
         if not results:
             print(f"  No relevant documents found for query: {query}")
-            return ["No relevant documents found in Dropbox for this query."]
+            return [NO_RESULTS]
         
         print(f" Found {len(results)} relevant document chunks")
         return results
     
-    def _split_into_chunks(self, content: str, chunk_size: int = 500) -> List[str]:
-        """
-        Split document content into manageable chunks.
-        Tries to split on paragraph boundaries.
-        """
-        # Split on double newlines (paragraphs)
-        paragraphs = re.split(r'\n\s*\n', content)
-        
-        chunks = []
-        current_chunk = ""
-        
-        for para in paragraphs:
-            para = para.strip()
-            if not para:
-                continue
-                
-            # If adding this paragraph exceeds chunk size, save current chunk
-            if len(current_chunk) + len(para) > chunk_size and current_chunk:
-                chunks.append(current_chunk.strip())
-                current_chunk = para
-            else:
-                current_chunk += "\n\n" + para if current_chunk else para
-        
-        # Add the last chunk
-        if current_chunk:
-            chunks.append(current_chunk.strip())
-        
-        return chunks
-    
     def get_stats(self) -> Dict:
         """Get statistics about loaded documents."""
+        corpus = self.corpus
         return {
             'initialized': self.initialized,
-            'document_count': len(self.documents),
-            'total_size': sum(doc['size'] for doc in self.documents),
+            'document_count': len(corpus.documents),
+            'chunk_count': len(corpus.chunks),
+            'term_count': len(corpus.index.postings),
+            'corpus_version': corpus.version,
+            'chunking': self.chunker.describe(),
+            'retrieval_mode': self.retrieval_mode,
+            'vector_count': len(corpus.vectors) if corpus.vectors is not None else 0,
+            'retrievers': self.hybrid.stats(),
+            'embedder': self.embedder.name if self.embedder is not None else None,
+            'load_progress': dict(self.progress),
+            'extraction': self.extractor.stats(),
+            'auto_refresh': self._longpoll_thread is not None,
+            'index_mode': self.index_mode,
+            'index_role': self.role,
+            'index_swaps': self.index_swaps,
+            'total_size': sum(doc.size for doc in corpus.documents.values()),
+            'memory': corpus.memory_usage(),
             'folder_path': self.folder_path
         }
     
     def refresh(self) -> int:
-        """Refresh document cache from Dropbox."""
-        print(" Refreshing documents from Dropbox...")
-        return self.load_documents()
+        """
+        Refresh document cache from Dropbox.
+        Applies only the changes since the last listing cursor: files whose
+        content_hash changed are re-downloaded and re-indexed, deleted files
+        are dropped, and the updated snapshot is swapped in atomically.
+        Falls back to a full load when there is no usable cursor.
+        Returns the number of documents added, modified or deleted.
+        A follower instead swaps in the latest published snapshot.
+        """
+        if self.role == "follower":
+            return self.reload_published()
+        if not self.initialized:
+            print("  Dropbox not initialized, skipping refresh")
+            return 0
+        
+        with self._update_lock:
+            if self.cursor is None:
+                print(" Refreshing documents from Dropbox (full load)...")
+                return self._load_all()
+            try:
+                return self._apply_changes()
+            except ApiError as e:
+                if e.error.is_reset():
+                    print(" Dropbox cursor was reset, reloading all documents")
+                    return self._load_all()
+                print(f" Dropbox API error during refresh: {e}")
+                return 0
+            except Exception as e:
+                print(f" Error refreshing documents: {e}")
+                return 0
+    
+    def _apply_changes(self) -> int:
+        corpus = self.corpus
+        changed_files = {}
+        deleted = set()
+        
+        # Collect deltas; later entries for the same path win
+        result = self._with_retry(self.dbx.files_list_folder_continue, self.cursor)
+        while True:
+            for entry in result.entries:
+                path = entry.path_lower
+                if isinstance(entry, dropbox.files.DeletedMetadata):
+                    changed_files.pop(path, None)
+                    deleted.add(path)
+                elif isinstance(entry, dropbox.files.FileMetadata) and self._is_text_file(entry.name):
+                    deleted.discard(path)
+                    changed_files[path] = entry
+            if not result.has_more:
+                break
+            result = self._with_retry(self.dbx.files_list_folder_continue, result.cursor)
+        
+        # Skip files whose content is unchanged
+        to_download = [
+            entry for path, entry in changed_files.items()
+            if getattr(corpus.documents.get(path), 'content_hash', None) != entry.content_hash
+        ]
+        
+        documents = []
+        if to_download:
+            with self._reusing(corpus), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                for doc in pool.map(self._download_entry, to_download):
+                    if doc is not None:
+                        documents.append(doc)
+        
+        updated = corpus.copy()
+        removed = 0
+        for path in deleted:
+            # A deleted path may be a file or a whole folder
+            if updated.remove_document(path):
+                removed += 1
+            else:
+                removed += len(updated.remove_prefix(path))
+        for doc in documents:
+            updated.add_document(doc)
+        
+        changes = removed + len(documents)
+        if changes:
+            self._index_vectors(updated, previous=corpus)
+            self.corpus = updated
+            changed_terms = set()
+            for doc in documents:
+                changed_terms |= updated.document_terms(doc['path'])
+            self._notify(deleted | {doc['path'] for doc in documents}, changed_terms)
+        self.cursor = result.cursor
+        self.save_snapshot()
+        print(f" Refreshed from Dropbox: {len(documents)} added/modified, {removed} deleted, "
+              f"{len(changed_files) - len(to_download)} unchanged (corpus v{self.corpus.version})")
+        return changes
+    
+    def start_auto_refresh(self, timeout: int = 30) -> None:
+        """
+        Keep the corpus fresh in the background: long-poll Dropbox for
+        changes on the current cursor and apply them incrementally.
+        """
+        if self._longpoll_thread is not None or not self.initialized:
+            return
+        self._longpoll_stop.clear()
+        self._longpoll_thread = threading.Thread(
+            target=self._longpoll_loop, args=(timeout,), name="dropbox-longpoll", daemon=True
+        )
+        self._longpoll_thread.start()
+        print(f" Dropbox auto-refresh started (longpoll timeout {timeout}s)")
+    
+    def stop_auto_refresh(self) -> None:
+        """Stop the background long-poll loop."""
+        thread = self._longpoll_thread
+        if thread is None:
+            return
+        self._longpoll_stop.set()
+        thread.join(timeout=1)
+        self._longpoll_thread = None
+    
+    def _longpoll_loop(self, timeout: int) -> None:
+        while not self._longpoll_stop.is_set():
+            try:
+                if self.cursor is None:
+                    self.refresh()
+                    continue
+                result = self.dbx.files_list_folder_longpoll(self.cursor, timeout=timeout)
+                if result.changes and not self._longpoll_stop.is_set():
+                    self.refresh()
+                if result.backoff:
+                    self._longpoll_stop.wait(result.backoff)
+            except Exception as e:
+                print(f" Dropbox longpoll error: {e}")
+                self._longpoll_stop.wait(5)
+    
+    def start(self) -> None:
+        """
+        Load the corpus and start background updates according to
+        RAG_INDEX_MODE. A leader loads from the snapshot or Dropbox and
+        keeps the snapshot file up to date; a follower memory-maps the
+        published file (text, chunk table and postings are shared
+        read-only with every other process mapping it) and swaps in each
+        new version the leader publishes.
+        """
+        if self.index_mode != "local" and not self.snapshot_path:
+            print("  RAG_INDEX_MODE needs RAG_SNAPSHOT_PATH; loading a local index")
+            self.index_mode = "local"
+        if self.index_mode == "shared" and not self.initialized:
+            self.index_mode = "local"  # No Dropbox access here, so no leader could publish either
+        if self.index_mode == "local" or self.claim_leadership() or not self._attach_published():
+            self._lead()
+        if self.role == "follower":
+            self._watch_thread = threading.Thread(target=self._watch_loop, name="index-watch", daemon=True)
+            self._watch_thread.start()
+    
+    def _lead(self) -> None:
+        self.role = "leader"
+        if self.load_snapshot():
+            # Serve from the snapshot now, catch up with Dropbox in the background
+            self._reconcile_thread = threading.Thread(target=self.refresh, name="dropbox-reconcile", daemon=True)
+            self._reconcile_thread.start()
+        else:
+            # Load documents on first initialization
+            self.load_documents()
+        if os.getenv("DROPBOX_AUTO_REFRESH", "false").lower() in ("1", "true", "yes"):
+            self.start_auto_refresh()
+    
+    def claim_leadership(self) -> bool:
+        """
+        Try to become the process that builds and publishes the shared
+        index: a non-blocking exclusive lock on <snapshot>.lock, held
+        until the process exits (so a dead leader's lock is released).
+        """
+        if self.index_mode == "attach":
+            return False
+        if self.index_mode == "local" or self._leader_file is not None:
+            return True
+        try:
+            import fcntl
+        except ImportError:
+            return True  # No flock (Windows): every process builds its own index
+        lock_file = open(self.snapshot_path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._leader_file = lock_file
+        print(f" Index leader (pid {os.getpid()}): publishing {self.snapshot_path}")
+        return True
+    
+    def _attach_published(self) -> bool:
+        """
+        Become a follower and wait for the published snapshot. Returns
+        False if this process took over leadership while waiting.
+        """
+        self.role = "follower"
+        waited = False
+        while not self.load_snapshot(build_vectors=False):
+            if self.index_mode == "shared" and self.claim_leadership():
+                return False
+            if not waited:
+                print(f" Waiting for the index leader to publish {self.snapshot_path}")
+                waited = True
+            time.sleep(self.index_poll_seconds)
+        return True
+    
+    def reload_published(self) -> int:
+        """Swap in the published snapshot if it changed since it was loaded. Returns 1 if swapped."""
+        signature = _file_signature(self.snapshot_path)
+        if signature is None or signature == self._published:
+            return 0
+        previous = self.corpus.version
+        if not self.load_snapshot(build_vectors=False):
+            return 0
+        self.index_swaps += 1
+        print(f" Swapped in published index v{self.corpus.version} (was v{previous})")
+        return 1
+    
+    def stop_index_watch(self) -> None:
+        """Stop following the published snapshot."""
+        thread = self._watch_thread
+        if thread is None:
+            return
+        self._watch_stop.set()
+        thread.join(timeout=1)
+        self._watch_thread = None
+    
+    def close(self) -> None:
+        """Stop background threads and give up leadership of the shared index."""
+        self.stop_index_watch()
+        self.stop_auto_refresh()
+        if self._reconcile_thread is not None:
+            self._reconcile_thread.join()
+            self._reconcile_thread = None
+        if self._leader_file is not None:
+            self._leader_file.close()  # Releases the lock for the next leader
+            self._leader_file = None
+    
+    def _watch_loop(self) -> None:
+        while self.role == "follower" and not self._watch_stop.wait(self.index_poll_seconds):
+            try:
+                if self.index_mode == "shared" and self.claim_leadership():
+                    # The leader exited; continue from its last published snapshot
+                    self._lead()
+                    return
+                self.reload_published()
+            except Exception as e:
+                print(f"  Index watch error: {e}")
+
+
+def _file_signature(path: str) -> Optional[tuple]:
+    """Changes whenever the file is replaced (the leader publishes with a rename)."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
 
 
 # Global instance (singleton pattern)
 _dropbox_rag_instance = None
+_instance_lock = threading.Lock()  # Held while the instance is built; later callers wait for it
+_loading_instance = None  # The instance being built, for progress reporting
+_warmup_lock = threading.Lock()
+_warmup_thread = None
+_warmup = {'state': 'idle', 'started_at': None, 'finished_at': None, 'error': None}
+
+def _default_instance() -> DropboxRAG:
+    instance = DropboxRAG()
+    instance.snapshot_path = os.getenv("RAG_SNAPSHOT_PATH", DEFAULT_SNAPSHOT_PATH) or None
+    return instance
+
+def _build_instance(factory: Callable[[], DropboxRAG]) -> None:
+    """Create and load the global instance. Caller holds _instance_lock."""
+    global _dropbox_rag_instance, _loading_instance
+    _warmup.update(state='loading', started_at=time.time(), finished_at=None, error=None)
+    try:
+        instance = _loading_instance = factory()
+        instance.start()
+    except Exception as e:
+        _warmup.update(state='failed', finished_at=time.time(), error=str(e))
+        raise
+    finally:
+        _loading_instance = None
+    _dropbox_rag_instance = instance
+    _warmup.update(state='ready', finished_at=time.time())
+    print(f" Corpus ready ({len(instance.corpus.documents)} documents, "
+          f"{_warmup['finished_at'] - _warmup['started_at']:.1f}s)")
 
-def get_dropbox_rag() -> DropboxRAG:
-    """Get or create the global DropboxRAG instance."""
-    global _dropbox_rag_instance
+def get_dropbox_rag(factory: Optional[Callable[[], DropboxRAG]] = None) -> DropboxRAG:
+    """
+    Get or create the global DropboxRAG instance. Blocks until the corpus
+    is loaded; concurrent first callers wait for a single load.
+    """
     if _dropbox_rag_instance is None:
-        _dropbox_rag_instance = DropboxRAG()
-        # Load documents on first initialization
-        _dropbox_rag_instance.load_documents()
-    return _dropbox_rag_instance
\ No newline at end of file
+        with _instance_lock:
+            if _dropbox_rag_instance is None:
+                _build_instance(factory or _default_instance)
+    return _dropbox_rag_instance
+
+def start_warmup(factory: Optional[Callable[[], DropboxRAG]] = None) -> bool:
+    """
+    Build the global instance on a background thread (server startup).
+    Returns False if it is already loaded or being loaded. A failed
+    warm-up is retried on the next call.
+    """
+    global _warmup_thread
+    with _warmup_lock:
+        if _dropbox_rag_instance is not None or (_warmup_thread is not None and _warmup_thread.is_alive()):
+            return False
+
+        def warm():
+            try:
+                get_dropbox_rag(factory)
+            except Exception as e:
+                print(f" Corpus warm-up failed: {e}")
+
+        _warmup_thread = threading.Thread(target=warm, name="corpus-warmup", daemon=True)
+        _warmup_thread.start()
+        return True
+
+def get_ready_dropbox_rag() -> Optional[DropboxRAG]:
+    """The global instance if its corpus is loaded; otherwise starts warm-up and returns None."""
+    instance = _dropbox_rag_instance
+    if instance is None:
+        start_warmup()
+    return instance
+
+def warmup_status() -> Dict:
+    """Readiness for /readyz: warm-up state, load progress and the served corpus version."""
+    instance = _dropbox_rag_instance or _loading_instance
+    ready = _dropbox_rag_instance is not None
+    started, finished = _warmup['started_at'], _warmup['finished_at']
+    status = {
+        'ready': ready,
+        # An instance installed without warm-up (tests, benchmarks) counts as ready
+        'state': 'ready' if ready else _warmup['state'],
+        'error': _warmup['error'],
+        'elapsed_s': round((finished or time.time()) - started, 2) if started else None,
+        'dropbox': instance.initialized if instance is not None else None,
+        'progress': dict(instance.progress) if instance is not None else None,
+        'documents': len(instance.corpus.documents) if instance is not None else 0,
+        'corpus_version': instance.corpus.version if ready else None,
+        'index_role': instance.role if instance is not None else None,
+    }
+    return status
+
+def _collect_metrics():
+    """Readiness, corpus size and retriever outcomes for /metrics."""
+    instance = _dropbox_rag_instance or _loading_instance
+    yield ("rag_ready", "gauge", "1 once the corpus is loaded and requests get Dropbox context",
+           [({}, 1 if _dropbox_rag_instance is not None else 0)])
+    if instance is None:
+        return
+    corpus = instance.corpus
+    yield ("rag_corpus_documents", "gauge", "Documents in the served corpus", [({}, len(corpus.documents))])
+    yield ("rag_corpus_chunks", "gauge", "Chunks in the served corpus", [({}, len(corpus.chunks))])
+    yield ("rag_corpus_terms", "gauge", "Distinct indexed terms", [({}, len(corpus.index.postings))])
+    yield ("rag_corpus_vectors", "gauge", "Chunk embeddings in the vector index",
+           [({}, len(corpus.vectors) if corpus.vectors is not None else 0)])
+    yield ("rag_corpus_version", "gauge", "Version of the served corpus snapshot", [({}, corpus.version)])
+    yield ("rag_index_leader", "gauge", "1 if this process builds and publishes the index, 0 if it attaches to it",
+           [({"mode": instance.index_mode}, 1 if instance.role == "leader" else 0)])
+    yield ("rag_index_swaps_total", "counter", "Published index snapshots swapped in by this follower",
+           [({}, instance.index_swaps)])
+    yield ("rag_load_files", "gauge", "Files listed, loaded and failed by the current or last load",
+           [({"state": state}, n) for state, n in instance.progress.items()])
+    formats = instance.extractor.stats()['formats']
+    yield ("rag_extract_files_total", "counter", "Files passed through format extraction, by result",
+           [({"format": fmt, "result": result}, s[result]) for fmt, s in formats.items()
+            for result in ("files", "cached", "failed")])
+    yield ("rag_extract_bytes_total", "counter", "UTF-8 bytes before (in) and after (out) format extraction",
+           [({"format": fmt, "direction": d}, s[f"bytes_{d}"]) for fmt, s in formats.items() for d in ("in", "out")])
+    retrievers = instance.hybrid.stats()
+    yield ("rag_retriever_calls_total", "counter", "Hybrid retriever calls by outcome",
+           [({"retriever": name, "outcome": outcome}, s[outcome])
+            for name, s in retrievers.items() for outcome in ("ok", "timeouts", "errors")])
+
+REGISTRY.add_collector(_collect_metrics)
@@ -0,0 +1,102 @@
+"""
+Text embedders.
+Every embedder exposes `dim`, `name` and `embed(texts) -> float32 array
+(n, dim)` with L2-normalized rows, so cosine similarity is a dot product.
+
+  hashing - offline, CPU-only feature hashing of words, word bigrams and
+            character trigrams (default)
+  openai  - OpenAI embeddings API (RAG_EMBEDDING_MODEL)
+
+Select with RAG_EMBEDDER; see get_embedder().
+"""
+import os
+import zlib
+from typing import List
+
+import numpy as np
+
+from search_index import tokenize
+
+
+class HashingEmbedder:
+    """
+    Deterministic bag-of-features embedding; no model download, no network.
+    Features are hashed into `dim` buckets with a sign bit to reduce
+    collisions, weighted by 1 + log(tf).
+    """
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    @property
+    def name(self) -> str:
+        return f"hashing-{self.dim}"
+
+    def _features(self, text: str) -> List[str]:
+        words = tokenize(text)
+        features = list(words)
+        features.extend(f"{a} {b}" for a, b in zip(words, words[1:]))
+        for word in words:
+            padded = f"<{word}>"
+            features.extend("#" + padded[i:i + 3] for i in range(len(padded) - 2))
+        return features
+
+    def _buckets(self, text: str):
+        counts = {}
+        for feature in self._features(text):
+            h = zlib.crc32(feature.encode("utf-8"))
+            bucket = h % self.dim
+            sign = 1.0 if (h >> 31) & 1 else -1.0
+            counts[bucket] = counts.get(bucket, 0.0) + sign
+        return counts
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for bucket, value in self._buckets(text).items():
+                out[row, bucket] = np.sign(value) * (1.0 + np.log(abs(value))) if value else 0.0
+        return _normalize(out)
+
+
+class OpenAIEmbedder:
+    """OpenAI embeddings API; requests are sent in batches of `batch_size` texts."""
+
+    def __init__(self, model: str = "text-embedding-3-small", dim: int = 1536, batch_size: int = 256):
+        from openai import OpenAI
+
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        self.model = model
+        self.dim = dim
+        self.batch_size = batch_size
+
+    @property
+    def name(self) -> str:
+        return f"openai-{self.model}-{self.dim}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for start in range(0, len(texts), self.batch_size):
+            batch = [t or " " for t in texts[start:start + self.batch_size]]
+            response = self.client.embeddings.create(model=self.model, input=batch, dimensions=self.dim)
+            for item in response.data:
+                out[start + item.index] = item.embedding
+        return _normalize(out)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def get_embedder():
+    """Embedder selected by RAG_EMBEDDER (hashing | openai)."""
+    kind = os.getenv("RAG_EMBEDDER", "hashing").lower()
+    if kind == "openai":
+        return OpenAIEmbedder(
+            model=os.getenv("RAG_EMBEDDING_MODEL", "text-embedding-3-small"),
+            dim=int(os.getenv("RAG_EMBEDDING_DIM", "1536")),
+        )
+    if kind != "hashing":
+        raise ValueError(f"Unknown RAG_EMBEDDER {kind!r}, expected 'hashing' or 'openai'")
+    return HashingEmbedder(dim=int(os.getenv("RAG_EMBEDDING_DIM", "512")))
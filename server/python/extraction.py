@@ -0,0 +1,284 @@
+"""
+Format-aware text extraction at ingestion.
+Files are indexed as the text a reader would see, not their raw bytes:
+  .html - main content (<main>/<article> when present) without scripts,
+          styles and navigation; headings become Markdown headings so
+          RAG_CHUNK_STRATEGY=heading still splits on them
+  .json - selected fields (RAG_JSON_FIELDS) as "field: value" lines,
+          one paragraph per record
+  .csv  - one "column: value; ..." record per row
+Anything else (and a file that fails to parse) is kept as-is.
+
+Extractor.extract() takes the file as UTF-8 blocks (a streamed download)
+and decodes them incrementally; HTML and CSV are extracted piece by
+piece, so the raw file is never held in memory whole. Extraction runs
+once per file content: a file whose Dropbox content_hash matches a
+document already in the corpus (a reload or a moved file) reuses that
+document's text instead of being downloaded and processed again (see
+DropboxRAG), so no second copy of the extracted text is kept.
+"""
+import codecs
+import csv
+import io
+import json
+import os
+import threading
+from html.parser import HTMLParser
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Bump when extraction output changes, so snapshots built with older output are rebuilt
+EXTRACTION_VERSION = 1
+
+DEFAULT_JSON_FIELDS = "title,name,heading,question,answer,summary,description,content,text,body,steps"
+
+# Never part of the readable content
+SKIP_TAGS = frozenset("script style noscript template svg canvas iframe head form button select".split())
+# Page chrome, dropped when it is not inside the main content
+BOILERPLATE_TAGS = frozenset("nav header footer aside".split())
+MAIN_TAGS = frozenset(("main", "article"))
+BLOCK_TAGS = frozenset("""
+p div section main article li ul ol dl dt dd table tr blockquote pre br hr
+figure figcaption details summary h1 h2 h3 h4 h5 h6 header footer nav aside
+""".split())
+VOID_TAGS = frozenset("area base br col embed hr img input link meta source track wbr".split())
+
+
+class _HTMLText(HTMLParser):
+    """Collects text blocks, separately for the whole body and for <main>/<article>."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: List[str] = []
+        self.main_blocks: List[str] = []
+        self._line: List[str] = []
+        self._skip = 0
+        self._boilerplate = 0
+        self._main = 0
+        self._prefix = ""
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_TAGS:
+            if tag in ("br", "hr"):
+                self._flush()
+            return
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag in MAIN_TAGS:
+            self._flush()
+            self._main += 1
+        elif tag in BOILERPLATE_TAGS:
+            self._boilerplate += 1
+        if tag in BLOCK_TAGS:
+            self._flush()
+            if len(tag) == 2 and tag[0] == "h" and tag[1].isdigit():
+                self._prefix = "#" * int(tag[1]) + " "
+            elif tag == "li":
+                self._prefix = "- "
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in ("br", "hr"):
+            self._flush()
+
+    def handle_endtag(self, tag):
+        if tag in VOID_TAGS:
+            return
+        if tag in BLOCK_TAGS:
+            self._flush()
+        if tag in SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in MAIN_TAGS:
+            self._main = max(0, self._main - 1)
+        elif tag in BOILERPLATE_TAGS:
+            self._boilerplate = max(0, self._boilerplate - 1)
+
+    def handle_data(self, data):
+        if not self._skip:
+            self._line.append(data)
+
+    def _flush(self):
+        text = " ".join("".join(self._line).split())
+        self._line = []
+        if text:
+            text = self._prefix + text
+            if self._main:
+                self.main_blocks.append(text)
+            # Chrome inside <main> is content; outside it, it is navigation
+            if self._main or not self._boilerplate:
+                self.blocks.append(text)
+        self._prefix = ""
+
+    def text(self) -> str:
+        self._flush()
+        return "\n\n".join(self.main_blocks or self.blocks)
+
+
+def _pieces(content: Union[str, Iterable[str]]) -> Iterable[str]:
+    return (content,) if isinstance(content, str) else content
+
+
+def extract_html(content: Union[str, Iterable[str]]) -> str:
+    """Text of an HTML document, given whole or as consecutive pieces."""
+    parser = _HTMLText()
+    for piece in _pieces(content):
+        parser.feed(piece)
+    parser.close()
+    return parser.text()
+
+
+def _json_fields() -> List[str]:
+    return [f.strip().lower() for f in os.getenv("RAG_JSON_FIELDS", DEFAULT_JSON_FIELDS).split(",") if f.strip()]
+
+
+def _scalar(value) -> Optional[str]:
+    if isinstance(value, str):
+        return " ".join(value.split()) or None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, list) and value and all(isinstance(v, str) for v in value):
+        return "; ".join(" ".join(v.split()) for v in value if v.strip()) or None
+    return None
+
+
+def extract_json(content: str, fields: Optional[List[str]] = None) -> str:
+    """
+    Selected fields of every object, one paragraph per object. When none
+    of the fields occur anywhere, all string values are kept instead.
+    """
+    data = json.loads(content)
+    wanted = set(fields if fields is not None else _json_fields())
+
+    def records(node, select) -> List[str]:
+        out = []
+        if isinstance(node, dict):
+            lines = []
+            for key, value in node.items():
+                text = _scalar(value)
+                if text is not None:
+                    if select is None or str(key).lower() in select:
+                        lines.append(f"{key}: {text}")
+                else:
+                    out.extend(records(value, select))
+            if lines:
+                out.insert(0, "\n".join(lines))
+        elif isinstance(node, list):
+            for item in node:
+                out.extend(records(item, select))
+        else:
+            text = _scalar(node)
+            if text is not None and select is None:
+                out.append(text)
+        return out
+
+    return "\n\n".join(records(data, wanted) or records(data, None))
+
+
+def _lines(pieces: Iterable[str]) -> Iterator[str]:
+    """Re-split pieces of text into lines (quoted newlines inside a field are left to csv)."""
+    pending = ""
+    for piece in pieces:
+        pending += piece
+        end = pending.rfind("\n") + 1
+        if end:
+            yield from io.StringIO(pending[:end], newline="\n")
+            pending = pending[end:]
+    if pending:
+        yield pending
+
+
+def extract_csv(content: Union[str, Iterable[str]]) -> str:
+    """One line per row: 'column: value; column: value' (empty cells skipped)."""
+    reader = csv.reader(_lines(_pieces(content)))
+    header = next(reader, None)
+    if not header:
+        return ""
+    header = [h.strip() or f"column {i + 1}" for i, h in enumerate(header)]
+    rows = []
+    for row in reader:
+        cells = [f"{header[i] if i < len(header) else f'column {i + 1}'}: {' '.join(cell.split())}"
+                 for i, cell in enumerate(row) if cell.strip()]
+        if cells:
+            rows.append("; ".join(cells))
+    return "\n".join(rows)
+
+
+FORMATS = {".html": "html", ".json": "json", ".csv": "csv"}
+EXTRACTORS = {"html": extract_html, "json": extract_json, "csv": extract_csv}
+
+
+def file_format(name: str) -> str:
+    """'html', 'json', 'csv' or 'text' (kept as-is)."""
+    return FORMATS.get(os.path.splitext(name.lower())[1], "text")
+
+
+class Extractor:
+    """
+    Applies the extractor for a file's format and counts files, bytes
+    in/out and reused texts (`cached`) per format.
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def reused(self, name: str, size: int, text: str) -> str:
+        """Count a file whose text was taken from an already extracted copy of the same content."""
+        self._count(file_format(name), size, len(text.encode("utf-8")), cached=True)
+        return text
+
+    def extract(self, name: str, blocks: Iterable[bytes]) -> Tuple[str, str]:
+        """
+        Decode UTF-8 blocks (e.g. a streamed download) incrementally and
+        return (text to index, format). HTML and CSV are extracted as the
+        blocks arrive, so only the extracted text is ever held whole.
+        Raises UnicodeDecodeError for files that are not UTF-8.
+        """
+        fmt = file_format(name)
+        counted = [0]
+        decoder = codecs.getincrementaldecoder("utf-8")()
+
+        def pieces():
+            for block in blocks:
+                counted[0] += len(block)
+                piece = decoder.decode(block)  # Keeps a multi-byte character split across blocks
+                if piece:
+                    yield piece
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+
+        if fmt == "text":
+            text = "".join(pieces())
+            self._count(fmt, counted[0], counted[0], cached=False)
+            return text, fmt
+        if fmt == "json":
+            # The stdlib parser needs the whole document
+            raw = "".join(pieces())
+            try:
+                text = extract_json(raw)
+            except ValueError as e:
+                # Malformed file: index it as plain text rather than dropping it
+                print(f"   ✗ Could not extract {name} as {fmt}, keeping raw text: {e}")
+                self._count(fmt, counted[0], counted[0], cached=False, failed=True)
+                return raw, fmt
+        else:
+            text = EXTRACTORS[fmt](pieces())
+        self._count(fmt, counted[0], len(text.encode("utf-8")), cached=False)
+        return text, fmt
+
+    def _count(self, fmt: str, raw_bytes: int, text_bytes: int, cached: bool, failed: bool = False) -> None:
+        with self._lock:
+            s = self._stats.setdefault(fmt, {'files': 0, 'cached': 0, 'failed': 0,
+                                             'bytes_in': 0, 'bytes_out': 0, 'bytes_removed': 0})
+            s['files'] += 1
+            s['cached'] += cached
+            s['failed'] += failed
+            s['bytes_in'] += raw_bytes
+            s['bytes_out'] += text_bytes
+            s['bytes_removed'] += raw_bytes - text_bytes
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per format: files, reused texts, failures, bytes in/out/removed and removed ratio."""
+        with self._lock:
+            formats = {fmt: dict(s, removed_ratio=round(s['bytes_removed'] / s['bytes_in'], 4) if s['bytes_in'] else 0.0)
+                       for fmt, s in self._stats.items()}
+            return {'formats': formats}
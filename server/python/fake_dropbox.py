@@ -0,0 +1,169 @@
+"""
+In-memory stand-in for the Dropbox SDK client.
+Implements the handful of calls DropboxRAG uses, returns real
+`dropbox.files` metadata types, and can inject per-call latency and
+rate-limit errors so ingestion can be exercised offline.
+"""
+import datetime
+import hashlib
+import itertools
+import threading
+import time
+from typing import Dict
+
+from dropbox import files
+from dropbox.exceptions import RateLimitError
+
+DROPBOX_HASH_BLOCK = 4 * 1024 * 1024
+
+
+def dropbox_content_hash(data: bytes) -> str:
+    """Dropbox content_hash: sha256 over the concatenated sha256 of each 4 MB block."""
+    block_hashes = b"".join(
+        hashlib.sha256(data[i:i + DROPBOX_HASH_BLOCK]).digest()
+        for i in range(0, len(data), DROPBOX_HASH_BLOCK)
+    )
+    return hashlib.sha256(block_hashes).hexdigest()
+
+
+class FakeResponse:
+    """Mimics the requests.Response returned by files_download."""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.blocks = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size: int = 1, decode_unicode: bool = False):
+        for i in range(0, len(self.content), chunk_size):
+            self.blocks += 1
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDropbox:
+    """
+    Fake Dropbox client backed by a dict of path -> bytes.
+
+    Args:
+        files_by_path: initial folder contents ({'/rag_sources/a.md': b'...'})
+        latency: seconds slept on every API call
+        page_size: entries per files_list_folder page
+        rate_limit_every: raise RateLimitError on every Nth download (0 = never)
+    """
+
+    def __init__(self, files_by_path: Dict[str, bytes] = None, latency: float = 0.0,
+                 page_size: int = 100, rate_limit_every: int = 0):
+        self.latency = latency
+        self.page_size = page_size
+        self.rate_limit_every = rate_limit_every
+        self._files: Dict[str, bytes] = {}
+        self._log = []  # paths in the order they changed
+        self._pages = {}  # page cursor -> (remaining entries, log position)
+        self._cursor_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self.calls = {"list": 0, "continue": 0, "download": 0, "rate_limited": 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        for path, data in (files_by_path or {}).items():
+            self.put(path, data)
+
+    # --- test helpers ---
+
+    def put(self, path: str, data: bytes):
+        """Create or overwrite a file."""
+        with self._changed:
+            self._files[path.lower()] = data
+            self._log.append(path.lower())
+            self._changed.notify_all()
+
+    def delete(self, path: str):
+        """Remove a file."""
+        with self._changed:
+            self._files.pop(path.lower(), None)
+            self._log.append(path.lower())
+            self._changed.notify_all()
+
+    def _sleep(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _metadata(self, path: str):
+        if path not in self._files:
+            return files.DeletedMetadata(name=path.rsplit("/", 1)[-1], path_lower=path, path_display=path)
+        data = self._files[path]
+        stamp = datetime.datetime(2024, 1, 1)
+        return files.FileMetadata(
+            name=path.rsplit("/", 1)[-1],
+            id="id:" + hashlib.md5(path.encode()).hexdigest()[:16],
+            client_modified=stamp,
+            server_modified=stamp,
+            rev="%09x" % (len(self._log) or 1),
+            size=len(data),
+            path_lower=path,
+            path_display=path,
+            content_hash=dropbox_content_hash(data),
+        )
+
+    def _paginate(self, entries, log_pos):
+        page, rest = entries[:self.page_size], entries[self.page_size:]
+        if rest:
+            cursor = f"page:{next(self._cursor_ids)}"
+            self._pages[cursor] = (rest, log_pos)
+        else:
+            cursor = f"log:{log_pos}"
+        return files.ListFolderResult(entries=page, cursor=cursor, has_more=bool(rest))
+
+    # --- Dropbox API surface ---
+
+    def users_get_current_account(self):
+        self._sleep()
+        return {"account_id": "fake"}
+
+    def files_list_folder(self, path, recursive=False, limit=None, **kwargs):
+        self._sleep()
+        prefix = path.lower().rstrip("/") + "/"
+        with self._lock:
+            self.calls["list"] += 1
+            entries = [self._metadata(p) for p in sorted(self._files) if p.startswith(prefix)]
+            return self._paginate(entries, len(self._log))
+
+    def files_list_folder_continue(self, cursor):
+        self._sleep()
+        with self._lock:
+            self.calls["continue"] += 1
+            if cursor in self._pages:
+                entries, log_pos = self._pages.pop(cursor)
+                return self._paginate(entries, log_pos)
+            log_pos = int(cursor.split(":", 1)[1])
+            changed = list(dict.fromkeys(self._log[log_pos:]))
+            entries = [self._metadata(p) for p in changed]
+            return self._paginate(entries, len(self._log))
+
+    def files_list_folder_longpoll(self, cursor, timeout=30):
+        log_pos = int(cursor.split(":", 1)[1])
+        with self._changed:
+            changes = self._changed.wait_for(lambda: len(self._log) > log_pos, timeout=timeout)
+            return files.ListFolderLongpollResult(changes=bool(changes), backoff=None)
+
+    def files_download(self, path, rev=None):
+        with self._lock:
+            self.calls["download"] += 1
+            n = self.calls["download"]
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            self._sleep()
+            if self.rate_limit_every and n % self.rate_limit_every == 0:
+                with self._lock:
+                    self.calls["rate_limited"] += 1
+                raise RateLimitError("fake-request", backoff=0)
+            with self._lock:
+                data = self._files[path.lower()]
+                return self._metadata(path.lower()), FakeResponse(data)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
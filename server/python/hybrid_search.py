@@ -0,0 +1,181 @@
+"""
+Hybrid retrieval: several retrievers run concurrently and their rankings
+are merged with reciprocal-rank fusion (RRF).
+Every retriever has its own deadline and its own threads. One that misses
+its deadline is left out of that query's fusion, so a slow retriever
+makes the result less complete but does not make the request slower, and
+its backlog cannot delay the others. The fused ranking names the
+retrievers that were left out (`missing`), so callers can avoid caching
+an incomplete result.
+"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional, Tuple
+
+# retriever(query, top_k) -> [(chunk_id, score)] best first
+Retriever = Callable[[str, int], List[Tuple[int, float]]]
+
+
+class Fused(list):
+    """
+    Fused [(chunk_id, rrf score, {retriever: rank})]. `fused` names the
+    retrievers whose rankings went in, `missing` the ones that timed out
+    or failed.
+    """
+
+    def __init__(self, hits=(), missing=(), fused=()):
+        super().__init__(hits)
+        self.missing = tuple(missing)
+        self.fused = tuple(fused)
+
+
+def reciprocal_rank_fusion(rankings: Dict[str, List[Tuple[int, float]]], k: int = 60,
+                           top_k: int = 5) -> List[Tuple[int, float, Dict[str, int]]]:
+    """
+    Fuse rankings by summing 1 / (k + rank) over the retrievers that
+    returned each chunk. Returns [(chunk_id, rrf score, {retriever: rank})].
+    """
+    fused: Dict[int, float] = {}
+    ranks: Dict[int, Dict[str, int]] = {}
+    for name, ranking in rankings.items():
+        for rank, (chunk_id, _) in enumerate(ranking, start=1):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (k + rank)
+            ranks.setdefault(chunk_id, {})[name] = rank
+    # Stable sort: ties keep the order in which retrievers were listed
+    best = sorted(fused, key=fused.get, reverse=True)[:top_k]
+    return [(chunk_id, fused[chunk_id], ranks[chunk_id]) for chunk_id in best]
+
+
+class HybridSearch:
+    """
+    Args:
+        deadline: default seconds each retriever gets, from the start of the query
+        deadlines: per-retriever overrides, e.g. {'vector': 0.5}
+        candidates: ranking depth requested from each retriever
+        rrf_k: RRF smoothing constant (60 is the usual choice)
+        max_workers: threads per retriever
+    """
+
+    def __init__(self, deadline: float = 0.25, deadlines: Optional[Dict[str, float]] = None,
+                 candidates: int = 20, rrf_k: int = 60, max_workers: int = 8):
+        self.deadline = deadline
+        self.deadlines = dict(deadlines or {})
+        self.candidates = candidates
+        self.rrf_k = rrf_k
+        self.max_workers = max_workers
+        self._pools: Dict[str, ThreadPoolExecutor] = {}
+        self._stats: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def search(self, query: str, retrievers: Dict[str, Retriever], top_k: int = 5) -> Fused:
+        """Fused [(chunk_id, rrf score, {retriever: rank})] for the retrievers that met their deadline."""
+        started = time.perf_counter()
+        depth = max(top_k, self.candidates)
+        futures = {name: self._pool(name).submit(self._timed, fn, query, depth, started + self._deadline_for(name))
+                   for name, fn in retrievers.items()}
+        rankings = {}
+        outcomes = {}
+        # Wait for the earliest deadlines first; later ones keep running meanwhile
+        for name in sorted(futures, key=self._deadline_for):
+            remaining = self._deadline_for(name) - (time.perf_counter() - started)
+            done, _ = wait([futures[name]], timeout=max(0.0, remaining))
+            if not done:
+                # A call still queued behind earlier slow ones is dropped, not run late
+                futures[name].cancel()
+                outcomes[name] = ("timeout", self._deadline_for(name), 0)
+                continue
+            try:
+                ranking, elapsed = futures[name].result()
+            except TimeoutError:
+                outcomes[name] = ("timeout", self._deadline_for(name), 0)
+                continue
+            except Exception as e:
+                print(f"  {name} retriever failed: {e}")
+                outcomes[name] = ("error", time.perf_counter() - started, 0)
+                continue
+            rankings[name] = ranking
+            outcomes[name] = ("ok", elapsed, len(ranking))
+        # Fuse in the caller's retriever order so ties are deterministic
+        fused = reciprocal_rank_fusion({n: rankings[n] for n in retrievers if n in rankings},
+                                       k=self.rrf_k, top_k=top_k)
+        self._record(outcomes, fused)
+        return Fused(fused, [name for name in retrievers if name not in rankings],
+                     [name for name in retrievers if name in rankings])
+
+    def search_many(self, queries: List[str], retrievers: Dict[str, Callable], top_k: int = 5) -> List[Fused]:
+        """
+        search() for a batch. Retrievers take (queries, top_k) and return a
+        ranking per query; they still run concurrently, but a batch has no
+        deadline - it waits for every retriever that does not fail.
+        """
+        depth = max(top_k, self.candidates)
+        futures = {name: self._pool(name).submit(self._timed, fn, queries, depth) for name, fn in retrievers.items()}
+        rankings = {}
+        outcomes = {}
+        for name, future in futures.items():
+            try:
+                rankings[name], elapsed = future.result()
+                outcomes[name] = ("ok", elapsed, sum(len(r) for r in rankings[name]))
+            except Exception as e:
+                print(f"  {name} retriever failed: {e}")
+                outcomes[name] = ("error", 0.0, 0)
+        missing = [name for name in retrievers if name not in rankings]
+        fused = [
+            Fused(reciprocal_rank_fusion({name: ranking[i] for name, ranking in rankings.items()},
+                                         k=self.rrf_k, top_k=top_k), missing, list(rankings))
+            for i in range(len(queries))
+        ]
+        self._record(outcomes, [hit for hits in fused for hit in hits])
+        return fused
+
+    def _deadline_for(self, name: str) -> float:
+        return self.deadlines.get(name, self.deadline)
+
+    def _pool(self, name: str) -> ThreadPoolExecutor:
+        """The retriever's own threads, so a slow one only queues behind itself."""
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                pool = self._pools[name] = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                              thread_name_prefix=f"hybrid-{name}")
+            return pool
+
+    @staticmethod
+    def _timed(fn: Retriever, query: str, top_k: int, expires: Optional[float] = None):
+        started = time.perf_counter()
+        if expires is not None and started > expires:
+            # Picked up after the caller gave up on it
+            raise TimeoutError("deadline passed while queued")
+        ranking = fn(query, top_k)
+        return ranking, time.perf_counter() - started
+
+    def _record(self, outcomes: Dict[str, Tuple[str, float, int]], fused) -> None:
+        with self._lock:
+            for name, (status, elapsed, returned) in outcomes.items():
+                stats = self._stats.setdefault(name, {
+                    'calls': 0, 'ok': 0, 'timeouts': 0, 'errors': 0, 'total_ms': 0.0,
+                    'max_ms': 0.0, 'returned': 0, 'contributed': 0, 'sole_source': 0,
+                })
+                stats['calls'] += 1
+                stats[{'ok': 'ok', 'timeout': 'timeouts', 'error': 'errors'}[status]] += 1
+                if status == "ok":
+                    stats['total_ms'] += elapsed * 1000
+                    stats['max_ms'] = max(stats['max_ms'], elapsed * 1000)
+                    stats['returned'] += returned
+            # Contribution: fused results a retriever ranked, and ones only it found
+            for _, _, ranks in fused:
+                for name in ranks:
+                    self._stats[name]['contributed'] += 1
+                    if len(ranks) == 1:
+                        self._stats[name]['sole_source'] += 1
+
+    def stats(self) -> Dict[str, Dict]:
+        """Per-retriever counters with mean latency of successful calls."""
+        with self._lock:
+            return {
+                name: dict(s, total_ms=round(s['total_ms'], 2), max_ms=round(s['max_ms'], 2),
+                           mean_ms=round(s['total_ms'] / s['ok'], 2) if s['ok'] else 0.0,
+                           deadline_ms=round(self._deadline_for(name) * 1000, 1))
+                for name, s in self._stats.items()
+            }
@@ -0,0 +1,264 @@
+"""
+Admission control for upstream LLM calls.
+Every async model call takes a slot from one LLMScheduler first, so a
+traffic spike queues locally instead of turning into provider rate-limit
+errors:
+  - at most `max_concurrency` calls run at once
+  - a token bucket holds calls to `tokens_per_minute` (estimated up
+    front, corrected with the response's usage once it finishes)
+  - waiting calls are served strictly by class: answer (/rag) before
+    title (/title) before batch (/rag/batch)
+  - each class has a bounded queue and a maximum wait; a call that is
+    not expected to start in time is refused at once with Overloaded
+    (served as 429/503 with Retry-After) rather than left to time out
+
+The scheduler lives on the event loop; it has no locks and must only be
+used from coroutines.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Dict, Optional
+
+from metrics import REGISTRY
+
+PRIORITIES = ("answer", "title", "batch")  # Served in this order
+
+QUEUE_WAIT_SECONDS = REGISTRY.histogram(
+    "rag_llm_queue_wait_seconds", "Time LLM calls waited for admission, by class", ["priority"])
+SHED = REGISTRY.counter(
+    "rag_llm_shed_total", "LLM calls refused by admission control, by class and reason", ["priority", "reason"])
+
+
+class Overloaded(Exception):
+    """
+    A call could not be admitted in time. reason is queue_full, wait_exceeded
+    (expected to start later than the class's maximum wait), rate_limited
+    (token budget) or timeout; status is the HTTP status to answer with.
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"LLM admission refused ({reason}), retry after {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.status = 429 if reason == "rate_limited" else 503
+
+
+class _Slot:
+    """An admitted call. settle() replaces the token estimate with actual usage."""
+    __slots__ = ("scheduler", "tokens")
+
+    def __init__(self, scheduler: "LLMScheduler", tokens: int):
+        self.scheduler = scheduler
+        self.tokens = tokens
+
+    def settle(self, actual_tokens: Optional[int]) -> None:
+        if actual_tokens is not None and self.scheduler.tokens_per_minute:
+            self.scheduler._tokens += self.tokens - actual_tokens
+            self.tokens = actual_tokens
+
+
+class _Admission:
+    def __init__(self, scheduler: "LLMScheduler", priority: str, tokens: int, max_wait: Optional[float]):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.tokens = tokens
+        self.max_wait = max_wait
+        self.started = None
+
+    async def __aenter__(self) -> _Slot:
+        await self.scheduler._acquire(self.priority, self.tokens, self.max_wait)
+        self.started = time.monotonic()
+        self.scheduler._started[self] = self.started
+        return _Slot(self.scheduler, self.tokens)
+
+    async def __aexit__(self, *exc):
+        self.scheduler._release(time.monotonic() - self.started, self)
+        return False
+
+
+class LLMScheduler:
+    """
+    Args:
+        max_concurrency: calls in flight at once
+        tokens_per_minute: token budget (0 = unlimited); up to one minute's
+            worth may be spent in a burst
+        max_queue: waiting calls allowed per class
+        max_wait: seconds a call of each class may wait before it is shed
+    """
+
+    def __init__(self, max_concurrency: int = 16, tokens_per_minute: int = 0,
+                 max_queue: Optional[Dict[str, int]] = None, max_wait: Optional[Dict[str, float]] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = dict({"answer": 64, "title": 16, "batch": 256}, **(max_queue or {}))
+        self.max_wait = dict({"answer": 10.0, "title": 2.0, "batch": 60.0}, **(max_wait or {}))
+        self.running = 0
+        self.counters = {p: {'admitted': 0, 'queued': 0, 'shed': 0} for p in PRIORITIES}
+        self._tokens = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._queue = []  # (priority rank, seq, tokens, future)
+        self._waiting = {p: 0 for p in PRIORITIES}
+        self._seq = itertools.count()
+        self._timer = None
+        self._call_seconds = 1.0  # Moving average, for wait estimates
+        self._started: Dict[_Admission, float] = {}  # Calls in flight and when they started, for wait estimates
+
+    def admit(self, priority: str, tokens: int = 0, max_wait: Optional[float] = None) -> _Admission:
+        """
+        Async context manager holding a slot for one call:
+            async with scheduler.admit("answer", tokens) as slot:
+                response = await client.responses.create(...)
+                slot.settle(response.usage.total_tokens)
+        Raises Overloaded instead of waiting longer than max_wait
+        (default: the class's configured maximum).
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority!r}, expected one of {PRIORITIES}")
+        return _Admission(self, priority, tokens, max_wait)
+
+    async def _acquire(self, priority: str, tokens: int, max_wait: Optional[float]) -> None:
+        queued_at = time.monotonic()
+        self._refill()
+        if not self._queue and self.running < self.max_concurrency and self._has_tokens(tokens):
+            self._grant(priority, tokens)
+            QUEUE_WAIT_SECONDS.observe(0.0, priority=priority)
+            return
+
+        max_wait = self.max_wait[priority] if max_wait is None else max_wait
+        if self._waiting[priority] >= self.max_queue[priority]:
+            self._shed(priority, "queue_full", self._estimate_wait(priority, tokens))
+        estimate = self._estimate_wait(priority, tokens)
+        if estimate > max_wait:
+            token_wait = self._token_wait(priority, tokens)
+            self._shed(priority, "rate_limited" if token_wait >= estimate else "wait_exceeded", estimate)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (PRIORITIES.index(priority), next(self._seq), tokens, future)
+        heapq.heappush(self._queue, entry)
+        self._waiting[priority] += 1
+        self.counters[priority]['queued'] += 1
+        try:
+            self._dispatch()
+            await asyncio.wait_for(future, max_wait)
+        except asyncio.TimeoutError:
+            self._shed(priority, "timeout", self._estimate_wait(priority, tokens))
+        except BaseException:
+            if future.done() and not future.cancelled():
+                self._release()  # Admitted just as the caller went away
+            raise
+        finally:
+            self._waiting[priority] -= 1
+            if entry in self._queue:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - queued_at, priority=priority)
+
+    def _grant(self, priority: str, tokens: int) -> None:
+        self.running += 1
+        if self.tokens_per_minute:
+            self._tokens -= tokens
+        self.counters[priority]['admitted'] += 1
+
+    def _release(self, seconds: Optional[float] = None, admission: Optional[_Admission] = None) -> None:
+        self.running -= 1
+        self._started.pop(admission, None)
+        if seconds is not None:
+            self._call_seconds = 0.8 * self._call_seconds + 0.2 * seconds
+        self._dispatch()
+
+    def _shed(self, priority: str, reason: str, retry_after: float) -> None:
+        self.counters[priority]['shed'] += 1
+        SHED.inc(priority=priority, reason=reason)
+        raise Overloaded(reason, retry_after)
+
+    def _dispatch(self) -> None:
+        """Admit waiting calls in class order while slots and tokens allow."""
+        self._refill()
+        while self._queue and self.running < self.max_concurrency:
+            rank, _, tokens, future = self._queue[0]
+            if future.done():  # Timed out or cancelled meanwhile
+                heapq.heappop(self._queue)
+                continue
+            if not self._has_tokens(tokens):
+                # The head waits for the bucket; later classes do not overtake it
+                self._schedule_dispatch((min(tokens, self.tokens_per_minute) - self._tokens) / self._rate)
+                break
+            heapq.heappop(self._queue)
+            self._grant(PRIORITIES[rank], tokens)
+            future.set_result(None)
+
+    def _schedule_dispatch(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(max(0.001, delay), self._dispatch)
+
+    @property
+    def _rate(self) -> float:
+        return self.tokens_per_minute / 60.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self.tokens_per_minute:
+            self._tokens = min(float(self.tokens_per_minute), self._tokens + (now - self._refilled_at) * self._rate)
+        self._refilled_at = now
+
+    def _has_tokens(self, tokens: int) -> bool:
+        # A call larger than the whole budget runs once the bucket is full
+        return not self.tokens_per_minute or self._tokens >= min(tokens, self.tokens_per_minute)
+
+    def _ahead(self, priority: str):
+        rank = PRIORITIES.index(priority)
+        return [e for e in self._queue if e[0] <= rank and not e[3].done()]
+
+    def _token_wait(self, priority: str, tokens: int) -> float:
+        if not self.tokens_per_minute:
+            return 0.0
+        needed = sum(e[2] for e in self._ahead(priority)) + min(tokens, self.tokens_per_minute)
+        return max(0.0, (needed - self._tokens) / self._rate)
+
+    def _slot_wait(self, ahead: int) -> float:
+        """
+        Seconds until a slot is free for the call behind `ahead` queued ones:
+        running calls free their slot once they have run an average call's
+        time (or soon, when already overdue), and each queued call then
+        holds the slot it takes for an average call.
+        """
+        now = time.monotonic()
+        free = [max(0.0, self._call_seconds - (now - started)) for started in self._started.values()]
+        free += [self._call_seconds] * max(0, self.running - len(free))  # Admitted, not yet started
+        free += [0.0] * max(0, self.max_concurrency - len(free))
+        heapq.heapify(free)
+        for _ in range(ahead):
+            heapq.heapreplace(free, free[0] + self._call_seconds)
+        return free[0]
+
+    def _estimate_wait(self, priority: str, tokens: int) -> float:
+        """Seconds until a new call of this class would start, from the calls running and queued ahead of it."""
+        return max(self._slot_wait(len(self._ahead(priority))), self._token_wait(priority, tokens))
+
+    def stats(self) -> Dict:
+        self._refill()
+        return {
+            'running': self.running,
+            'max_concurrency': self.max_concurrency,
+            'queued': dict(self._waiting),
+            'tokens_available': round(self._tokens) if self.tokens_per_minute else None,
+            'tokens_per_minute': self.tokens_per_minute,
+            'avg_call_seconds': round(self._call_seconds, 3),
+            'classes': {p: dict(c) for p, c in self.counters.items()},
+        }
+
+    def collect(self):
+        """Queue depth, calls in flight and token budget for /metrics."""
+        stats = self.stats()
+        yield ("rag_llm_queue_depth", "gauge", "LLM calls waiting for admission, by class",
+               [({"priority": p}, n) for p, n in stats['queued'].items()])
+        yield ("rag_llm_in_flight", "gauge", "LLM calls running", [({}, stats['running'])])
+        if self.tokens_per_minute:
+            yield ("rag_llm_tokens_available", "gauge", "Tokens left in the per-minute budget",
+                   [({}, stats['tokens_available'])])
+        yield ("rag_llm_admitted_total", "counter", "LLM calls admitted, by class",
+               [({"priority": p}, c['admitted']) for p, c in stats['classes'].items()])
@@ -0,0 +1,114 @@
+"""
+Load test for the /rag request path.
+Starts mock_llm_server with artificial latency, then fires concurrent
+/rag requests at two in-process copies of the API:
+  blocking - the old handler shape (sync generate_answer inside async def)
+  async    - main.app (async OpenAI client + retrieval pool)
+and reports throughput and latency percentiles for each.
+
+    python load_test.py --requests 40 --concurrency 20 --latency 1.0
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+# Configure the OpenAI clients before rag.py creates them
+os.environ.setdefault("OPENAI_API_KEY", "mock")
+os.environ["DROPBOX_ACCESS_TOKEN"] = ""  # stub documents, no Dropbox traffic
+os.environ["RAG_SNAPSHOT_PATH"] = ""
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run_load(app, n_requests: int, concurrency: int, path: str = "/rag", queries=None):
+    """Fire n_requests POSTs, `concurrency` at a time; queries cycle through `queries` if given."""
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(client, i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            query = queries[i % len(queries)] if queries else f"How do I connect to RIT Wi-Fi? #{i}"
+            r = await client.post(path, json={"query": query})
+            latencies.append(time.perf_counter() - started)
+            if r.status_code != 200:
+                errors += 1
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=300) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(one(client, i) for i in range(n_requests)))
+        wall = time.perf_counter() - started
+
+    return {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(n_requests / wall, 2),
+        "p50_s": round(percentile(latencies, 50), 3),
+        "p99_s": round(percentile(latencies, 99), 3),
+        "mean_s": round(statistics.mean(latencies), 3),
+    }
+
+
+def blocking_app():
+    """The pre-async handler: a sync OpenAI call made directly on the event loop."""
+    from fastapi import FastAPI, Request
+    from rag import generate_answer
+
+    app = FastAPI()
+
+    @app.post("/rag")
+    async def rag_endpoint(request: Request):
+        data = await request.json()
+        result = generate_answer(data.get("query", ""))
+        return {"answer": result["text"], "citations": result.get("citations", [])}
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=1.0, help="mock LLM latency in seconds")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args(argv)
+
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{args.port}/v1"
+    from mock_llm_server import serve_in_background
+    server = serve_in_background(args.port, args.latency)
+
+    import main as api
+    results = {"mock_latency_s": args.latency}
+    for name, app in (("blocking", blocking_app()), ("async", api.app)):
+        print(f" Running {args.requests} requests against the {name} handler...")
+        results[name] = asyncio.run(run_load(app, args.requests, args.concurrency))
+        print(f"   {json.dumps(results[name])}")
+    server.should_exit = True
+
+    speedup = results["async"]["throughput_rps"] / max(results["blocking"]["throughput_rps"], 1e-9)
+    results["speedup"] = round(speedup, 2)
+    print(f" Async throughput is {speedup:.1f}x the blocking handler")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,245 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
-from rag import generate_answer, generate_title
+from llm_scheduler import Overloaded
+from metrics import REGISTRY
+from rag import (
+    BATCH_CONCURRENCY, answer_turn_async, cache_stats, generate_answer_async, generate_answers_batch,
+    generate_title_async, stream_answer,
+)
 import traceback
 
 # Auto-load environment variables from server/python/.env if present
 load_dotenv()
 
-app = FastAPI()
+# While the corpus loads, "degrade" answers without Dropbox context and
+# "reject" returns 503 with Retry-After from the answer endpoints
+WHILE_LOADING = os.getenv("RAG_WHILE_LOADING", "degrade").lower()
+RETRY_AFTER_SECONDS = int(os.getenv("RAG_RETRY_AFTER", "5"))
+STARTED_AT = time.time()
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the corpus in the background so the first user doesn't pay for it
+    if os.getenv("RAG_WARMUP", "true").lower() in ("1", "true", "yes"):
+        from dropbox_rag import start_warmup
+        start_warmup()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+HTTP_REQUESTS = REGISTRY.counter("rag_http_requests_total", "HTTP requests by route and status", ["route", "status"])
+HTTP_SECONDS = REGISTRY.histogram("rag_http_request_seconds", "Time until response headers, by route", ["route"])
+ERRORS = REGISTRY.counter("rag_errors_total", "Failed answers and titles by endpoint and error", ["endpoint", "error"])
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Label by route template, not raw path, so unknown URLs don't add series
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    HTTP_SECONDS.observe(time.perf_counter() - started, route=route)
+    HTTP_REQUESTS.inc(route=route, status=response.status_code)
+    return response
+
+
+def _warming_up_response():
+    """503 while the corpus loads, when RAG_WHILE_LOADING=reject; None otherwise."""
+    if WHILE_LOADING != "reject":
+        return None
+    from dropbox_rag import get_ready_dropbox_rag, warmup_status
+    if get_ready_dropbox_rag() is not None:
+        return None
+    status = warmup_status()
+    return JSONResponse(status_code=503, headers={"Retry-After": str(RETRY_AFTER_SECONDS)},
+                        content={"error": "warming_up", "progress": status["progress"]})
+
+def _overloaded_response(endpoint: str, e: Overloaded):
+    """429 (token budget) or 503 (queue) with Retry-After when admission control sheds a call."""
+    print(f"⏳ {endpoint} shed by LLM admission control ({e.reason})")
+    ERRORS.inc(endpoint=endpoint, error="overloaded")
+    return JSONResponse(status_code=e.status, headers={"Retry-After": str(e.retry_after)},
+                        content={"error": "overloaded", "reason": e.reason, "retry_after": e.retry_after})
+
+async def _json_object(request: Request):
+    """The request body as a dict, or None when it is not a JSON object (answer 400)."""
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+def _bad_body_response(error: str = "body must be a JSON object"):
+    return JSONResponse(status_code=400, content={"error": error})
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and serving, whether or not the corpus is loaded."""
+    return {"status": "ok", "uptime_s": round(time.time() - STARTED_AT, 1)}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: 200 once the corpus is loaded, 503 with load progress until then."""
+    from dropbox_rag import warmup_status
+    status = warmup_status()
+    return JSONResponse(status_code=200 if status["ready"] else 503, content=status)
+
 @app.post("/rag")
 async def rag_endpoint(request: Request):
+    rejected = _warming_up_response()
+    if rejected is not None:
+        return rejected
     try: 
         data = await request.json()
         query = data.get("query", "")
-        result = generate_answer(query)
-        return {"answer": result["text"], "citations": result.get("citations", [])}
+        conversation_id, history = data.get("conversation_id"), data.get("history")
+        if history is not None and not (isinstance(history, list) and all(isinstance(m, dict) for m in history)):
+            return JSONResponse(status_code=400, content={"error": "history must be a list of messages"})
+        if "conversation_id" not in data and not history:
+            result = await generate_answer_async(query)
+            return {"answer": result["text"], "citations": result.get("citations", [])}
+        # A conversation turn (conversation_id null starts one): chained to the
+        # previous one, see rag.answer_turn_async()
+        result = await answer_turn_async(query, conversation_id and str(conversation_id), history)
+        return {"answer": result["text"], "citations": result.get("citations", []),
+                "conversation_id": result["conversation_id"], "usage": result["usage"]}
+    except Overloaded as e:
+        return _overloaded_response("/rag", e)
+    except asyncio.TimeoutError:
+        print("❌ /rag timed out waiting for the model")
+        ERRORS.inc(endpoint="/rag", error="upstream_timeout")
+        return JSONResponse(status_code=504, content={"error": "upstream_timeout"})
     except Exception as e:
         # Print full traceback to your server console to diagnose quickly
         traceback.print_exc()
+        ERRORS.inc(endpoint="/rag", error="internal_error")
         return JSONResponse(
             status_code=500,
             content={"error": "internal_error", "detail": str(e)},
         )
 
+def _sse(event: str, payload) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+async def _rag_event_stream(query: str):
+    """SSE framing for stream_answer(): delta*, citations, done (or error)."""
+    try:
+        async for event, payload in stream_answer(query):
+            if event == "delta":
+                yield _sse("delta", {"text": payload})
+            else:
+                yield _sse("citations", {"citations": payload})
+        yield _sse("done", {})
+    except Overloaded as e:
+        ERRORS.inc(endpoint="/rag/stream", error="overloaded")
+        yield _sse("error", {"error": "overloaded", "reason": e.reason, "retry_after": e.retry_after})
+    except asyncio.TimeoutError:
+        print("❌ /rag/stream timed out waiting for the model")
+        ERRORS.inc(endpoint="/rag/stream", error="upstream_timeout")
+        yield _sse("error", {"error": "upstream_timeout"})
+    except Exception as e:
+        traceback.print_exc()
+        ERRORS.inc(endpoint="/rag/stream", error="internal_error")
+        yield _sse("error", {"error": "internal_error", "detail": str(e)})
+
+@app.post("/rag/stream")
+async def rag_stream_endpoint(request: Request):
+    """
+    Streaming /rag over Server-Sent Events.
+    Body: {"query": "..."}. Events: `delta` {"text"} as the answer is
+    generated, then `citations` {"citations": [...]}, then `done`.
+    """
+    rejected = _warming_up_response()
+    if rejected is not None:
+        return rejected
+    data = await _json_object(request)
+    if data is None:
+        return _bad_body_response()
+    if not isinstance(data.get("query", ""), str):
+        return _bad_body_response("query must be a string")
+    return StreamingResponse(
+        _rag_event_stream(data.get("query", "")),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/rag/stream")
+async def rag_stream_get_endpoint(query: str = ""):
+    """Same as POST /rag/stream, for EventSource clients (?query=...)."""
+    rejected = _warming_up_response()
+    if rejected is not None:
+        return rejected
+    return StreamingResponse(
+        _rag_event_stream(query),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+MAX_BATCH_CONCURRENCY = 32
+MAX_BATCH_QUERIES = int(os.getenv("RAG_BATCH_MAX_QUERIES", "1000"))
+
+async def _rag_batch_lines(queries, concurrency: int):
+    """NDJSON framing for generate_answers_batch(): one line per query as it completes."""
+    async for index, result in generate_answers_batch(queries, concurrency):
+        line = {"index": index, "query": queries[index]}
+        if isinstance(result, Overloaded):
+            line.update(error="overloaded", retry_after=result.retry_after)
+        elif isinstance(result, asyncio.TimeoutError):
+            line["error"] = "upstream_timeout"
+        elif isinstance(result, Exception):
+            line.update(error="internal_error", detail=str(result))
+        if "error" in line:
+            ERRORS.inc(endpoint="/rag/batch", error=line["error"])
+        else:
+            line.update(answer=result["text"], citations=result.get("citations", []))
+        yield json.dumps(line) + "\n"
+
+@app.post("/rag/batch")
+async def rag_batch_endpoint(request: Request):
+    """
+    Answer many queries in one request.
+    Body: {"queries": ["...", ...], "concurrency": 8}. Streams NDJSON, one
+    {"index", "query", "answer", "citations"} (or "error") line per query,
+    in completion order.
+    """
+    rejected = _warming_up_response()
+    if rejected is not None:
+        return rejected
+    data = await _json_object(request)
+    if data is None:
+        return _bad_body_response()
+    queries = data.get("queries")
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return JSONResponse(status_code=400, content={"error": "queries must be a list of strings"})
+    if len(queries) > MAX_BATCH_QUERIES:
+        return JSONResponse(status_code=400, content={"error": f"at most {MAX_BATCH_QUERIES} queries per batch"})
+    concurrency = data.get("concurrency")
+    if concurrency is None:
+        concurrency = BATCH_CONCURRENCY
+    elif isinstance(concurrency, bool) or not isinstance(concurrency, int) or concurrency < 1:
+        return JSONResponse(status_code=400, content={"error": "concurrency must be a positive integer"})
+    concurrency = min(concurrency, MAX_BATCH_CONCURRENCY)
+    print(f"📦 Batch of {len(queries)} queries (concurrency {concurrency})")
+    return StreamingResponse(_rag_batch_lines(queries, concurrency), media_type="application/x-ndjson")
+
+@app.get("/cache/stats")
+async def cache_stats_endpoint():
+    """Answer cache counters: hit rates and semantic similarity histogram."""
+    return cache_stats()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus scrape: per-stage latency histograms, corpus size, cache and error counters."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 @app.post("/title")
 async def title_endpoint(request: Request):
     try:
@@ -32,12 +247,19 @@ async def title_endpoint(request: Request):
         # Expect: {"messages": [{role:'User'|'RAG'|'System', text:'...'}, ...]}
         msgs = data.get("messages", []) or []
         print(f"📝 Generating title for {len(msgs)} messages")
-        title = generate_title(msgs)
+        title = await generate_title_async(msgs)
         print(f"✅ Generated title: {title}")
         return {"title": title}
+    except Overloaded as e:
+        return _overloaded_response("/title", e)
+    except asyncio.TimeoutError:
+        print("❌ Title generation timed out")
+        ERRORS.inc(endpoint="/title", error="upstream_timeout")
+        return JSONResponse(status_code=504, content={"error": "upstream_timeout"})
     except Exception as e:
         print(f"❌ Title generation error: {e}")
         traceback.print_exc()
+        ERRORS.inc(endpoint="/title", error="internal_error")
         return JSONResponse(status_code=500, content={"error": "internal_error", "detail": str(e)})
 
 # Start with:
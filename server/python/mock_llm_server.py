@@ -0,0 +1,110 @@
+"""
+Mock OpenAI Responses API server for load tests.
+Answers POST /v1/responses after an artificial delay with a canned
+HTML answer and Sources block, so the backend can be exercised without
+network access or API spend. With "stream": true the latency is spent
+before the first token and the answer arrives as SSE text deltas.
+
+Run standalone:
+    MOCK_LLM_LATENCY=1.5 uvicorn mock_llm_server:app --port 8100
+then point the backend at it:
+    OPENAI_BASE_URL=http://127.0.0.1:8100/v1 OPENAI_API_KEY=mock uvicorn main:app
+"""
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+app = FastAPI()
+app.state.latency = float(os.getenv("MOCK_LLM_LATENCY", "1.0"))
+app.state.requests = 0
+app.state.last_request = None  # Body of the latest call, for tests
+
+_ids = itertools.count(1)
+
+CANNED_ANSWER = (
+    "<p>To connect to <strong>RIT Wi-Fi</strong>, join the <code>eduroam</code> network "
+    "and sign in with your RIT username and password.</p>\n"
+    "<ol>\n  <li>Open Wi-Fi settings</li>\n  <li>Choose eduroam</li>\n</ol>\n\n"
+    "Sources:\n"
+    "RIT Wi-Fi Setup — https://help.rit.edu/sp?id=kb_article_view&sysparm_article=KB0040936\n"
+)
+
+
+def _response_body(text: str, body: dict) -> dict:
+    n = next(_ids)
+    prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("input", []) if isinstance(m, dict))
+    return {
+        "id": f"resp_mock_{n}",
+        "object": "response",
+        "created_at": int(time.time()),
+        "model": body.get("model", "gpt-5"),
+        "status": "completed",
+        "output": [{
+            "type": "message",
+            "id": f"msg_mock_{n}",
+            "status": "completed",
+            "role": "assistant",
+            "content": [{"type": "output_text", "text": text, "annotations": []}],
+        }],
+        "parallel_tool_calls": True,
+        "tool_choice": "auto",
+        "tools": body.get("tools", []),
+        "usage": {
+            "input_tokens": prompt_chars // 4,
+            "input_tokens_details": {"cached_tokens": 0},
+            "output_tokens": len(text) // 4,
+            "output_tokens_details": {"reasoning_tokens": 0},
+            "total_tokens": (prompt_chars + len(text)) // 4,
+        },
+    }
+
+
+@app.post("/v1/responses")
+async def responses(request: Request):
+    body = await request.json()
+    app.state.requests += 1
+    app.state.last_request = body
+    await asyncio.sleep(app.state.latency)
+    if body.get("stream"):
+        return StreamingResponse(_stream_events(CANNED_ANSWER, body), media_type="text/event-stream")
+    return _response_body(CANNED_ANSWER, body)
+
+
+async def _stream_events(text: str, body: dict, piece: int = 12):
+    final = _response_body(text, body)
+    seq = itertools.count()
+
+    def event(payload):
+        payload["sequence_number"] = next(seq)
+        return f"event: {payload['type']}\ndata: {json.dumps(payload)}\n\n"
+
+    yield event({"type": "response.created", "response": dict(final, status="in_progress", output=[])})
+    for i in range(0, len(text), piece):
+        yield event({
+            "type": "response.output_text.delta",
+            "item_id": final["output"][0]["id"],
+            "output_index": 0,
+            "content_index": 0,
+            "delta": text[i:i + piece],
+            "logprobs": [],
+        })
+        await asyncio.sleep(0.005)
+    yield event({"type": "response.completed", "response": final})
+
+
+def serve_in_background(port: int, latency: float):
+    """Start the mock on 127.0.0.1:port in a daemon thread; returns the uvicorn server."""
+    import uvicorn
+
+    app.state.latency = latency
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="mock-llm", daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server
@@ -1,10 +1,60 @@
 # rag.py
+import asyncio
+import hashlib
+import json
 import os
 import re
-from typing import List, Dict, Tuple
-from openai import OpenAI
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
+from openai import AsyncOpenAI, BadRequestError, NotFoundError, OpenAI
+from answer_cache import create_answer_cache, normalize_query
+from context_packing import ContextPacker, count_tokens
+from conversations import ConversationStore
+from llm_scheduler import LLMScheduler
+from routing import RouteDecision, WebSearchRouter, local_citations, parse_min_scores
+from semantic_cache import create_semantic_cache
+from single_flight import SingleFlight
+from titles import TitleCache, TitleStats, extract_title, keywords
+from metrics import REGISTRY
 
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+# --- Per-stage latency (served on /metrics, see metrics.py) ---
+STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_seconds", "Time spent in each stage of answering a request", ["stage"])
+
+# --- Async request path settings ---
+LLM_TIMEOUT = float(os.getenv("RAG_LLM_TIMEOUT", "90"))            # seconds per OpenAI call
+RETRIEVAL_TIMEOUT = float(os.getenv("RAG_RETRIEVAL_TIMEOUT", "5"))  # seconds per retrieval
+# Retrieval is CPU-bound Python; run it off the event loop on a small pool
+retrieval_pool = ThreadPoolExecutor(
+    max_workers=int(os.getenv("RAG_RETRIEVAL_WORKERS", "4")), thread_name_prefix="retrieval"
+)
+
+# --- Admission control for model calls (see llm_scheduler.py) ---
+# Answers go before titles, titles before batch answers; calls that cannot
+# start within their class's wait limit fail fast with Overloaded
+llm_scheduler = LLMScheduler(
+    max_concurrency=int(os.getenv("RAG_LLM_CONCURRENCY", "16")),
+    tokens_per_minute=int(os.getenv("RAG_LLM_TPM", "0")),
+    max_queue={"answer": int(os.getenv("RAG_LLM_QUEUE", "64")),
+               "title": int(os.getenv("RAG_LLM_TITLE_QUEUE", "16")),
+               "batch": int(os.getenv("RAG_LLM_BATCH_QUEUE", "256"))},
+    max_wait={"answer": float(os.getenv("RAG_LLM_MAX_WAIT", "10")),
+              "title": float(os.getenv("RAG_LLM_TITLE_MAX_WAIT", "2")),
+              "batch": float(os.getenv("RAG_LLM_BATCH_MAX_WAIT", "60"))},
+)
+ANSWER_OUTPUT_TOKENS = int(os.getenv("RAG_LLM_ANSWER_OUTPUT_TOKENS", "1500"))  # Budgeted until usage is known
+TITLE_OUTPUT_TOKENS = 50
+
+def _request_tokens(request: Dict, output_tokens: int) -> int:
+    """Token estimate for a responses.create() call: its input plus an output allowance."""
+    return sum(count_tokens(m["content"]) for m in request["input"]) + output_tokens
+
+def _usage_tokens(response) -> Optional[int]:
+    return getattr(getattr(response, "usage", None), "total_tokens", None)
 
 # --- Central place to define allowed help domains ---
 ALLOWED_HELP_DOMAINS = [
@@ -48,6 +98,80 @@ def strip_inline_links(text: str) -> str:
     text = BARE_URL.sub("", text)    # remove bare URLs
     return " ".join(text.split())
 
+# Incremental counterparts of the helpers above, for streamed answers
+SOURCES_START = re.compile(r"(?i)\n+sources\s*:")
+SOURCES_PREFIX = re.compile(r"(?i)\n+(s(o(u(r(c(e(s\s*)?)?)?)?)?)?)?$")  # could still become "\nSources:"
+LINK_PREFIX = re.compile(r"\[[^\]]*(\](\([^\s)]*)?)?$")  # could still become a [title](url) link
+MAX_HOLDBACK = 2000  # chars held while waiting for a link to close
+
+class AnswerStreamParser:
+    """
+    Streaming version of parse_sources_block() + strip_inline_links().
+    feed() each text delta and emit what it returns; the text is held
+    back only while it could still turn into a link, a URL or the start
+    of the 'Sources:' block. finish() returns the last piece of body
+    text and the parsed citations. The concatenated output equals
+    strip_inline_links(parse_sources_block(full_text)[0]).
+    """
+
+    def __init__(self):
+        self._pending = ""        # body text not emitted yet
+        self._sources = None      # raw text from "\nSources:" on, once seen
+        self._space = False       # whitespace seen after the last emitted word
+        self._emitted = False
+
+    def feed(self, delta: str) -> str:
+        if self._sources is not None:
+            self._sources += delta
+            return ""
+        self._pending += delta
+        m = SOURCES_START.search(self._pending)
+        if m:
+            self._sources = self._pending[m.start():]
+            body, self._pending = self._pending[:m.start()], ""
+            return self._clean(body)
+
+        cut = len(self._pending)
+        prefix = SOURCES_PREFIX.search(self._pending)
+        if prefix:
+            cut = prefix.start()
+        # Hold the trailing word: it may be a URL that is still arriving
+        word = len(self._pending[:cut]) - len(self._pending[:cut].rstrip())
+        if word == 0:
+            cut = max(self._pending.rfind(" ", 0, cut), self._pending.rfind("\n", 0, cut), 0)
+        # Hold an unfinished [title](url) link, whatever its title contains,
+        # and never cut inside a finished one
+        link = LINK_PREFIX.search(self._pending)
+        if link and link.start() < cut and len(self._pending) - link.start() < MAX_HOLDBACK:
+            cut = link.start()
+        for link in MD_LINK.finditer(self._pending):
+            if link.start() < cut < link.end():
+                cut = link.start()
+                break
+
+        ready, self._pending = self._pending[:cut], self._pending[cut:]
+        return self._clean(ready)
+
+    def finish(self) -> Tuple[str, List[Dict[str, str]]]:
+        """Flush the remaining body text and parse the Sources block."""
+        body, citations = parse_sources_block(self._pending + (self._sources or ""))
+        self._pending = ""
+        # A space pending from the last delta still separates it from the tail
+        return self._clean(body), citations
+
+    def _clean(self, text: str) -> str:
+        if not text:
+            return ""
+        text = BARE_URL.sub("", MD_LINK.sub(r"\1", text))
+        words = text.split()
+        if not words:
+            self._space = self._space or bool(text)
+            return ""
+        lead = " " if self._emitted and (self._space or text[0].isspace()) else ""
+        self._space = text[-1].isspace()
+        self._emitted = True
+        return lead + " ".join(words)
+
 def parse_sources_block(ans: str) -> Tuple[str, List[Dict[str, str]]]:
     """
     Extract a 'Sources:' section from the end of ans, return (body_without_sources, citations[]).
@@ -89,133 +213,641 @@ def parse_sources_block(ans: str) -> Tuple[str, List[Dict[str, str]]]:
     body = ans[:m.start()].rstrip()
     return body, citations
 
-def retrieve_docs(query: str):
+def _stub_hit(text: str, degraded: bool = False) -> Dict:
+    """Placeholder context; degraded ones (loading, timeout, error) keep the answer out of the caches."""
+    return {'text': text, 'path': None, 'name': None, 'chunk_id': None, 'score': 0.0, 'degraded': degraded}
+
+def retrieve(query: str, mode: Optional[str] = None) -> List[Dict]:
+    """
+    Retrieve ranked Dropbox chunks for the given query as hit dicts
+    ({'text', 'path', 'name', 'chunk_id', 'score'}).
+    mode: 'keyword', 'vector' or 'hybrid'; defaults to RAG_RETRIEVAL_MODE.
+    Falls back to stub documents (path None) if Dropbox is not configured,
+    and answers without Dropbox context while the corpus is still loading.
     """
-    Retrieve relevant documents from Dropbox for the given query.
+    with STAGE_SECONDS.time(stage="retrieve"):
+        try:
+            from dropbox_rag import LOADING, NO_RESULTS, STUB_DOCUMENTS, get_ready_dropbox_rag
+            dropbox_rag = get_ready_dropbox_rag()
+            if dropbox_rag is None:
+                print("  Corpus still loading, answering without Dropbox context")
+                return [_stub_hit(LOADING, degraded=True)]
+            if not dropbox_rag.corpus.documents:
+                print("  No documents loaded, using stub documents")
+                return [_stub_hit(text) for text in STUB_DOCUMENTS]
+            hits = dropbox_rag.search(query, max_results=5, mode=mode)
+            if not hits:
+                print(f"  No relevant documents found for query: {query}")
+                # Not cached when a hybrid retriever was left out (timeout or error)
+                return [_stub_hit(NO_RESULTS, degraded=bool(getattr(hits, 'missing', ())))]
+            print(f" Found {len(hits)} relevant document chunks")
+            return hits
+        except Exception as e:
+            print(f"  Error retrieving from Dropbox: {e}")
+            print("   Falling back to stub documents")
+            return [_stub_hit("Document 1: Placeholder content", degraded=True),
+                    _stub_hit("Document 2: Placeholder content", degraded=True)]
+
+def retrieve_many(queries: List[str], mode: Optional[str] = None) -> List[List[Dict]]:
+    """retrieve() for a batch of queries in one pass over the index (DropboxRAG.search_many)."""
+    with STAGE_SECONDS.time(stage="retrieve_batch"):
+        try:
+            from dropbox_rag import LOADING, NO_RESULTS, STUB_DOCUMENTS, get_ready_dropbox_rag
+            dropbox_rag = get_ready_dropbox_rag()
+            if dropbox_rag is None:
+                print("  Corpus still loading, answering without Dropbox context")
+                return [[_stub_hit(LOADING, degraded=True)] for _ in queries]
+            if not dropbox_rag.corpus.documents:
+                print("  No documents loaded, using stub documents")
+                return [[_stub_hit(text) for text in STUB_DOCUMENTS] for _ in queries]
+            results = dropbox_rag.search_many(queries, max_results=5, mode=mode)
+            print(f" Retrieved for {len(queries)} queries, {sum(1 for hits in results if hits)} with matches")
+            return [hits or [_stub_hit(NO_RESULTS, degraded=bool(getattr(hits, 'missing', ())))]
+                    for hits in results]
+        except Exception as e:
+            print(f"  Error retrieving from Dropbox: {e}")
+            print("   Falling back to stub documents")
+            return [[_stub_hit("Document 1: Placeholder content", degraded=True),
+                     _stub_hit("Document 2: Placeholder content", degraded=True)] for _ in queries]
+
+def hits_to_docs(hits: List[Dict]) -> List[str]:
+    """Context strings for the prompt, '[From name]' headed for Dropbox chunks."""
+    return [f"[From {hit['name']}]\n{hit['text']}" if hit['name'] else hit['text'] for hit in hits]
+
+# --- Context assembly (see context_packing.py) ---
+context_packer = ContextPacker(
+    budget=int(os.getenv("RAG_CONTEXT_TOKENS", "3000")),
+    duplicate_threshold=float(os.getenv("RAG_CONTEXT_DEDUP_THRESHOLD", "0.8")),
+    render=lambda hit: hits_to_docs([hit])[0],
+)
+
+def pack_hits(hits: List[Dict]) -> List[Dict]:
+    """Dedupe, merge and budget retrieved hits before they go into the prompt."""
+    with STAGE_SECONDS.time(stage="context"):
+        packed, report = context_packer.pack(hits)
+    print(f" Context: {report['tokens_out']} tokens, {report['tokens_saved']} saved "
+          f"({report['duplicates']} duplicate, {report['merged']} merged, {report['over_budget']} over budget)")
+    return packed
+
+def retrieve_docs(query: str, mode: Optional[str] = None):
+    """
+    Retrieve relevant documents from Dropbox for the given query, packed
+    into the context token budget (RAG_CONTEXT_TOKENS).
+    mode selects keyword (BM25), vector or hybrid search, see retrieve().
     Falls back to stub documents if Dropbox is not configured.
     """
+    return hits_to_docs(pack_hits(retrieve(query, mode)))
+
+async def retrieve_async(query: str) -> List[Dict]:
+    """
+    retrieve() on the retrieval pool, bounded by RAG_RETRIEVAL_TIMEOUT.
+    A slow retrieval degrades to an answer without local context.
+    """
+    loop = asyncio.get_running_loop()
     try:
-        from dropbox_rag import get_dropbox_rag
-        dropbox_rag = get_dropbox_rag()
-        return dropbox_rag.search_documents(query, max_results=5)
-    except Exception as e:
-        print(f"  Error retrieving from Dropbox: {e}")
-        print("   Falling back to stub documents")
-        return ["Document 1: Placeholder content", "Document 2: Placeholder content"]
+        return await asyncio.wait_for(
+            loop.run_in_executor(retrieval_pool, retrieve, query), RETRIEVAL_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        print(f"  Retrieval timed out after {RETRIEVAL_TIMEOUT}s, answering without Dropbox context")
+        return [_stub_hit("No Dropbox documents available for this query.", degraded=True)]
 
-def generate_answer(query: str):
-    docs = retrieve_docs(query)
-    context = "\n".join(docs)
+async def retrieve_docs_async(query: str):
+    """Async retrieve_docs(); see retrieve_async()."""
+    return hits_to_docs(pack_hits(await retrieve_async(query)))
 
-    # Updated system message to explain domain restrictions and formatting
-    system_msg = (
-        "You are a helpful assistant with web_search access.\n"
-        "When the answer involves public or recent facts, USE web_search.\n"
-        "Your web_search tool is restricted to:\n"
-        "• Rochester Institute of Technology sites (rit.edu)\n"
-        "• Slack help\n"
-        "• Microsoft / Office help\n"
-        "• Google help / Workspace docs\n"
-        "• Adobe help\n"
-        "• A few general technical help sites (e.g., Stack Overflow)\n"
-        "Prefer RIT pages when answering RIT-specific questions.\n\n"
-        "FORMATTING GUIDELINES - Use HTML for maximum readability:\n\n"
-        "1. **Structure Your Response:**\n"
-        "   - Start with a brief overview (1-2 sentences in a <p> tag)\n"
-        "   - Break complex answers into clear sections with headings\n"
-        "   - Use <br> or separate <p> tags for spacing between sections\n\n"
-        "2. **Headings:** Use <h2> for main sections and <h3> for subsections\n"
-        "   Example:\n"
-        "   <h2>How to Connect</h2>\n"
-        "   <h3>On iOS Devices</h3>\n\n"
-        "3. **Emphasis:**\n"
-        "   - Use <strong> or <b> for important terms, names, and key concepts\n"
-        "   - Use <em> or <i> for secondary emphasis or definitions\n\n"
-        "4. **Lists:**\n"
-        "   - Use <ul> and <li> for unordered items or options\n"
-        "   - Use <ol> and <li> for sequential steps or instructions\n"
-        "   - Keep list items concise (1-2 sentences max)\n"
-        "   Example:\n"
-        "   <ol>\n"
-        "     <li>First step here</li>\n"
-        "     <li>Second step here</li>\n"
-        "   </ol>\n\n"
-        "5. **Paragraphs:**\n"
-        "   - Wrap each paragraph in <p> tags\n"
-        "   - Keep paragraphs short (2-4 sentences)\n"
-        "   - Start new paragraphs for new ideas\n\n"
-        "6. **Special Elements:**\n"
-        "   - Use <blockquote> for important notes or warnings\n"
-        "   - Use <code> for technical terms, commands, or file names\n"
-        "   - Use <hr> to separate major sections if needed\n\n"
-        "7. **Readability:**\n"
-        "   - Write in a friendly, conversational tone\n"
-        "   - Use short sentences when possible\n"
-        "   - Avoid jargon unless necessary (then explain it)\n"
-        "   - Use examples when helpful\n\n"
-        "8. **NO inline links in the body** - citations go in the Sources section\n\n"
-        "9. **Important:** Always return valid, well-formed HTML. Close all tags properly.\n\n"
-        "CRITICAL - SOURCES SECTION:\n"
-        "After your HTML formatted answer, you MUST add a plain text section titled 'Sources:'\n"
-        "This section should be OUTSIDE of any HTML tags - just plain text.\n"
-        "Format:\n"
-        "Sources:\n"
-        "Title — URL\n"
-        "Another Title — URL\n\n"
-        "Example:\n"
-        "<p>Your HTML answer here...</p>\n\n"
-        "Sources:\n"
-        "RIT Wi-Fi Setup — https://help.rit.edu/sp?id=kb_article_view&sysparm_article=KB0040936\n"
-        "Network Guide — https://rit.edu/its/networking\n\n"
-        "List at least 1 source. Prefer authoritative sites. If you used web_search, include those sources."
-    )
+# The static prompt prefix (tools, then system message) is built once, so
+# it is byte-identical on every call and the provider's prompt cache applies
+# Updated system message to explain domain restrictions and formatting;
+# the formatting rules are shared with the local-only system message
+ANSWER_FORMATTING = (
+    "FORMATTING GUIDELINES - Use HTML for maximum readability:\n\n"
+    "1. **Structure Your Response:**\n"
+    "   - Start with a brief overview (1-2 sentences in a <p> tag)\n"
+    "   - Break complex answers into clear sections with headings\n"
+    "   - Use <br> or separate <p> tags for spacing between sections\n\n"
+    "2. **Headings:** Use <h2> for main sections and <h3> for subsections\n"
+    "   Example:\n"
+    "   <h2>How to Connect</h2>\n"
+    "   <h3>On iOS Devices</h3>\n\n"
+    "3. **Emphasis:**\n"
+    "   - Use <strong> or <b> for important terms, names, and key concepts\n"
+    "   - Use <em> or <i> for secondary emphasis or definitions\n\n"
+    "4. **Lists:**\n"
+    "   - Use <ul> and <li> for unordered items or options\n"
+    "   - Use <ol> and <li> for sequential steps or instructions\n"
+    "   - Keep list items concise (1-2 sentences max)\n"
+    "   Example:\n"
+    "   <ol>\n"
+    "     <li>First step here</li>\n"
+    "     <li>Second step here</li>\n"
+    "   </ol>\n\n"
+    "5. **Paragraphs:**\n"
+    "   - Wrap each paragraph in <p> tags\n"
+    "   - Keep paragraphs short (2-4 sentences)\n"
+    "   - Start new paragraphs for new ideas\n\n"
+    "6. **Special Elements:**\n"
+    "   - Use <blockquote> for important notes or warnings\n"
+    "   - Use <code> for technical terms, commands, or file names\n"
+    "   - Use <hr> to separate major sections if needed\n\n"
+    "7. **Readability:**\n"
+    "   - Write in a friendly, conversational tone\n"
+    "   - Use short sentences when possible\n"
+    "   - Avoid jargon unless necessary (then explain it)\n"
+    "   - Use examples when helpful\n\n"
+    "8. **NO inline links in the body** - citations go in the Sources section\n\n"
+    "9. **Important:** Always return valid, well-formed HTML. Close all tags properly.\n\n"
+)
+ANSWER_INSTRUCTIONS = (
+    "You are a helpful assistant with web_search access.\n"
+    "When the answer involves public or recent facts, USE web_search.\n"
+    "Your web_search tool is restricted to:\n"
+    "• Rochester Institute of Technology sites (rit.edu)\n"
+    "• Slack help\n"
+    "• Microsoft / Office help\n"
+    "• Google help / Workspace docs\n"
+    "• Adobe help\n"
+    "• A few general technical help sites (e.g., Stack Overflow)\n"
+    "Prefer RIT pages when answering RIT-specific questions.\n\n"
+    + ANSWER_FORMATTING +
+    "CRITICAL - SOURCES SECTION:\n"
+    "After your HTML formatted answer, you MUST add a plain text section titled 'Sources:'\n"
+    "This section should be OUTSIDE of any HTML tags - just plain text.\n"
+    "Format:\n"
+    "Sources:\n"
+    "Title — URL\n"
+    "Another Title — URL\n\n"
+    "Example:\n"
+    "<p>Your HTML answer here...</p>\n\n"
+    "Sources:\n"
+    "RIT Wi-Fi Setup — https://help.rit.edu/sp?id=kb_article_view&sysparm_article=KB0040936\n"
+    "Network Guide — https://rit.edu/its/networking\n\n"
+    "List at least 1 source. Prefer authoritative sites. If you used web_search, include those sources."
+)
+# System message for local-only answers (see routing.py): no web_search, and
+# the Dropbox documents are cited from the retrieved hits, not by the model
+LOCAL_ANSWER_INSTRUCTIONS = (
+    "You are a helpful assistant answering questions from RIT help documents.\n"
+    "Answer ONLY from the Context in the user's message; you have no web access.\n"
+    "If the Context does not answer the question, say so instead of guessing.\n\n"
+    + ANSWER_FORMATTING +
+    "CITATIONS:\n"
+    "Do not add a Sources section or any URLs; the Context documents you used are cited automatically."
+)
 
-    user_msg = f"Context:\n{context}\n\nQuestion: {query}"
+ANSWER_TOOLS = [
+    {
+        "type": "web_search",
+        "filters": {
+            # Only search these domains (and their subdomains)
+            "allowed_domains": ALLOWED_HELP_DOMAINS,
+        },
+    }
+]
+# Requests sharing this key are routed to the same prompt cache
+PROMPT_CACHE_KEY = os.getenv("RAG_PROMPT_CACHE_KEY", "rag-answer")
+# Local-only answers get LOCAL_ANSWER_INSTRUCTIONS; a chained turn sends no
+# system message (the provider keeps the first turn's), so it carries this note
+LOCAL_ONLY_NOTE = "\n\nAnswer from the Context above; web_search is not available for this question."
 
-    response = client.responses.create(
+def _user_message(query: str, docs: List[str]) -> str:
+    context = "\n".join(docs)
+    return f"Context:\n{context}\n\nQuestion: {query}"
+
+def _answer_request(query: str, docs: List[str], local_only: bool = False) -> Dict:
+    """
+    Keyword arguments for responses.create() for a question and its retrieved docs.
+    local_only leaves out the web_search tool and answers from the
+    context with LOCAL_ANSWER_INSTRUCTIONS (see routing.py).
+    """
+    request = dict(
         model="gpt-5",
-        tools=[
-            {
-                "type": "web_search",
-                "filters": {
-                    # Only search these domains (and their subdomains)
-                    "allowed_domains": ALLOWED_HELP_DOMAINS,
-                },
-            }
-        ],
+        tools=ANSWER_TOOLS,
         input=[
-            {"role": "system", "content": system_msg},
-            {"role": "user", "content": user_msg},
+            {"role": "system", "content": ANSWER_INSTRUCTIONS},
+            {"role": "user", "content": _user_message(query, docs)},
         ],
+        prompt_cache_key=PROMPT_CACHE_KEY,
         # temperature=0.2,
         # reasoning={"effort": "medium"},
         # Optional: if you want the full list of sources as a fallback:
         # include=["web_search_call.action.sources"],
     )
+    if local_only:
+        del request["tools"]
+        request["input"][0]["content"] = LOCAL_ANSWER_INSTRUCTIONS
+    return request
+
+# --- Web search routing (see routing.py) ---
+# Requests whose Dropbox context is strong enough are answered without the
+# (slow) web_search tool; RAG_WEB_SEARCH_ROUTING=shadow only logs the decision
+web_search_router = WebSearchRouter(
+    mode=os.getenv("RAG_WEB_SEARCH_ROUTING", "shadow").lower(),
+    min_scores=parse_min_scores(os.getenv("RAG_ROUTE_MIN_SCORE", "")),
+    min_coverage=float(os.getenv("RAG_ROUTE_MIN_COVERAGE", "0.8")),
+)
+# Local-only citations link to the Dropbox document: base URL + its path
+LOCAL_SOURCE_URL = os.getenv("RAG_LOCAL_SOURCE_URL", "https://www.dropbox.com/home")
 
+def _routed_answer(response, decision: RouteDecision, hits: List[Dict]) -> Dict:
+    """_parse_answer(), cited with the Dropbox documents when answered from local context only."""
+    result = _parse_answer(response)
+    if decision.local_only:
+        result["citations"] = local_citations(hits, LOCAL_SOURCE_URL)
+    return result
+
+def _parse_answer(response) -> Dict:
+    """Turn a Responses API result into {'text', 'citations'}."""
     # Raw text the model returned (may contain 'Sources:' section)
     raw_text = (getattr(response, "output_text", "") or "").strip()
 
     # Parse Sources block -> citations[], and remove it from body
-    body, citations = parse_sources_block(raw_text)
+    with STAGE_SECONDS.time(stage="parse_sources"):
+        body, citations = parse_sources_block(raw_text)
 
     # Fallback: if no sources block, attempt to collect tool annotations (when present)
     if not citations:
-        try:
-            for block in response.output:
-                if getattr(block, "type", "") == "message":
-                    for part in getattr(block, "content", []):
-                        for ann in getattr(part, "annotations", []) or []:
-                            if ann.get("type") == "url_citation" and ann.get("url"):
-                                citations.append({"title": ann.get("title"), "url": ann.get("url")})
-        except Exception:
-            pass
+        citations = _annotation_citations(response)
 
     # Finally, ensure no inline links remain in the body
-    body = strip_inline_links(body)
+    with STAGE_SECONDS.time(stage="strip_links"):
+        body = strip_inline_links(body)
 
     return {"text": body, "citations": citations[:6]}
 
+def _annotation_citations(response) -> List[Dict[str, str]]:
+    """url_citation annotations attached to the response's message output."""
+    citations = []
+    try:
+        for block in response.output:
+            if getattr(block, "type", "") == "message":
+                for part in getattr(block, "content", []):
+                    for ann in getattr(part, "annotations", []) or []:
+                        if ann.get("type") == "url_citation" and ann.get("url"):
+                            citations.append({"title": ann.get("title"), "url": ann.get("url")})
+    except Exception:
+        pass
+    return citations
+
+# --- Answer cache (see answer_cache.py; RAG_ANSWER_CACHE=memory|sqlite|off) ---
+ANSWER_CONFIG_FINGERPRINT = hashlib.sha256(
+    json.dumps(_answer_request("", []), sort_keys=True).encode("utf-8")
+).hexdigest()[:16]
+# Paraphrases fall through to the semantic cache (semantic_cache.py; RAG_SEMANTIC_CACHE=auto|on|off)
+answer_cache = create_answer_cache(ANSWER_CONFIG_FINGERPRINT)
+semantic_cache = create_semantic_cache()
+for _cache in (answer_cache, semantic_cache):
+    if _cache is not None:
+        try:
+            from dropbox_rag import on_corpus_change
+            on_corpus_change(_cache.on_corpus_change)
+        except ImportError:
+            pass
+
+def _cache_get(query: str):
+    cached = answer_cache.get(query) if answer_cache is not None else None
+    if cached is None and semantic_cache is not None:
+        cached, _ = semantic_cache.lookup(query)
+    return cached
+
+async def _cache_get_async(query: str):
+    """_cache_get() off the event loop: a semantic lookup embeds the query (an API call with the openai embedder)."""
+    cached = answer_cache.get(query) if answer_cache is not None else None
+    if cached is None and semantic_cache is not None:
+        cached, _ = await asyncio.get_running_loop().run_in_executor(retrieval_pool, semantic_cache.lookup, query)
+    return cached
+
+def _cache_set(query: str, result: Dict, hits: List[Dict]) -> None:
+    if not result.get("text") or any(hit.get('degraded') for hit in hits):
+        return
+    sources = [hit['path'] for hit in hits]
+    if answer_cache is not None:
+        answer_cache.set(query, result, sources=sources)
+    if semantic_cache is not None:
+        # Embedding the query can be an API call; the async paths must not wait for it
+        retrieval_pool.submit(semantic_cache.add, query, result, sources)
+
+def cache_stats() -> Dict:
+    """Hit rates for both answer caches, the semantic similarity distribution, coalescing, titles and routing."""
+    return {
+        "exact": answer_cache.stats() if answer_cache is not None else None,
+        "semantic": semantic_cache.stats() if semantic_cache is not None else None,
+        "coalescing": {"answers": answer_flight.stats(), "titles": title_flight.stats()},
+        "titles": title_stats.stats(),
+        "routing": web_search_router.stats(),
+    }
+
+def _collect_metrics():
+    """Cache, coalescing, title and context counters for /metrics, read at scrape time."""
+    caches = [("exact", answer_cache), ("semantic", semantic_cache)]
+    yield ("rag_cache_lookups_total", "counter", "Answer cache lookups by result",
+           [({"cache": name, "result": result}, cache.counters[result])
+            for name, cache in caches if cache is not None for result in ("hits", "misses")])
+    yield ("rag_coalesced_requests_total", "counter", "Requests that shared an identical in-flight call",
+           [({"kind": "answer"}, answer_flight.counters['coalesced']),
+            ({"kind": "title"}, title_flight.counters['coalesced'])])
+    yield ("rag_titles_total", "counter", "Chat titles by source",
+           [({"source": source}, n) for source, n in title_stats.counts.items()])
+    totals = context_packer.totals
+    yield ("rag_context_tokens_total", "counter", "Context tokens retrieved and sent to the model",
+           [({"kind": "retrieved"}, totals['tokens_in']), ({"kind": "sent"}, totals['tokens_out'])])
+
+REGISTRY.add_collector(_collect_metrics)
+REGISTRY.add_collector(lambda: llm_scheduler.collect())
+REGISTRY.add_collector(lambda: web_search_router.collect())
+
+# --- Request coalescing (see single_flight.py) ---
+# Identical questions arriving together (e.g. during an outage) share one
+# retrieval and one model call; so do title requests for the same transcript.
+answer_flight = SingleFlight()
+title_flight = SingleFlight()
+
+def _answer_flight_key(query: str) -> str:
+    return f"{normalize_query(query)}\0{ANSWER_CONFIG_FINGERPRINT}"
+
+def generate_answer(query: str):
+    with STAGE_SECONDS.time(stage="cache_lookup"):
+        cached = _cache_get(query)
+    if cached is not None:
+        return cached
+    return answer_flight.do(_answer_flight_key(query), _generate_answer, query)
+
+def _generate_answer(query: str):
+    hits = pack_hits(retrieve(query))
+    decision = web_search_router.decide(query, hits)
+    started = time.perf_counter()
+    with STAGE_SECONDS.time(stage="llm"):
+        response = client.responses.create(**_answer_request(query, hits_to_docs(hits), decision.local_only))
+    web_search_router.observe(decision, time.perf_counter() - started)
+    result = _routed_answer(response, decision, hits)
+    _cache_set(query, result, hits)
+    return result
+
+async def generate_answer_async(query: str):
+    """
+    Non-blocking generate_answer(): retrieval runs on the retrieval pool and
+    the OpenAI call uses the async client, so the event loop keeps serving
+    other requests. Concurrent identical queries share one computation.
+    Raises asyncio.TimeoutError after RAG_LLM_TIMEOUT, or Overloaded when
+    admission control refuses the model call.
+    """
+    with STAGE_SECONDS.time(stage="cache_lookup"):
+        cached = await _cache_get_async(query)
+    if cached is not None:
+        return cached
+    return await answer_flight.do_async(_answer_flight_key(query), lambda: _generate_answer_async(query))
+
+async def _generate_answer_async(query: str):
+    return await _answer_from_hits_async(query, await retrieve_async(query))
+
+async def _answer_from_hits_async(query: str, hits: List[Dict], priority: str = "answer"):
+    hits = pack_hits(hits)
+    decision = web_search_router.decide(query, hits)
+    response = await _create_response(_answer_request(query, hits_to_docs(hits), decision.local_only),
+                                      decision, priority)
+    result = _routed_answer(response, decision, hits)
+    _cache_set(query, result, hits)
+    return result
+
+async def _create_response(request: Dict, decision: RouteDecision, priority: str = "answer"):
+    """
+    responses.create() once admission control lets the call through, bounded
+    by RAG_LLM_TIMEOUT. The call's time is recorded under its route.
+    """
+    async with llm_scheduler.admit(priority, _request_tokens(request, ANSWER_OUTPUT_TOKENS)) as slot:
+        started = time.perf_counter()
+        with STAGE_SECONDS.time(stage="llm"):
+            response = await asyncio.wait_for(async_client.responses.create(**request), LLM_TIMEOUT)
+        web_search_router.observe(decision, time.perf_counter() - started)
+        slot.settle(_usage_tokens(response))
+    return response
+
+# --- Conversations (see conversations.py) ---
+# Follow-ups are chained to the previous turn's response id (or get a
+# compacted transcript) instead of resending the conversation
+conversations = ConversationStore(
+    max_entries=int(os.getenv("RAG_CONVERSATION_MAX", "10000")),
+    ttl=float(os.getenv("RAG_CONVERSATION_TTL", "3600")),
+    overlap=float(os.getenv("RAG_FOLLOWUP_OVERLAP", "0.5")),
+)
+HISTORY_CHARS = int(os.getenv("RAG_HISTORY_CHARS", "2000"))  # compacted transcript size
+INSTRUCTION_TOKENS = count_tokens(ANSWER_INSTRUCTIONS)
+REGISTRY.add_collector(lambda: conversations.collect())
+
+def _compacted_request(query: str, docs: List[str], history: List[Dict], local_only: bool = False) -> Dict:
+    """_answer_request() with the recent transcript after the static prefix."""
+    request = _answer_request(query, docs, local_only)
+    transcript = _serialize_transcript(history, limit_chars=HISTORY_CHARS)
+    request["input"].insert(1, {"role": "user", "content": f"Earlier in this conversation:\n{transcript}"})
+    return request
+
+async def answer_turn_async(query: str, conversation_id: Optional[str] = None,
+                            history: Optional[List[Dict]] = None) -> Dict:
+    """
+    generate_answer_async() for one turn of a conversation. The result also
+    has 'conversation_id' (a new one unless the given id is a live
+    conversation this worker issued) and 'usage': how the
+    turn was sent (first, chained, compacted or cached), whether it reused
+    the previous turn's chunks, and its input tokens against resending the
+    full transcript. history is the UI's earlier messages ({'role', 'text'});
+    it is only sent (compacted) when this worker cannot chain the turn.
+    """
+    conversation = conversations.get(conversation_id)
+    history = list(conversation.history) or list(history or [])
+    if not conversation.turns:
+        # Joined mid-conversation: a full resend would include the UI's transcript
+        conversation.transcript_tokens = sum(count_tokens(m.get("text") or "") for m in history)
+
+    if not conversation.response_id and not history:
+        # A standalone question: the answer caches apply, and concurrent
+        # identical first turns share one retrieval and one model call
+        with STAGE_SECONDS.time(stage="cache_lookup"):
+            cached = await _cache_get_async(query)
+        if cached is not None:
+            return _finish_turn(conversation, query, cached, None, None, "cached", False, 0, 0)
+        result, hits, response, request = await answer_flight.do_async(
+            "turn\0" + _answer_flight_key(query), lambda: _first_turn_async(query))
+        full = INSTRUCTION_TOKENS + count_tokens(_user_message(query, hits_to_docs(hits)))
+        return _finish_turn(conversation, query, result, hits, response, "first", False, full,
+                            _request_tokens(request, 0))
+
+    reused = conversations.same_topic(conversation, query)
+    hits = conversation.hits if reused else pack_hits(await retrieve_async(query))
+    docs = hits_to_docs(hits)
+    decision = web_search_router.decide(query, hits)
+    local_only = decision.local_only
+    if conversation.response_id:
+        mode = "chained"
+        # Earlier turns, and the context they were sent, are kept by the provider
+        content = f"Question: {query}" if reused else _user_message(query, docs)
+        if local_only:
+            content += LOCAL_ONLY_NOTE
+        request = dict(_answer_request(query, docs, local_only), previous_response_id=conversation.response_id,
+                       input=[{"role": "user", "content": content}])
+    else:
+        mode = "compacted"
+        request = _compacted_request(query, docs, history, local_only)
+    full = INSTRUCTION_TOKENS + conversation.transcript_tokens + count_tokens(_user_message(query, docs))
+
+    try:
+        response = await _create_response(request, decision)
+    except (BadRequestError, NotFoundError) as e:
+        if mode != "chained":
+            raise
+        # The provider no longer has the previous response (expired or another project)
+        print(f"  Cannot chain to {conversation.response_id} ({e.__class__.__name__}), sending compacted history")
+        mode = "compacted"
+        request = _compacted_request(query, docs, history, local_only)
+        response = await _create_response(request, decision)
+
+    result = _routed_answer(response, decision, hits)
+    return _finish_turn(conversation, query, result, hits, response, mode, reused, full,
+                        _request_tokens(request, 0))
+
+async def _first_turn_async(query: str):
+    """A conversation's first turn; also returns what _finish_turn() needs to chain the next one."""
+    hits = pack_hits(await retrieve_async(query))
+    decision = web_search_router.decide(query, hits)
+    request = _answer_request(query, hits_to_docs(hits), decision.local_only)
+    response = await _create_response(request, decision)
+    result = _routed_answer(response, decision, hits)
+    _cache_set(query, result, hits)
+    return result, hits, response, request
+
+def _finish_turn(conversation, query: str, result: Dict, hits: Optional[List[Dict]], response,
+                 mode: str, reused: bool, full: int, sent: int) -> Dict:
+    """Remember what the next turn needs and report this one."""
+    conversation.response_id = getattr(response, "id", None)
+    if hits is not None and not any(hit.get('degraded') for hit in hits):
+        conversation.topic = conversation.topic | keywords(query) if reused else frozenset(keywords(query))
+        conversation.hits = hits
+    else:
+        conversation.topic, conversation.hits = frozenset(keywords(query)), None
+    conversation.history.extend([{"role": "User", "text": query}, {"role": "RAG", "text": result["text"]}])
+    conversation.transcript_tokens += count_tokens(_user_message(query, hits_to_docs(hits or []))) + \
+        count_tokens(result["text"])
+    conversations.save(conversation, "first" if mode == "cached" else mode, reused, full, sent)
+
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "input_tokens_details", None)
+    report = {
+        "turn": conversation.turns,
+        "mode": mode,
+        "reused_context": reused,
+        "input_tokens_full": full,       # Resending the whole transcript (estimate)
+        "input_tokens_sent": sent,       # Actually sent with this turn (estimate)
+        "input_tokens_billed": getattr(usage, "input_tokens", 0),  # Including chained turns
+        "input_tokens_cached": getattr(details, "cached_tokens", 0),
+    }
+    print(f" Turn {report['turn']} ({mode}{', reused context' if reused else ''}): "
+          f"{sent} input tokens sent, {full} for a full resend")
+    return dict(result, conversation_id=conversation.id, usage=report)
+
+BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "8"))  # model calls in flight per batch
+
+async def generate_answers_batch(queries: List[str], concurrency: int = BATCH_CONCURRENCY):
+    """
+    Answer many queries. Async generator of (index, result or exception)
+    in completion order. Cached answers come back first; retrieval for the
+    rest runs as one batch (retrieve_many), then at most `concurrency`
+    model calls run at once. Answers are parsed exactly like /rag's and
+    fill the answer caches, so this also serves to warm them.
+    """
+    misses = []
+    for i, query in enumerate(queries):
+        cached = await _cache_get_async(query)
+        if cached is not None:
+            yield i, cached
+        else:
+            misses.append(i)
+    if not misses:
+        return
+
+    loop = asyncio.get_running_loop()
+    batch_hits = await loop.run_in_executor(retrieval_pool, retrieve_many, [queries[i] for i in misses])
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def answer(i: int, hits: List[Dict]):
+        async with semaphore:
+            try:
+                # An earlier duplicate in the batch may have finished meanwhile
+                cached = await _cache_get_async(queries[i])
+                if cached is not None:
+                    return i, cached
+                # Duplicates still in flight, in the batch or from /rag, share one call
+                return i, await answer_flight.do_async(
+                    _answer_flight_key(queries[i]), lambda: _answer_from_hits_async(queries[i], hits, "batch"))
+            except Exception as e:
+                return i, e
+
+    tasks = [asyncio.ensure_future(answer(i, hits)) for i, hits in zip(misses, batch_hits)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+async def stream_answer(query: str):
+    """
+    Streaming generate_answer_async(). Async generator of (event, payload):
+      ("delta", text)            - cleaned answer text, as soon as it is safe to show
+      ("citations", [{...}])     - once, after the model finishes
+    Raises asyncio.TimeoutError if the whole answer takes longer than RAG_LLM_TIMEOUT,
+    or Overloaded (before any delta) when admission control refuses the model call.
+    """
+    with STAGE_SECONDS.time(stage="cache_lookup"):
+        cached = await _cache_get_async(query)
+    if cached is not None:
+        yield "delta", cached["text"]
+        yield "citations", cached["citations"]
+        return
+
+    hits = pack_hits(await retrieve_async(query))
+    decision = web_search_router.decide(query, hits)
+    request = _answer_request(query, hits_to_docs(hits), decision.local_only)
+    async with llm_scheduler.admit("answer", _request_tokens(request, ANSWER_OUTPUT_TOKENS)) as slot:
+        async for item in _stream_model_answer(query, hits, request, slot, decision):
+            yield item
+
+async def _stream_model_answer(query: str, hits: List[Dict], request: Dict, slot, decision: RouteDecision):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LLM_TIMEOUT
+    llm_started = started = loop.time()
+    stream = await asyncio.wait_for(async_client.responses.create(**request, stream=True), deadline - loop.time())
+
+    parser = AnswerStreamParser()
+    final_response = None
+    events = stream.__aiter__()
+    while True:
+        try:
+            event = await asyncio.wait_for(events.__anext__(), max(0.0, deadline - loop.time()))
+        except StopAsyncIteration:
+            break
+        if event.type == "response.output_text.delta":
+            if llm_started is not None:
+                STAGE_SECONDS.observe(loop.time() - llm_started, stage="llm_first_token")
+                llm_started = None
+            text = parser.feed(event.delta)
+            if text:
+                yield "delta", text
+        elif event.type == "response.completed":
+            final_response = event.response
+
+    with STAGE_SECONDS.time(stage="parse_sources"):
+        text, citations = parser.finish()
+    if text:
+        yield "delta", text
+    if decision.local_only:
+        citations = local_citations(hits, LOCAL_SOURCE_URL)
+    elif not citations and final_response is not None:
+        citations = _annotation_citations(final_response)
+    yield "citations", citations[:6]
+    web_search_router.observe(decision, loop.time() - started)
+    if final_response is not None:
+        slot.settle(_usage_tokens(final_response))
+        _cache_set(query, _routed_answer(final_response, decision, hits), hits)
+
 
 # --- Title generation helpers ---
 
@@ -260,18 +892,9 @@ def _postprocess_title(s: str) -> str:
         s = s[:57].rstrip() + "…"
     return s or "New chat"
 
-def generate_title(messages):
-    """
-    Ask GPT for a concise, human-readable chat title (3–7 words).
-    No schema—plain text for maximum compatibility.
-    """
-    transcript = _serialize_transcript(messages)
-
-    # If we somehow have nothing yet, fall back immediately
-    if not transcript:
-        return "New chat"
-
-    response = client.responses.create(
+def _title_request(transcript: str) -> Dict:
+    """Keyword arguments for responses.create() to title a transcript."""
+    return dict(
         model="gpt-5",
         input=[
             {
@@ -295,5 +918,80 @@ def generate_title(messages):
         # No tools, no JSON schema (to avoid 500s on picky SDKs)
     )
 
+# --- Fast titles (see titles.py) ---
+# A cached title is reused while the conversation stays on topic; otherwise
+# a local extractive title is used unless its confidence is below
+# RAG_TITLE_MIN_CONFIDENCE, and only then is the model asked.
+TITLE_MIN_CONFIDENCE = float(os.getenv("RAG_TITLE_MIN_CONFIDENCE", "0.6"))
+title_cache = TitleCache(max_entries=int(os.getenv("RAG_TITLE_CACHE_SIZE", "10000")))
+title_stats = TitleStats()
+
+def _local_title(messages, transcript: str):
+    """(title, source) without calling the model, or (None, None)."""
+    cached = title_cache.lookup(messages)
+    if cached is not None:
+        return cached, "cache"
+    title, confidence = extract_title(transcript)
+    if title and confidence >= TITLE_MIN_CONFIDENCE:
+        title = _postprocess_title(title)
+        title_cache.store(messages, title)
+        return title, "local"
+    return None, None
+
+def _title_flight_key(transcript: str) -> str:
+    return hashlib.sha256(json.dumps(_title_request(transcript), sort_keys=True).encode("utf-8")).hexdigest()
+
+def generate_title(messages):
+    """
+    Concise, human-readable chat title (3–7 words): the cached or local
+    extractive title when possible, otherwise ask GPT.
+    No schema—plain text for maximum compatibility.
+    """
+    transcript = _serialize_transcript(messages)
+
+    # If we somehow have nothing yet, fall back immediately
+    if not transcript:
+        return "New chat"
+
+    started = time.perf_counter()
+    title, source = _local_title(messages, transcript)
+    if title is None:
+        title = title_flight.do(_title_flight_key(transcript), _generate_title, transcript)
+        title_cache.store(messages, title)
+        source = "llm"
+    title_stats.observe(source, started)
+    return title
+
+def _generate_title(transcript: str) -> str:
+    with STAGE_SECONDS.time(stage="llm_title"):
+        response = client.responses.create(**_title_request(transcript))
+
+    raw = (getattr(response, "output_text", "") or "").strip()
+    return _postprocess_title(raw)
+
+async def generate_title_async(messages):
+    """
+    Non-blocking generate_title(); raises asyncio.TimeoutError after
+    RAG_LLM_TIMEOUT, or Overloaded when admission control refuses the call.
+    """
+    transcript = _serialize_transcript(messages)
+    if not transcript:
+        return "New chat"
+
+    started = time.perf_counter()
+    title, source = _local_title(messages, transcript)
+    if title is None:
+        title = await title_flight.do_async(_title_flight_key(transcript), lambda: _generate_title_async(transcript))
+        title_cache.store(messages, title)
+        source = "llm"
+    title_stats.observe(source, started)
+    return title
+
+async def _generate_title_async(transcript: str) -> str:
+    request = _title_request(transcript)
+    async with llm_scheduler.admit("title", _request_tokens(request, TITLE_OUTPUT_TOKENS)) as slot:
+        with STAGE_SECONDS.time(stage="llm_title"):
+            response = await asyncio.wait_for(async_client.responses.create(**request), LLM_TIMEOUT)
+        slot.settle(_usage_tokens(response))
     raw = (getattr(response, "output_text", "") or "").strip()
     return _postprocess_title(raw)
@@ -0,0 +1,149 @@
+"""
+Confidence-gated web search.
+The web_search tool makes an answer several seconds slower, so it is only
+enabled when the Dropbox context may not be enough. WebSearchRouter looks
+at the retrieved hits and picks a route per request:
+  - local: the best hit scores at least the retrieval mode's threshold and
+    the hits cover at least `min_coverage` of the query's terms; answered
+    from the context alone, cited with the Dropbox documents
+  - web: anything else (no Dropbox context, weak or partial matches)
+Scores are on the scale of the retrieval mode that produced them (BM25 for
+keyword, cosine similarity for vector, RRF for hybrid), hence one threshold
+per mode. An RRF score is a sum over the fused retrievers, at most
+1 / (k + 1) from each, so the hybrid threshold is per fused retriever: a
+hybrid search that only had the keyword ranking (no vector index) needs
+half the score of one that fused two. In shadow mode the decision is only logged and counted; every
+request still uses web search. Model call latency is recorded by the
+route taken and the route decided, so shadow mode shows what would change.
+"""
+import threading
+from collections import deque
+from typing import Dict, List, Optional
+from urllib.parse import quote
+
+from metrics import REGISTRY
+from search_index import tokenize
+
+ROUTES = ("local", "web")
+ROUTING_MODES = ("off", "shadow", "on")
+DEFAULT_MIN_SCORES = "keyword=4,vector=0.45,hybrid=0.015"
+
+ROUTE_SECONDS = REGISTRY.histogram(
+    "rag_route_llm_seconds", "Model call time by route taken and route decided", ["route", "decision"])
+
+
+def parse_min_scores(spec: str) -> Dict[str, float]:
+    """'keyword=4,vector=0.45' -> {'keyword': 4.0, 'vector': 0.45}"""
+    scores = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, value = item.partition("=")
+        scores[name.strip()] = float(value)
+    return scores
+
+
+def local_citations(hits: List[Dict], base_url: str, limit: int = 6) -> List[Dict[str, str]]:
+    """One citation per Dropbox document in the hits, best ranked first."""
+    citations, seen = [], set()
+    for hit in hits:
+        path = hit.get('path')
+        if not path or path in seen:
+            continue
+        seen.add(path)
+        citations.append({"title": hit.get('name') or path, "url": base_url + quote(path), "path": path})
+    return citations[:limit]
+
+
+class RouteDecision:
+    """route is what the scores say; applied is what the request does (web unless mode is on)."""
+    __slots__ = ('route', 'applied', 'reason', 'score', 'coverage')
+
+    def __init__(self, route: str, applied: str, reason: str, score: float = 0.0, coverage: float = 0.0):
+        self.route = route
+        self.applied = applied
+        self.reason = reason
+        self.score = score
+        self.coverage = coverage
+
+    @property
+    def local_only(self) -> bool:
+        return self.applied == "local"
+
+
+class WebSearchRouter:
+    """
+    Args:
+        mode: off (always web search), shadow (decide and log only) or on
+        min_scores: best hit score needed per retrieval mode (hybrid: per fused retriever)
+        min_coverage: share of query terms that must occur in the hits
+    """
+
+    def __init__(self, mode: str = "shadow", min_scores: Optional[Dict[str, float]] = None,
+                 min_coverage: float = 0.8, window: int = 1000):
+        if mode not in ROUTING_MODES:
+            raise ValueError(f"Unknown routing mode {mode!r}, expected one of {ROUTING_MODES}")
+        self.mode = mode
+        self.min_scores = dict(parse_min_scores(DEFAULT_MIN_SCORES), **(min_scores or {}))
+        self.min_coverage = min_coverage
+        self.counts = {(route, applied): 0 for route in ROUTES for applied in ROUTES}
+        self._latencies = {route: deque(maxlen=window) for route in ROUTES}
+        self._lock = threading.Lock()
+
+    def decide(self, query: str, hits: List[Dict]) -> RouteDecision:
+        if self.mode == "off":
+            return self._count(RouteDecision("web", "web", "off"))
+        local = [hit for hit in hits if hit.get('path') and not hit.get('degraded')]
+        if not local:
+            return self._decided("web", "no_local_context", query)
+        score = max(hit['score'] for hit in local)
+        mode = local[0].get('retrieval', 'keyword')
+        threshold = self.min_scores.get(mode, float("inf"))
+        if mode == "hybrid":
+            threshold *= local[0].get('fused_retrievers', 1)
+        terms = set(tokenize(query))
+        found = set(tokenize(" ".join(hit['text'] for hit in local))) & terms
+        coverage = len(found) / len(terms) if terms else 0.0
+        if score < threshold:
+            return self._decided("web", "low_score", query, score, coverage)
+        if coverage < self.min_coverage:
+            return self._decided("web", "low_coverage", query, score, coverage)
+        return self._decided("local", "confident", query, score, coverage)
+
+    def _decided(self, route: str, reason: str, query: str, score: float = 0.0, coverage: float = 0.0) -> RouteDecision:
+        decision = RouteDecision(route, route if self.mode == "on" else "web", reason, score, coverage)
+        shadow = " [shadow: using web_search]" if self.mode == "shadow" else ""
+        print(f" Route: {route} ({reason}, score {score:.3g}, coverage {coverage:.0%}){shadow} for: {query[:80]}")
+        return self._count(decision)
+
+    def _count(self, decision: RouteDecision) -> RouteDecision:
+        with self._lock:
+            self.counts[(decision.route, decision.applied)] += 1
+        return decision
+
+    def observe(self, decision: RouteDecision, seconds: float) -> None:
+        """Record a model call's duration under the route it took."""
+        ROUTE_SECONDS.observe(seconds, route=decision.applied, decision=decision.route)
+        with self._lock:
+            self._latencies[decision.applied].append(seconds)
+
+    def stats(self) -> Dict:
+        """Decisions by route and p50/p99 model call latency per route taken."""
+        with self._lock:
+            counts = dict(self.counts)
+            latencies = {route: sorted(values) for route, values in self._latencies.items()}
+        pct = lambda values, p: round(values[min(len(values) - 1, int(p / 100 * len(values)))] * 1000, 2) if values else 0.0
+        total = sum(counts.values())
+        return {
+            'mode': self.mode,
+            'decisions': {route: sum(n for (r, _), n in counts.items() if r == route) for route in ROUTES},
+            'local_only': counts[("local", "local")],
+            'local_rate': round(sum(n for (r, _), n in counts.items() if r == "local") / total, 4) if total else 0.0,
+            'latency': {route: {'calls': len(values), 'p50_ms': pct(values, 50), 'p99_ms': pct(values, 99)}
+                        for route, values in latencies.items()},
+        }
+
+    def collect(self):
+        """Routing decisions for /metrics (latency is the rag_route_llm_seconds histogram)."""
+        with self._lock:
+            counts = dict(self.counts)
+        yield ("rag_route_decisions_total", "counter", "Web search routing decisions, by route decided and taken",
+               [({"decision": route, "route": applied}, n) for (route, applied), n in counts.items()])
@@ -0,0 +1,252 @@
+"""
+Inverted index with BM25 scoring.
+Maps each term to the chunks that contain it so a query only touches
+the postings of its own terms instead of scanning the whole corpus.
+"""
+import heapq
+import math
+import re
+from collections import Counter
+from collections.abc import MutableMapping
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+TOKEN_RE = re.compile(r"\w+")
+
+# Bump whenever tokenize() or STOPWORDS change; persisted indexes built
+# with another version are rejected
+TOKENIZER_VERSION = 1
+
+# Common English function words that carry no retrieval signal
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are as at be because been
+before being below between both but by can could did do does doing down during
+each few for from further had has have having he her here hers herself him
+himself his how i if in into is it its itself just me more most my myself no
+nor not now of off on once only or other our ours ourselves out over own same
+she should so some such than that the their theirs them themselves then there
+these they this those through to too under until up very was we were what when
+where which while who whom why will with would you your yours yourself
+yourselves
+""".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lowercase word tokens with stopwords removed.
+    Used for both indexing and querying so the two always agree.
+    """
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Index:
+    """Term -> postings (chunk id -> term frequency) with Okapi BM25 ranking."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.doc_lengths: Dict[int, int] = {}
+        self.total_length = 0
+        self._owned = None  # Terms whose postings this copy may mutate (None = all)
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, chunk_id: int, tokens: Iterable[str]) -> None:
+        """Index one chunk from its (already tokenized) terms."""
+        counts = Counter(tokens)
+        length = sum(counts.values())
+        self.doc_lengths[chunk_id] = length
+        self.total_length += length
+        for term, tf in counts.items():
+            self._writable(term)[chunk_id] = tf
+
+    def remove(self, chunk_id: int, tokens: Iterable[str]) -> None:
+        """Drop a chunk; tokens must be the ones it was added with."""
+        length = self.doc_lengths.pop(chunk_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in set(tokens):
+            postings = self._writable(term)
+            postings.pop(chunk_id, None)
+            if not postings:
+                del self.postings[term]
+
+    def copy(self) -> "BM25Index":
+        """
+        Cheap copy-on-write clone: the term table is copied, but a term's
+        postings are only duplicated the first time the clone modifies it.
+        Readers of the original are never affected by writes to the copy.
+        """
+        clone = BM25Index(self.k1, self.b)
+        clone.postings = self.postings.copy()
+        clone.doc_lengths = dict(self.doc_lengths) if isinstance(self.doc_lengths, dict) \
+            else dict(enumerate(self.doc_lengths))  # Mapped array -> writable dict
+        clone.total_length = self.total_length
+        clone._owned = set()
+        return clone
+
+    def _writable(self, term: str) -> Dict[int, int]:
+        postings = self.postings.get(term)
+        if postings is None:
+            postings = self.postings[term] = {}
+            if self._owned is not None:
+                self._owned.add(term)
+        elif self._owned is not None and term not in self._owned:
+            postings = self.postings[term] = dict(postings)
+            self._owned.add(term)
+        return postings
+
+    def idf(self, term: str) -> float:
+        """BM25 inverse document frequency (always positive)."""
+        postings = self.postings
+        df = postings.count(term) if isinstance(postings, MappedPostings) else len(postings.get(term, ()))
+        n = len(self.doc_lengths)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[int, float]]:
+        """
+        Rank chunks for a query.
+        Returns up to top_k (chunk_id, score) pairs, best first.
+        """
+        terms = set(tokenize(query))
+        if not terms or not self.doc_lengths:
+            return []
+
+        avgdl = self.total_length / len(self.doc_lengths) or 1.0
+        scores: Dict[int, float] = {}
+        for term in terms:
+            for chunk_id, score in self._term_scores(term, avgdl):
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + score
+
+        return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+    def search_many(self, queries: List[str], top_k: int = 5) -> List[List[Tuple[int, float]]]:
+        """
+        search() for a batch of queries in one pass over the index: the
+        postings of each distinct term are decoded and scored only once,
+        however many queries share it.
+        """
+        term_sets = [set(tokenize(query)) for query in queries]
+        if not self.doc_lengths:
+            return [[] for _ in queries]
+        avgdl = self.total_length / len(self.doc_lengths) or 1.0
+        term_scores = {term: self._term_scores(term, avgdl) for term in set().union(*term_sets)}
+
+        results = []
+        for terms in term_sets:
+            scores: Dict[int, float] = {}
+            for term in terms:
+                for chunk_id, score in term_scores[term]:
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + score
+            results.append(heapq.nlargest(top_k, scores.items(), key=lambda item: item[1]))
+        return results
+
+    def _term_scores(self, term: str, avgdl: float) -> List[Tuple[int, float]]:
+        """BM25 contribution of one term to every chunk containing it."""
+        if isinstance(self.postings, MappedPostings):
+            postings = self.postings.pairs(term)  # Read in place, not decoded into this process
+        else:
+            postings = self.postings.get(term)
+            postings = postings.items() if postings else ()
+        if not postings:
+            return []
+        idf = self.idf(term)
+        k1, b = self.k1, self.b
+        doc_lengths = self.doc_lengths
+        return [
+            (chunk_id, idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * doc_lengths[chunk_id] / avgdl)))
+            for chunk_id, tf in postings
+        ]
+
+
+class MappedPostings(MutableMapping):
+    """
+    Postings backed by flat arrays (e.g. a memory-mapped snapshot).
+    A term's postings are decoded into a dict the first time it is
+    looked up; writes and deletes live in an overlay so the arrays are
+    never modified. Drop-in replacement for BM25Index.postings. Searches
+    use pairs()/count(), which read the arrays in place, so a read-only
+    process never copies postings onto its heap.
+
+    Args:
+        terms: term -> term id
+        offsets: per term id, start of its run in chunk_ids/tfs (len = terms + 1)
+        chunk_ids, tfs: postings runs for all terms, concatenated
+    """
+
+    def __init__(self, terms: Dict[str, int], offsets, chunk_ids, tfs):
+        self._terms = terms
+        self._offsets = offsets
+        self._chunk_ids = chunk_ids
+        self._tfs = tfs
+        self._overlay: Dict[str, Dict[int, int]] = {}  # decoded or modified; None = deleted
+
+    def __getitem__(self, term: str) -> Dict[int, int]:
+        postings = self._overlay.get(term, self)
+        if postings is self:
+            term_id = self._terms.get(term)
+            if term_id is None:
+                raise KeyError(term)
+            start, end = self._offsets[term_id], self._offsets[term_id + 1]
+            postings = dict(zip(self._chunk_ids[start:end], self._tfs[start:end]))
+            self._overlay[term] = postings
+        if postings is None:
+            raise KeyError(term)
+        return postings
+
+    def __setitem__(self, term: str, postings: Dict[int, int]) -> None:
+        self._overlay[term] = postings
+
+    def __delitem__(self, term: str) -> None:
+        if term not in self:
+            raise KeyError(term)
+        self._overlay[term] = None
+
+    def __contains__(self, term) -> bool:
+        if term in self._overlay:
+            return self._overlay[term] is not None
+        return term in self._terms
+
+    def __iter__(self):
+        for term in self._terms:
+            if self._overlay.get(term, True) is not None:
+                yield term
+        for term, postings in list(self._overlay.items()):
+            if postings is not None and term not in self._terms:
+                yield term
+
+    def __len__(self) -> int:
+        deleted = sum(1 for t, p in list(self._overlay.items()) if p is None and t in self._terms)
+        added = sum(1 for t, p in list(self._overlay.items()) if p is not None and t not in self._terms)
+        return len(self._terms) - deleted + added
+
+    def pairs(self, term: str) -> Sequence[Tuple[int, int]]:
+        """(chunk id, tf) pairs of a term, read from the arrays without decoding them into the overlay."""
+        postings = self._overlay.get(term, self)
+        if postings is not self:
+            return list(postings.items()) if postings else []
+        term_id = self._terms.get(term)
+        if term_id is None:
+            return []
+        start, end = self._offsets[term_id], self._offsets[term_id + 1]
+        return list(zip(self._chunk_ids[start:end], self._tfs[start:end]))
+
+    def count(self, term: str) -> int:
+        """Number of chunks containing a term (document frequency)."""
+        postings = self._overlay.get(term, self)
+        if postings is not self:
+            return len(postings) if postings else 0
+        term_id = self._terms.get(term)
+        return 0 if term_id is None else self._offsets[term_id + 1] - self._offsets[term_id]
+
+    def decoded(self) -> List[Dict[int, int]]:
+        """Postings currently held in memory (decoded or modified), for memory accounting."""
+        return [p for p in list(self._overlay.values()) if p is not None]
+
+    def copy(self) -> "MappedPostings":
+        """Share the arrays, copy only the overlay."""
+        clone = MappedPostings(self._terms, self._offsets, self._chunk_ids, self._tfs)
+        clone._overlay = dict(self._overlay)
+        return clone
@@ -0,0 +1,144 @@
+"""
+Semantic answer cache for paraphrased questions.
+Embeds each answered query into a preallocated float32 matrix; a lookup
+is one matrix-vector product plus argmax, and returns the cached answer
+when the best cosine similarity clears the threshold.
+"""
+import os
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from answer_cache import normalize_query, query_dependencies
+
+SIMILARITY_BUCKETS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0]
+
+
+class SemanticCache:
+    """
+    Args:
+        embedder: see embeddings.py
+        threshold: minimum cosine similarity for a hit
+        max_entries: capacity; the least recently used slot is reused when full
+        ttl: seconds an answer stays valid
+    """
+
+    def __init__(self, embedder, threshold: float = 0.85, max_entries: int = 1000, ttl: float = 3600):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.epoch = ""
+        self._vectors = np.zeros((max_entries, embedder.dim), dtype=np.float32)
+        self._expires = np.zeros(max_entries, dtype=np.float64)  # 0 = empty slot
+        self._last_used = np.zeros(max_entries, dtype=np.float64)
+        self._entries: Dict[int, Dict] = {}  # slot -> {'query', 'result', 'deps'}
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0}
+        # Histogram of the best similarity seen per lookup (upper bucket bounds)
+        self.similarity_histogram = [0] * len(SIMILARITY_BUCKETS)
+        self.similarity_sum = 0.0
+
+    def _embed(self, query: str) -> np.ndarray:
+        return self.embedder.embed([normalize_query(query)])[0]
+
+    def lookup(self, query: str) -> Tuple[Optional[Dict], float]:
+        """Returns (cached result or None, best similarity)."""
+        vector = self._embed(query)
+        now = time.time()
+        with self._lock:
+            live = self._expires > now
+            if not live.any():
+                self.counters["misses"] += 1
+                return None, 0.0
+            scores = self._vectors @ vector
+            scores[~live] = -1.0
+            slot = int(np.argmax(scores))
+            best = float(scores[slot])
+            self._record_similarity(best)
+            if best < self.threshold:
+                self.counters["misses"] += 1
+                return None, best
+            self._last_used[slot] = now
+            self.counters["hits"] += 1
+            return self._entries[slot]["result"], best
+
+    def add(self, query: str, result: Dict, sources: Iterable[str] = ()) -> None:
+        vector = self._embed(query)
+        now = time.time()
+        with self._lock:
+            free = np.flatnonzero(self._expires <= now)
+            slot = int(free[0]) if len(free) else int(np.argmin(self._last_used))
+            self._vectors[slot] = vector
+            self._expires[slot] = now + self.ttl
+            self._last_used[slot] = now
+            self._entries[slot] = {"query": query, "result": result,
+                                   "deps": query_dependencies(query, sources)}
+            self.counters["stores"] += 1
+
+    def on_corpus_change(self, corpus, changed_paths, changed_terms) -> None:
+        """Corpus listener; same invalidation rules as AnswerCache."""
+        with self._lock:
+            if changed_paths is None:
+                if corpus.epoch != self.epoch:
+                    self.epoch = corpus.epoch
+                    self._drop(list(self._entries))
+                return
+            deps = {f"doc:{path}" for path in changed_paths}
+            deps.update(f"term:{term}" for term in changed_terms or ())
+            self._drop([slot for slot, entry in self._entries.items() if entry["deps"] & deps])
+
+    def _drop(self, slots) -> None:
+        for slot in slots:
+            self._entries.pop(slot, None)
+            self._expires[slot] = 0.0
+            self._vectors[slot] = 0.0
+        self.counters["invalidations"] += len(slots)
+
+    def _record_similarity(self, similarity: float) -> None:
+        self.similarity_sum += similarity
+        for i, bound in enumerate(SIMILARITY_BUCKETS):
+            if similarity <= bound:
+                self.similarity_histogram[i] += 1
+                return
+        self.similarity_histogram[-1] += 1
+
+    def stats(self) -> Dict:
+        lookups = self.counters["hits"] + self.counters["misses"]
+        scored = sum(self.similarity_histogram)
+        return dict(
+            self.counters,
+            entries=int((self._expires > time.time()).sum()),
+            threshold=self.threshold,
+            embedder=self.embedder.name,
+            hit_rate=round(self.counters["hits"] / lookups, 4) if lookups else 0.0,
+            mean_similarity=round(self.similarity_sum / scored, 4) if scored else 0.0,
+            similarity_histogram={f"le_{b}": n for b, n in zip(SIMILARITY_BUCKETS, self.similarity_histogram)},
+        )
+
+
+def create_semantic_cache() -> Optional[SemanticCache]:
+    """
+    Build the cache from RAG_SEMANTIC_CACHE* env vars; None when disabled.
+    The default (auto) enables it only with a semantic embedder: the
+    hashing embedder's lexical similarity misses paraphrases and scores
+    different questions that share words close to the threshold.
+    """
+    mode = os.getenv("RAG_SEMANTIC_CACHE", "auto").lower()
+    if mode in ("", "off", "none", "false", "0"):
+        return None
+    from embeddings import HashingEmbedder, get_embedder
+
+    embedder = get_embedder()
+    if mode == "auto" and isinstance(embedder, HashingEmbedder):
+        print("  Semantic answer cache disabled: the hashing embedder is lexical "
+              "(set RAG_EMBEDDER=openai, or RAG_SEMANTIC_CACHE=on to force it)")
+        return None
+    return SemanticCache(
+        embedder,
+        threshold=float(os.getenv("RAG_SEMANTIC_CACHE_THRESHOLD", "0.85")),
+        max_entries=int(os.getenv("RAG_SEMANTIC_CACHE_SIZE", "1000")),
+        ttl=float(os.getenv("RAG_ANSWER_CACHE_TTL", "3600")),
+    )
@@ -0,0 +1,82 @@
+"""
+Single-flight request coalescing.
+While a computation for a key is running, further callers with the same
+key wait for it instead of starting their own, and all of them get its
+result - or its exception. The key is forgotten as soon as the
+computation finishes, so nothing is cached here (see answer_cache.py).
+"""
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces blocking calls (do) and coroutines (do_async) per key."""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._tasks: Dict[str, asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.counters = {'leaders': 0, 'coalesced': 0, 'errors': 0}
+
+    def do(self, key: str, fn: Callable[..., Any], *args) -> Any:
+        """Run fn(*args), or wait for the identical call already in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.counters['leaders'] += 1
+            else:
+                self.counters['coalesced'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn(*args)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            self.counters['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await factory(), or the identical coroutine already in flight.
+        The shared task is shielded: a caller that is cancelled (e.g. its
+        client disconnected) does not cancel it for the others.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._tasks[key] = task
+            self.counters['leaders'] += 1
+            task.add_done_callback(lambda t: self._finished(key, t))
+        else:
+            self.counters['coalesced'] += 1
+        return await asyncio.shield(task)
+
+    def _finished(self, key: str, task: asyncio.Future) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        # Mark the exception retrieved even if every caller has gone away
+        if not task.cancelled() and task.exception() is not None:
+            self.counters['errors'] += 1
+
+    def stats(self) -> Dict:
+        requests = self.counters['leaders'] + self.counters['coalesced']
+        return dict(self.counters, in_flight=len(self._calls) + len(self._tasks),
+                    coalesced_rate=round(self.counters['coalesced'] / requests, 4) if requests else 0.0)
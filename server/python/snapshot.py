@@ -0,0 +1,405 @@
+"""
+On-disk corpus snapshots.
+Persists the loaded documents, chunk table and BM25 index in a compact,
+versioned binary file that is memory-mapped on load, so a restart can
+answer queries immediately and catch up with Dropbox in the background.
+
+Layout (little-endian):
+    magic "RAGSNAP\\0" | u32 format version | u32 header length | header JSON
+    | sections, each 8-byte aligned, offsets relative to the end of the header
+
+Sections:
+    docs          JSON list of [path, name, size, content_hash, text_off, text_len, first_chunk, n_chunks]
+    text          UTF-8 document contents, concatenated
+    chunk_doc     u32 document index per chunk
+    chunk_start   u32 character offset of each chunk within its document
+    chunk_end     u32
+    chunk_byte_start  u32 byte offset of each chunk within its document's UTF-8 text
+    chunk_byte_end    u32
+    chunk_len     u32 indexed token count per chunk (BM25 document length)
+    terms         newline-separated sorted term list
+    term_offsets  u64 start of each term's postings run (terms + 1 entries)
+    post_chunks   u32 chunk ids, all postings runs concatenated
+    post_tfs      u32 term frequencies, parallel to post_chunks
+
+Usage:
+    python snapshot.py build [--out PATH] [--watch]
+    python snapshot.py inspect PATH
+    python snapshot.py validate PATH
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from chunking import Chunker
+from corpus import Corpus
+from corpus_store import ChunkTable, Document, TextBuffer
+from extraction import EXTRACTION_VERSION
+from search_index import BM25Index, MappedPostings, TOKENIZER_VERSION
+
+MAGIC = b"RAGSNAP\0"
+FORMAT_VERSION = 2
+PREAMBLE = struct.Struct("<8sII")
+ALIGN = 8
+
+DEFAULT_SNAPSHOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag_snapshot.bin")
+
+# section name -> array typecode (None = raw bytes)
+SECTION_TYPES = {
+    "docs": None,
+    "text": None,
+    "chunk_doc": "I",
+    "chunk_start": "I",
+    "chunk_end": "I",
+    "chunk_byte_start": "I",
+    "chunk_byte_end": "I",
+    "chunk_len": "I",
+    "terms": None,
+    "term_offsets": "Q",
+    "post_chunks": "I",
+    "post_tfs": "I",
+}
+
+
+class SnapshotError(Exception):
+    """Snapshot missing, corrupt or incompatible with this build."""
+
+
+def save_snapshot(corpus: Corpus, path: str, cursor: Optional[str] = None,
+                  folder_path: Optional[str] = None) -> Dict:
+    """
+    Write corpus to path atomically (temp file + rename).
+    Chunk ids are renumbered densely in document order.
+    Returns the header that was written.
+    """
+    if sys.byteorder != "little":
+        raise SnapshotError("snapshots are little-endian only")
+
+    docs_meta = []
+    text = bytearray()
+    chunk_doc, chunk_start, chunk_end, chunk_byte_start, chunk_byte_end, chunk_len = (array("I") for _ in range(6))
+    new_ids = {}
+
+    for doc_idx, doc_path in enumerate(sorted(corpus.documents)):
+        doc = corpus.documents[doc_path]
+        docs_meta.append([doc_path, doc.name, doc.size, doc.content_hash,
+                          len(text), doc.length, len(chunk_doc), doc.n_chunks])
+        text += corpus.text.get(doc.offset, doc.length)
+        for chunk_id in doc.chunk_ids:
+            new_ids[chunk_id] = len(chunk_doc)
+            chunk_doc.append(doc_idx)
+            chunk_start.append(corpus.table.starts[chunk_id])
+            chunk_end.append(corpus.table.ends[chunk_id])
+            chunk_byte_start.append(corpus.table.byte_starts[chunk_id])
+            chunk_byte_end.append(corpus.table.byte_ends[chunk_id])
+            chunk_len.append(corpus.index.doc_lengths[chunk_id])
+
+    postings = corpus.index.postings
+    # A mapped index is read in place; indexing it would decode every term onto the heap
+    read = postings.pairs if isinstance(postings, MappedPostings) else (lambda term: postings[term].items())
+    terms = sorted(postings)
+    term_offsets, post_chunks, post_tfs = array("Q", [0]), array("I"), array("I")
+    for term in terms:
+        for chunk_id, tf in sorted((new_ids[c], tf) for c, tf in read(term)):
+            post_chunks.append(chunk_id)
+            post_tfs.append(tf)
+        term_offsets.append(len(post_chunks))
+
+    sections = {
+        "docs": json.dumps(docs_meta, separators=(",", ":")).encode("utf-8"),
+        "text": bytes(text),
+        "chunk_doc": chunk_doc.tobytes(),
+        "chunk_start": chunk_start.tobytes(),
+        "chunk_end": chunk_end.tobytes(),
+        "chunk_byte_start": chunk_byte_start.tobytes(),
+        "chunk_byte_end": chunk_byte_end.tobytes(),
+        "chunk_len": chunk_len.tobytes(),
+        "terms": "\n".join(terms).encode("utf-8"),
+        "term_offsets": term_offsets.tobytes(),
+        "post_chunks": post_chunks.tobytes(),
+        "post_tfs": post_tfs.tobytes(),
+    }
+
+    table = {}
+    offset = 0
+    for name, data in sections.items():
+        table[name] = {"offset": offset, "length": len(data), "crc32": zlib.crc32(data)}
+        offset += _padded(len(data))
+
+    header = {
+        "format_version": FORMAT_VERSION,
+        "tokenizer_version": TOKENIZER_VERSION,
+        "extraction_version": EXTRACTION_VERSION,
+        "chunking": corpus.chunker.describe(),
+        "corpus_version": corpus.version,
+        "corpus_epoch": corpus.epoch,
+        "cursor": cursor,
+        "folder_path": folder_path,
+        "created_at": time.time(),
+        "document_count": len(docs_meta),
+        "chunk_count": len(chunk_doc),
+        "term_count": len(terms),
+        "posting_count": len(post_chunks),
+        "bm25": {"k1": corpus.index.k1, "b": corpus.index.b},
+        "sections": table,
+    }
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    preamble = PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes))
+    head_len = len(preamble) + len(header_bytes)
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(preamble)
+        f.write(header_bytes)
+        f.write(b"\0" * (_padded(head_len) - head_len))
+        for data in sections.values():
+            f.write(data)
+            f.write(b"\0" * (_padded(len(data)) - len(data)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return header
+
+
+def cursor_path(path: str) -> str:
+    return path + ".cursor"
+
+
+def save_cursor(path: str, cursor: Optional[str], created_at: float) -> None:
+    """
+    Record a newer listing cursor for the snapshot at path without rewriting
+    it (a refresh that changed nothing). It only applies to the snapshot
+    written at created_at, so a later full save supersedes it.
+    """
+    tmp_path = f"{cursor_path(path)}.tmp{os.getpid()}"
+    with open(tmp_path, "w") as f:
+        json.dump({"snapshot_created_at": created_at, "cursor": cursor}, f)
+    os.replace(tmp_path, cursor_path(path))
+
+
+def _saved_cursor(path: str, header: Dict) -> Optional[str]:
+    try:
+        with open(cursor_path(path)) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return saved.get("cursor") if saved.get("snapshot_created_at") == header.get("created_at") else None
+
+
+def read_header(path: str) -> Tuple[Dict, int]:
+    """Return (header, data_start) without mapping the sections."""
+    try:
+        with open(path, "rb") as f:
+            magic, version, header_len = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise SnapshotError(f"{path} is not a corpus snapshot")
+            if version != FORMAT_VERSION:
+                raise SnapshotError(f"snapshot format v{version}, expected v{FORMAT_VERSION}")
+            header = json.loads(f.read(header_len))
+    except (OSError, struct.error, ValueError) as e:
+        raise SnapshotError(f"cannot read snapshot {path}: {e}") from e
+    return header, _padded(PREAMBLE.size + header_len)
+
+
+def load_snapshot(path: str, chunker: Chunker, folder_path: Optional[str] = None) -> Tuple[Corpus, Dict]:
+    """
+    Memory-map a snapshot and rebuild a searchable Corpus from it.
+    Text, chunk rows, document lengths and postings all stay in the
+    mapping (read-only, shared with any other process mapping the same
+    file); only document records are built on the heap.
+    The returned header's cursor is the newest one saved for this file
+    (see save_cursor()).
+    Raises SnapshotError if the file is unusable with the current
+    tokenizer, text extraction, chunking config or Dropbox folder.
+    """
+    header, data_start = read_header(path)
+    if header["tokenizer_version"] != TOKENIZER_VERSION:
+        raise SnapshotError("snapshot was built with a different tokenizer")
+    if header.get("extraction_version") != EXTRACTION_VERSION:
+        raise SnapshotError("snapshot was built with a different text extraction")
+    if header["chunking"] != chunker.describe():
+        raise SnapshotError(f"snapshot chunking {header['chunking']} != {chunker.describe()}")
+    if folder_path and header.get("folder_path") and header["folder_path"] != folder_path:
+        raise SnapshotError(f"snapshot is for {header['folder_path']}, not {folder_path}")
+
+    sections = _map_sections(path, header, data_start)
+    docs = json.loads(bytes(sections["docs"]))
+    table = ChunkTable.mapped([doc[0] for doc in docs], sections["chunk_doc"],
+                              sections["chunk_start"], sections["chunk_end"],
+                              sections["chunk_byte_start"], sections["chunk_byte_end"])
+    corpus = Corpus(chunker, text=TextBuffer(sections["text"]), table=table)
+    for doc_path, name, size, content_hash, off, length, first, count in docs:
+        corpus.documents[doc_path] = Document(doc_path, name, size, content_hash, off, length, first, count)
+        corpus.text_bytes += length
+    corpus.chunks.live.extend(b"\1" * len(table))
+
+    terms = bytes(sections["terms"]).decode("utf-8")
+    term_ids = {term: i for i, term in enumerate(terms.split("\n"))} if terms else {}
+    index = BM25Index(**header["bm25"])
+    index.postings = MappedPostings(term_ids, sections["term_offsets"],
+                                    sections["post_chunks"], sections["post_tfs"])
+    index.doc_lengths = sections["chunk_len"]  # Chunk ids are dense, so the array is the mapping
+    index.total_length = sum(index.doc_lengths)
+    corpus.index = index
+    corpus.version = header["corpus_version"]
+    corpus.epoch = header.get("corpus_epoch", "")
+    header["cursor"] = _saved_cursor(path, header) or header.get("cursor")
+    return corpus, header
+
+
+def validate_snapshot(path: str) -> List[str]:
+    """Check checksums and internal consistency. Returns a list of problems (empty = valid)."""
+    try:
+        header, data_start = read_header(path)
+        sections = _map_sections(path, header, data_start)
+    except SnapshotError as e:
+        return [str(e)]
+
+    problems = []
+    for name, info in header["sections"].items():
+        raw = sections[name]
+        raw = raw.cast("B") if raw.format != "B" else raw
+        if zlib.crc32(raw) != info["crc32"]:
+            problems.append(f"section {name}: checksum mismatch")
+
+    n_chunks = header["chunk_count"]
+    for name in ("chunk_doc", "chunk_start", "chunk_end", "chunk_byte_start", "chunk_byte_end", "chunk_len"):
+        if len(sections[name]) != n_chunks:
+            problems.append(f"section {name}: {len(sections[name])} entries, expected {n_chunks}")
+    offsets = sections["term_offsets"]
+    if len(offsets) != header["term_count"] + 1 or (len(offsets) and offsets[-1] != len(sections["post_chunks"])):
+        problems.append("term_offsets do not cover post_chunks")
+    if len(sections["post_tfs"]) != len(sections["post_chunks"]):
+        problems.append("post_tfs and post_chunks differ in length")
+    if any(c >= n_chunks for c in sections["post_chunks"]):
+        problems.append("postings reference chunk ids past the chunk table")
+    if problems:
+        return problems
+
+    try:
+        docs = json.loads(bytes(sections["docs"]))
+    except ValueError as e:
+        return [f"section docs: {e}"]
+    text = sections["text"]
+    for doc_idx, (doc_path, _, _, _, off, length, first, count) in enumerate(docs):
+        try:
+            content = bytes(text[off:off + length]).decode("utf-8")
+        except UnicodeDecodeError:
+            problems.append(f"{doc_path}: text is not valid UTF-8")
+            continue
+        for chunk_id in range(first, first + count):
+            if sections["chunk_doc"][chunk_id] != doc_idx:
+                problems.append(f"{doc_path}: chunk {chunk_id} belongs to another document")
+            elif not 0 <= sections["chunk_start"][chunk_id] <= sections["chunk_end"][chunk_id] <= len(content):
+                problems.append(f"{doc_path}: chunk {chunk_id} offsets out of range")
+            elif not 0 <= sections["chunk_byte_start"][chunk_id] <= sections["chunk_byte_end"][chunk_id] <= length:
+                problems.append(f"{doc_path}: chunk {chunk_id} byte offsets out of range")
+    return problems
+
+
+def _build_and_watch(rag, path: str) -> int:
+    """Publish the snapshot, then keep it current until interrupted."""
+    rag.snapshot_path = path
+    rag.index_mode = "shared"
+    if not rag.claim_leadership():
+        print(f" Another process is already publishing {path}")
+        return 1
+    if rag.load_snapshot():
+        rag.refresh()  # Catch up from the snapshot's cursor; republishes on change
+    elif not rag.load_documents():
+        print(" No documents loaded, snapshot not written")
+        return 1
+    rag.start_auto_refresh()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        rag.stop_auto_refresh()
+    return 0
+
+
+def _padded(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _map_sections(path: str, header: Dict, data_start: int) -> Dict[str, memoryview]:
+    """Map the file read-only and return a typed memoryview per section."""
+    try:
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError) as e:
+        raise SnapshotError(f"cannot map snapshot {path}: {e}") from e
+
+    view = memoryview(mm)
+    sections = {}
+    for name, typecode in SECTION_TYPES.items():
+        info = header["sections"].get(name)
+        if info is None:
+            raise SnapshotError(f"snapshot has no {name} section")
+        start = data_start + info["offset"]
+        if start + info["length"] > len(mm):
+            raise SnapshotError(f"snapshot is truncated (section {name})")
+        section = view[start:start + info["length"]]
+        sections[name] = section.cast(typecode) if typecode else section
+    return sections
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Build, inspect and validate corpus snapshots.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="load the Dropbox folder and write a snapshot")
+    build.add_argument("--out", default=os.getenv("RAG_SNAPSHOT_PATH") or DEFAULT_SNAPSHOT_PATH)
+    build.add_argument("--watch", action="store_true",
+                       help="keep running as the index builder: long-poll Dropbox and republish on every change "
+                            "(for servers with RAG_INDEX_MODE=attach)")
+    for name in ("inspect", "validate"):
+        cmd = sub.add_parser(name)
+        cmd.add_argument("path", nargs="?", default=os.getenv("RAG_SNAPSHOT_PATH") or DEFAULT_SNAPSHOT_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        os.environ["RAG_INDEX_MODE"] = "local"  # The builder always loads from Dropbox itself
+        from dropbox_rag import DropboxRAG
+        rag = DropboxRAG()
+        if args.watch:
+            return _build_and_watch(rag, args.out)
+        if not rag.load_documents():
+            print(" No documents loaded, snapshot not written")
+            return 1
+        header = save_snapshot(rag.corpus, args.out, cursor=rag.cursor, folder_path=rag.folder_path)
+        print(f" Wrote {args.out}: {header['document_count']} documents, "
+              f"{header['chunk_count']} chunks, {header['term_count']} terms")
+        return 0
+
+    if args.command == "inspect":
+        try:
+            header, _ = read_header(args.path)
+        except SnapshotError as e:
+            print(f" {e}")
+            return 1
+        summary = {k: v for k, v in header.items() if k != "sections"}
+        summary["file_size"] = os.path.getsize(args.path)
+        summary["sections"] = {name: info["length"] for name, info in header["sections"].items()}
+        print(json.dumps(summary, indent=2))
+        return 0
+
+    started = time.time()
+    problems = validate_snapshot(args.path)
+    for problem in problems:
+        print(f"   ✗ {problem}")
+    if problems:
+        print(f" {args.path} is INVALID ({len(problems)} problems)")
+        return 1
+    print(f" {args.path} is valid ({time.time() - started:.2f}s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
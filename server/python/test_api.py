@@ -0,0 +1,524 @@
+"""
+Offline tests for the FastAPI endpoints.
+The OpenAI client is pointed at mock_llm_server and Dropbox at
+fake_dropbox, so no keys or network are needed:
+    python -m pytest test_api.py      (or: python test_api.py)
+"""
+import asyncio
+import json
+import os
+import sys
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(__file__))
+os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+import httpx
+from openai import AsyncOpenAI
+
+import dropbox_rag
+import main
+import rag
+from fake_dropbox import FakeDropbox
+from llm_scheduler import LLMScheduler, Overloaded
+from mock_llm_server import app as mock_llm
+from mock_llm_server import serve_in_background
+from routing import WebSearchRouter
+from test_ingest import FOLDER, make_corpus
+from titles import extract_title
+
+MOCK_PORT = 8123
+_server = None
+
+
+def _setup():
+    """Start the mock LLM once and install a fake-Dropbox corpus."""
+    global _server
+    if _server is None:
+        _server = serve_in_background(MOCK_PORT, 0.05)
+        instance = dropbox_rag.DropboxRAG(dbx=FakeDropbox(make_corpus(20)))
+        instance.folder_path = FOLDER
+        instance.load_documents()
+        dropbox_rag._dropbox_rag_instance = instance
+
+
+def _run(coro):
+    """asyncio.run() with an OpenAI client bound to the new event loop."""
+    rag.async_client = AsyncOpenAI(api_key="mock", base_url=f"http://127.0.0.1:{MOCK_PORT}/v1")
+    return asyncio.run(coro)
+
+
+async def _post_lines(path: str, body: dict):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+        response = await client.post(path, json=body)
+    return response, [json.loads(line) for line in response.text.splitlines() if line]
+
+
+def test_batch_streams_ndjson_answers_and_dedupes_model_calls():
+    _setup()
+    queries = [f"reset topic{i} settings" for i in range(6)] + ["reset topic0 settings"]
+    before = mock_llm.state.requests
+
+    response, lines = _run(_post_lines("/rag/batch", {"queries": queries, "concurrency": 3}))
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    assert sorted(line["index"] for line in lines) == list(range(7))
+    for line in lines:
+        assert line["query"] == queries[line["index"]]
+        # Same parsing as /rag: Sources block split into citations
+        assert "Sources:" not in line["answer"] and line["citations"][0]["url"].startswith("https://help.rit.edu")
+    # The duplicate query shared a call (or was served from the cache)
+    assert mock_llm.state.requests - before == 6
+
+    # Replaying the batch is answered from the cache
+    _, again = _run(_post_lines("/rag/batch", {"queries": queries[:2]}))
+    assert len(again) == 2 and mock_llm.state.requests - before == 6
+
+
+def test_batch_rejects_malformed_body():
+    _setup()
+    response, _ = _run(_post_lines("/rag/batch", {"queries": "not a list"}))
+    assert response.status_code == 400
+    response, [body] = _run(_post_lines("/rag/batch", [1, 2]))
+    assert response.status_code == 400 and body == {"error": "body must be a JSON object"}
+
+    async def post_raw(content):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.post("/rag/batch", content=content, headers={"Content-Type": "application/json"})
+
+    response = _run(post_raw(b'{"queries": ['))
+    assert response.status_code == 400 and response.json() == {"error": "body must be a JSON object"}
+    for concurrency in ("abc", [1], 0, True, 2.5):
+        response, [body] = _run(_post_lines("/rag/batch", {"queries": ["vpn"], "concurrency": concurrency}))
+        assert response.status_code == 400 and body == {"error": "concurrency must be a positive integer"}
+    response, _ = _run(_post_lines("/rag/batch", {"queries": ["vpn"] * (main.MAX_BATCH_QUERIES + 1)}))
+    assert response.status_code == 400
+
+
+def test_search_many_matches_single_query_search():
+    _setup()
+    instance = dropbox_rag.get_dropbox_rag()
+    queries = ["topic3 portal", "reset topic12", "nothing matches this"]
+    for mode in ("keyword", "vector", "hybrid"):
+        instance.retrieval_mode = mode
+        if mode != "keyword" and instance.corpus.vectors is None:
+            instance._index_vectors(instance.corpus)
+        batched = instance.search_many(queries, max_results=3)
+        single = [instance.search(q, max_results=3) for q in queries]
+        strip = lambda results: [[(h['path'], round(h['score'], 5)) for h in hits] for hits in results]
+        assert strip(batched) == strip(single), mode
+    instance.retrieval_mode = "keyword"
+
+
+def test_titles_are_local_or_cached_unless_unsure():
+    _setup()
+    assert extract_title("User: How do I install Adobe Creative Cloud on a lab computer?") == \
+        ("Install Adobe Creative Cloud", 0.9)
+    assert extract_title("User: hi")[1] == 0.0
+
+    async def title(messages):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return (await client.post("/title", json={"messages": messages})).json()["title"]
+
+    before = mock_llm.state.requests
+    chat = [{"role": "User", "text": "How do I install Adobe Creative Cloud on a lab computer?"}]
+    first = _run(title(chat))
+    assert first == "Install Adobe Creative Cloud" and mock_llm.state.requests == before
+
+    # Same topic: the reply and a follow-up keep the cached title
+    chat += [{"role": "RAG", "text": "<p>Use the Software Center on lab machines.</p>"},
+             {"role": "User", "text": "Creative Cloud install is greyed out, why?"}]
+    assert _run(title(chat)) == first
+
+    # A vague chat falls back to the model
+    assert _run(title([{"role": "User", "text": "hello there"}]))
+    assert mock_llm.state.requests == before + 1
+    stats = rag.title_stats.stats()
+    assert stats["cache"] >= 1 and stats["llm"] >= 1 and 0 < stats["llm_call_rate"] < 1
+
+
+
+def test_metrics_exposes_stage_latency_and_counters():
+    _setup()
+
+    async def scrape():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            await client.post("/rag", json={"query": "topic5 portal login"})
+            await client.get("/no/such/route")
+            return await client.get("/metrics")
+
+    response = _run(scrape())
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    for stage in ("cache_lookup", "retrieve", "context", "llm", "parse_sources", "strip_links"):
+        assert samples[f'rag_stage_seconds_count{{stage="{stage}"}}'] >= 1, stage
+        assert samples[f'rag_stage_seconds_bucket{{stage="{stage}",le="+Inf"}}'] >= 1
+    assert samples['rag_corpus_documents'] == 20 and samples['rag_corpus_chunks'] >= 20
+    assert samples['rag_http_requests_total{route="/rag",status="200"}'] >= 1
+    assert samples['rag_http_requests_total{route="unmatched",status="404"}'] >= 1
+    assert 'rag_cache_lookups_total{cache="exact",result="misses"}' in samples
+
+
+
+def test_requests_do_not_wait_for_corpus_warmup():
+    _setup()
+    installed = dropbox_rag._dropbox_rag_instance
+    dropbox_rag._dropbox_rag_instance = None
+    slow = FakeDropbox(make_corpus(30), latency=0.1, page_size=10)
+
+    def factory():
+        instance = dropbox_rag.DropboxRAG(dbx=slow)
+        instance.folder_path = FOLDER
+        return instance
+
+    async def call(method, path, **kwargs):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.request(method, path, **kwargs)
+
+    try:
+        assert dropbox_rag.start_warmup(factory)
+        assert not dropbox_rag.start_warmup(factory)  # Already loading
+        response = _run(call("GET", "/readyz"))
+        assert response.status_code == 503 and response.json()["state"] == "loading"
+        assert _run(call("GET", "/healthz")).status_code == 200
+
+        # Degraded: answered without Dropbox context, and not cached
+        response = _run(call("POST", "/rag", json={"query": "topic4 portal while loading"}))
+        assert response.status_code == 200 and rag._cache_get("topic4 portal while loading") is None
+
+        main.WHILE_LOADING = "reject"
+        response = _run(call("POST", "/rag", json={"query": "topic4 portal"}))
+        assert response.status_code == 503 and response.headers["Retry-After"] == "5"
+
+        dropbox_rag._warmup_thread.join(10)
+        response = _run(call("GET", "/readyz"))
+        assert response.status_code == 200
+        status = response.json()
+        assert status["documents"] == 30 and status["progress"]["loaded"] == 30
+        assert status["corpus_version"] == dropbox_rag.get_dropbox_rag().corpus.version
+        assert _run(call("POST", "/rag", json={"query": "topic4 portal"})).status_code == 200
+    finally:
+        main.WHILE_LOADING = "degrade"
+        dropbox_rag._dropbox_rag_instance = installed
+
+
+def test_llm_scheduler_prioritizes_answers_and_sheds_fast():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=1, max_queue={"title": 1})
+        order, release = [], asyncio.Event()
+
+        async def call(priority, name, hold=None):
+            async with scheduler.admit(priority):
+                order.append(name)
+                if hold is not None:
+                    await hold.wait()
+
+        tasks = [asyncio.ensure_future(call("answer", "running", release))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.ensure_future(call("title", "title")))
+        await asyncio.sleep(0)
+        try:
+            await call("title", "second title")  # Title queue is full: refused without waiting
+            assert False, "expected Overloaded"
+        except Overloaded as e:
+            assert e.reason == "queue_full" and e.status == 503 and e.retry_after >= 1
+        tasks.append(asyncio.ensure_future(call("answer", "answer")))
+        await asyncio.sleep(0)
+        assert scheduler.stats()['queued'] == {"answer": 1, "title": 1, "batch": 0}
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == ["running", "answer", "title"]  # The later answer overtook the title
+
+        # Token budget: 600/min refills 10 tokens/s
+        budget = LLMScheduler(tokens_per_minute=600)
+        async with budget.admit("answer", 500) as slot:
+            try:
+                async with budget.admit("title", 500):
+                    assert False, "expected Overloaded"
+            except Overloaded as e:
+                assert e.reason == "rate_limited" and e.status == 429 and e.retry_after >= 30
+            slot.settle(100)  # Actual usage was lower; the difference is returned
+        async with budget.admit("title", 500):
+            pass
+
+    asyncio.run(scenario())
+
+
+def test_llm_scheduler_estimates_wait_from_the_calls_in_flight():
+    async def scenario():
+        scheduler = LLMScheduler(max_concurrency=4)
+        scheduler._call_seconds = 15.0  # Slower than the answer class's 10s maximum wait
+        release = [asyncio.Event() for _ in range(4)]
+
+        async def call(hold=None):
+            async with scheduler.admit("answer"):
+                if hold is not None:
+                    await hold.wait()
+
+        running = [asyncio.ensure_future(call(hold)) for hold in release]
+        await asyncio.sleep(0)
+        try:
+            await call()  # Every slot is busy for about another 15s
+            assert False, "expected Overloaded"
+        except Overloaded as e:
+            assert e.reason == "wait_exceeded" and e.retry_after == 15
+
+        # One call has nearly run an average call's time: its slot frees soon, so the next one queues
+        scheduler._started[next(iter(scheduler._started))] -= 14.5
+        assert 0.4 < scheduler._estimate_wait("answer", 0) <= 0.5
+        queued = asyncio.ensure_future(call())
+        await asyncio.sleep(0)
+        assert scheduler.stats()['queued']["answer"] == 1
+        release[0].set()
+        await queued
+        for hold in release:
+            hold.set()
+        await asyncio.gather(*running)
+        assert scheduler.stats()['classes']["answer"]['shed'] == 1 and not scheduler._started
+
+    asyncio.run(scenario())
+
+
+def test_rag_sheds_with_retry_after_when_llm_queue_is_full():
+    _setup()
+    scheduler = rag.llm_scheduler
+    rag.llm_scheduler = LLMScheduler(max_concurrency=1, max_queue={"answer": 1})
+
+    async def burst():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            responses = await asyncio.gather(*[
+                client.post("/rag", json={"query": f"topic{i} portal burst"}) for i in range(3)])
+            return responses, await client.get("/metrics")
+
+    try:
+        responses, metrics = _run(burst())
+    finally:
+        rag.llm_scheduler = scheduler
+    statuses = sorted(r.status_code for r in responses)
+    assert statuses == [200, 200, 503]
+    shed = next(r for r in responses if r.status_code == 503)
+    assert shed.headers["Retry-After"] == str(shed.json()["retry_after"]) and shed.json()["reason"] == "queue_full"
+    assert 'rag_llm_shed_total{priority="answer",reason="queue_full"}' in metrics.text
+    assert 'rag_llm_queue_wait_seconds_count{priority="answer"}' in metrics.text
+    assert 'rag_llm_queue_depth{priority="answer"} 0' in metrics.text
+
+
+def test_conversation_turns_are_chained_and_reuse_context():
+    _setup()
+
+    async def turns(bodies):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            sent = []
+            for body in bodies:
+                response = await client.post("/rag", json=body)
+                sent.append((response, mock_llm.state.last_request))
+            return sent
+
+    async def conversation(queries):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            sent, conversation_id = [], None
+            for query in queries:
+                response = await client.post("/rag", json={"query": query, "conversation_id": conversation_id})
+                conversation_id = response.json()["conversation_id"]
+                sent.append((response, mock_llm.state.last_request))
+            return sent
+
+    (first, first_req), (follow, follow_req), (other, other_req) = _run(conversation([
+        "reset topic3 portal password", "topic3 portal password still failing", "printing in the library"]))
+    conversation_id = first.json()["conversation_id"]
+    assert first.status_code == 200 and len(conversation_id) >= 22
+    assert follow.json()["conversation_id"] == other.json()["conversation_id"] == conversation_id
+    assert first.json()["usage"]["mode"] == "first" and "previous_response_id" not in first_req
+    # The static prefix is byte-identical to a standalone question's
+    assert first_req["input"][0]["content"] == rag.ANSWER_INSTRUCTIONS
+    assert first_req["prompt_cache_key"] == rag.PROMPT_CACHE_KEY
+
+    # Same topic: chained, and the previous chunks are not sent again
+    usage = follow.json()["usage"]
+    assert usage["mode"] == "chained" and usage["reused_context"] and usage["turn"] == 2
+    assert follow_req["previous_response_id"].startswith("resp_mock_")
+    assert follow_req["input"] == [{"role": "user", "content": "Question: topic3 portal password still failing"}]
+    assert usage["input_tokens_sent"] < usage["input_tokens_full"]
+
+    # New topic: still chained, with freshly retrieved context
+    usage = other.json()["usage"]
+    assert usage["mode"] == "chained" and not usage["reused_context"]
+    assert len(other_req["input"]) == 1 and other_req["input"][0]["content"].startswith("Context:")
+
+    # A worker without the conversation's state compacts the UI's history instead
+    history = [{"role": "User", "text": "reset topic3 portal password"},
+               {"role": "RAG", "text": "<p>Use the <b>portal</b> reset page.</p>"}]
+    [(response, request)] = _run(turns([{"query": "topic3 portal again", "history": history}]))
+    assert response.json()["usage"]["mode"] == "compacted" and response.json()["conversation_id"]
+    assert request["input"][0]["content"] == rag.ANSWER_INSTRUCTIONS
+    assert request["input"][1]["content"] == \
+        "Earlier in this conversation:\nUser: reset topic3 portal password\nAssistant: Use the portal reset page."
+
+    [(response, _)] = _run(turns([{"query": "topic3", "history": "not a list"}]))
+    assert response.status_code == 400
+
+    # An id the server did not issue is not adopted: the turn starts a new conversation
+    [(response, request)] = _run(turns([{"query": "topic3 portal password", "conversation_id": "conv-guess"}]))
+    assert response.json()["conversation_id"] not in ("conv-guess", conversation_id)
+    assert response.json()["usage"]["turn"] == 1 and "previous_response_id" not in request
+
+
+def test_concurrent_first_turns_share_one_model_call():
+    _setup()
+
+    async def first_turns(n):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            responses = await asyncio.gather(*(
+                client.post("/rag", json={"query": "topic5 wifi setup steps", "conversation_id": None})
+                for _ in range(n)))
+        return [response.json() for response in responses]
+
+    before = mock_llm.state.requests
+    results = _run(first_turns(4))
+    assert mock_llm.state.requests - before == 1
+    assert len({result["conversation_id"] for result in results}) == 4
+    assert {result["answer"] for result in results} == {results[0]["answer"]}
+    assert all(result["usage"]["mode"] in ("first", "cached") for result in results)
+
+
+def test_confident_local_context_skips_web_search():
+    _setup()
+    router = rag.web_search_router
+    rag.web_search_router = WebSearchRouter(mode="on", min_scores={"keyword": 1.0})
+
+    async def ask(query):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            response = await client.post("/rag", json={"query": query})
+            return response.json(), mock_llm.state.last_request, await client.get("/metrics")
+
+    try:
+        local, local_req, _ = _run(ask("reset topic17 settings"))
+        web, web_req, metrics = _run(ask("eduroam certificate expired"))
+        stats = rag.web_search_router.stats()
+        # Shadow mode decides the same way but still searches the web
+        rag.web_search_router = WebSearchRouter(mode="shadow", min_scores={"keyword": 1.0})
+        _, shadow_req, _ = _run(ask("reset topic18 settings"))
+        shadow = rag.web_search_router.stats()
+    finally:
+        rag.web_search_router = router
+
+    # The local-only system message says it all; the note is only for chained turns
+    assert "tools" not in local_req and not local_req["input"][1]["content"].endswith(rag.LOCAL_ONLY_NOTE)
+    assert local_req["input"][0]["content"] == rag.LOCAL_ANSWER_INSTRUCTIONS
+    assert "web_search" not in rag.LOCAL_ANSWER_INSTRUCTIONS
+    assert web_req["input"][0]["content"] == rag.ANSWER_INSTRUCTIONS
+    assert local["citations"][0] == {"title": "article_0017.md", "path": f"{FOLDER}/article_0017.md",
+                                     "url": f"https://www.dropbox.com/home{FOLDER}/article_0017.md"}
+    assert web_req["tools"] == rag.ANSWER_TOOLS and web["citations"][0]["url"].startswith("https://help.rit.edu")
+    assert stats["decisions"] == {"local": 1, "web": 1} and stats["local_only"] == 1
+    assert stats["latency"]["local"]["calls"] == 1 and stats["latency"]["web"]["calls"] == 1
+    assert 'rag_route_llm_seconds_count{route="local",decision="local"} 1' in metrics.text
+    assert shadow_req["tools"] == rag.ANSWER_TOOLS
+    assert shadow["decisions"]["local"] == 1 and shadow["local_only"] == 0
+
+
+def test_hybrid_threshold_scales_with_the_retrievers_fused():
+    router = WebSearchRouter(mode="on")
+    hit = {'path': "/rag/a.md", 'text': "reset portal password", 'retrieval': "hybrid"}
+    # Top-ranked by the only retriever fused (no vector index): 1 / 61
+    keyword_only = dict(hit, score=1 / 61, fused_retrievers=1)
+    assert router.decide("reset portal password", [keyword_only]).route == "local"
+    # The same score from two fused retrievers means neither ranked it first
+    both = dict(hit, score=1 / 61, fused_retrievers=2)
+    assert router.decide("reset portal password", [both]).reason == "low_score"
+    assert router.decide("reset portal password", [dict(both, score=1 / 61 + 1 / 63)]).route == "local"
+
+
+
+STREAM_SAMPLES = [
+    "Hello world",
+    "<p>To fix it, open Settings.</p>\n\nSources:\nRIT — https://rit.edu/a\n",
+    "Word [x y z",
+    "See [link text with spaces](https://example.com/a) for more.\nNext line (with parens) here.",
+    "Read [foo (bar) baz](https://x.com/p) now and https://bare.example.com/x too",
+    "Use <code>eduroam</code>.\n\nsources: https://rit.edu\n",
+    "[a] [b c](https://x.y) end [dangling",
+    "Trailing space ",
+    "Multi\n\nline   text\twith  tabs\n",
+]
+
+
+def _parse_streamed(pieces):
+    parser = rag.AnswerStreamParser()
+    text = "".join(parser.feed(piece) for piece in pieces)
+    tail, citations = parser.finish()
+    return text + tail, citations
+
+
+def test_stream_parser_matches_non_streaming_parse_at_every_split():
+    for full in STREAM_SAMPLES:
+        answer, citations = rag.parse_sources_block(full)
+        expected = rag.strip_inline_links(answer)
+        for i in range(len(full) + 1):
+            assert _parse_streamed([full[:i], full[i:]]) == (expected, citations), (full, i)
+        for n in range(1, 8):
+            pieces = [full[j:j + n] for j in range(0, len(full), n)]
+            assert _parse_streamed(pieces)[0] == expected, (full, n)
+
+
+def _sse_events(body: str):
+    events = []
+    for frame in body.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in frame.splitlines() if ": " in line)
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines.get("data", "{}"))))
+    return events
+
+
+def test_rag_stream_emits_deltas_then_citations_then_done():
+    _setup()
+
+    async def stream(query):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            response = await client.post("/rag/stream", json={"query": query})
+        return response, _sse_events(response.text)
+
+    response, events = _run(stream("reset topic11 settings"))
+    assert response.headers["content-type"].startswith("text/event-stream")
+    names = [name for name, _ in events]
+    assert names[-2:] == ["citations", "done"] and set(names[:-2]) == {"delta"}
+    text = "".join(data["text"] for name, data in events if name == "delta")
+    assert text and "Sources:" not in text
+    assert events[-2][1]["citations"][0]["url"].startswith("https://help.rit.edu")
+
+    async def post_raw(content):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test", timeout=30) as client:
+            return await client.post("/rag/stream", content=content, headers={"Content-Type": "application/json"})
+
+    for content in (b"{not json", b"[1, 2]", b'{"query": 7}'):
+        bad = _run(post_raw(content))
+        assert bad.status_code == 400 and "error" in bad.json()
+
+    # A failing model call ends the stream with a single error event
+    rag.async_client = AsyncOpenAI(api_key="mock", base_url="http://127.0.0.1:9/v1", max_retries=0)
+    _, events = asyncio.run(stream("reset topic12 settings"))
+    assert [name for name, _ in events if name != "delta"] == ["error"]
+    assert events[-1][1]["error"] == "internal_error"
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f" ✓ {name}")
@@ -0,0 +1,180 @@
+"""
+Offline tests for the answer caches.
+    python -m pytest test_cache.py      (or: python test_cache.py)
+"""
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from answer_cache import AnswerCache, MemoryBackend, SQLiteBackend, normalize_query
+from corpus import Corpus
+from chunking import Chunker
+from embeddings import HashingEmbedder
+from semantic_cache import SemanticCache, create_semantic_cache
+from single_flight import SingleFlight
+
+ANSWER = {"text": "<p>Join eduroam.</p>", "citations": [{"title": "Wi-Fi", "url": "https://rit.edu/wifi"}]}
+
+
+def _corpus(epoch: str) -> Corpus:
+    corpus = Corpus(Chunker(500, 0, "paragraph"))
+    corpus.epoch = epoch
+    return corpus
+
+
+def _check_backend(backend):
+    cache = AnswerCache(backend, ttl=60, config_fingerprint="cfg")
+    cache.on_corpus_change(_corpus("e1"), None, None)
+
+    assert cache.get("How do I connect to RIT Wi-Fi?") is None
+    cache.set("How do I connect to RIT Wi-Fi?", ANSWER, sources=["/rag/wifi.md"])
+    cache.set("Duo enrollment", ANSWER, sources=["/rag/duo.md"])
+    # Normalization: case, punctuation and spacing do not matter
+    assert cache.get("  how do i connect to rit wi fi ") == ANSWER
+
+    # Unrelated incremental change keeps both; a changed source drops only its answer
+    cache.on_corpus_change(_corpus("e1"), {"/rag/printing.md"}, {"printer"})
+    assert cache.get("Duo enrollment") == ANSWER
+    cache.on_corpus_change(_corpus("e1"), {"/rag/wifi.md"}, set())
+    assert cache.get("How do I connect to RIT Wi-Fi?") is None
+    assert cache.get("Duo enrollment") == ANSWER
+
+    # New content sharing a query term invalidates too
+    cache.on_corpus_change(_corpus("e1"), {"/rag/new.md"}, {"duo"})
+    assert cache.get("Duo enrollment") is None
+
+    # A full reload with a new epoch clears everything
+    cache.set("Duo enrollment", ANSWER, sources=["/rag/duo.md"])
+    cache.on_corpus_change(_corpus("e2"), None, None)
+    assert cache.get("Duo enrollment") is None
+    assert cache.stats()["hits"] == 3
+
+
+def test_memory_backend_keys_and_invalidation():
+    _check_backend(MemoryBackend())
+
+
+def test_sqlite_backend_keys_and_invalidation():
+    with tempfile.TemporaryDirectory() as tmp:
+        _check_backend(SQLiteBackend(os.path.join(tmp, "cache.sqlite3")))
+
+
+def test_lru_and_ttl_eviction():
+    cache = AnswerCache(MemoryBackend(max_entries=2), ttl=0.05)
+    for q in ("a1", "a2", "a3"):
+        cache.set(q, ANSWER)
+    assert cache.get("a1") is None and cache.stats()["evictions"] == 1
+    assert cache.get("a3") == ANSWER
+    time.sleep(0.06)
+    assert cache.get("a3") is None and cache.stats()["expired"] == 1
+
+
+def test_config_fingerprint_is_part_of_the_key():
+    backend = MemoryBackend()
+    AnswerCache(backend, config_fingerprint="gpt-5/v1").set("q", ANSWER)
+    assert AnswerCache(backend, config_fingerprint="gpt-5/v2").get("q") is None
+    assert normalize_query("What's   VPN?") == "what s vpn"
+
+
+def test_semantic_cache_matches_paraphrases():
+    cache = SemanticCache(HashingEmbedder(), threshold=0.5, max_entries=2)
+    cache.add("wifi setup on iphone", ANSWER, sources=["/rag/wifi.md"])
+    result, similarity = cache.lookup("Connect iPhone to RIT wifi")
+    assert result == ANSWER and similarity >= 0.5
+    result, similarity = cache.lookup("reset my Duo password")
+    assert result is None and similarity < 0.5
+
+    # A changed source drops the entry; capacity reuses the LRU slot
+    cache.on_corpus_change(_corpus("e1"), {"/rag/wifi.md"}, set())
+    assert cache.lookup("wifi setup on iphone")[0] is None
+    for q in ("printing in the library", "vpn install", "duo enrollment"):
+        cache.add(q, ANSWER)
+    assert cache.lookup("printing in the library")[0] is None
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["hits"] == 1
+    assert sum(stats["similarity_histogram"].values()) == 3
+
+
+
+def test_semantic_cache_is_off_by_default_with_the_hashing_embedder():
+    saved = {k: os.environ.pop(k, None) for k in ("RAG_SEMANTIC_CACHE", "RAG_EMBEDDER", "OPENAI_API_KEY")}
+    try:
+        log = io.StringIO()
+        with contextlib.redirect_stdout(log):
+            assert create_semantic_cache() is None
+        assert "Semantic answer cache disabled" in log.getvalue()
+        os.environ["RAG_SEMANTIC_CACHE"] = "on"
+        assert create_semantic_cache().embedder.name.startswith("hashing")
+        # auto turns it on with a semantic embedder (nothing is embedded until the first lookup)
+        os.environ.update(RAG_SEMANTIC_CACHE="auto", RAG_EMBEDDER="openai", OPENAI_API_KEY="mock")
+        assert create_semantic_cache().embedder.name.startswith("openai-")
+    finally:
+        for key, value in saved.items():
+            os.environ.pop(key, None)
+            if value is not None:
+                os.environ[key] = value
+
+def test_single_flight_shares_results_and_errors():
+    flight = SingleFlight()
+    calls = []
+
+    def compute(value):
+        calls.append(value)
+        time.sleep(0.05)
+        if value == "boom":
+            raise RuntimeError("upstream down")
+        return {"text": value}
+
+    results, errors = [], []
+
+    def worker(value):
+        try:
+            results.append(flight.do(value, compute, value))
+        except RuntimeError as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=worker, args=(v,)) for v in ["email"] * 5 + ["boom"] * 3]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(calls) == ["boom", "email"]
+    assert results == [{"text": "email"}] * 5 and errors == ["upstream down"] * 3
+    assert flight.stats()["coalesced"] == 6 and flight.stats()["in_flight"] == 0
+
+    async def scenario():
+        started = []
+
+        async def answer(value):
+            started.append(value)
+            await asyncio.sleep(0.05)
+            if value == "boom":
+                raise RuntimeError("upstream down")
+            return value
+
+        waiters = [asyncio.ensure_future(flight.do_async("q", lambda: answer("email"))) for _ in range(4)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()  # A client going away must not cancel the shared call
+        shared = await asyncio.gather(*waiters[1:])
+        failed = await asyncio.gather(*(flight.do_async("b", lambda: answer("boom")) for _ in range(3)),
+                                      return_exceptions=True)
+        return started, shared, failed
+
+    started, shared, failed = asyncio.run(scenario())
+    assert started == ["email", "boom"] and shared == ["email"] * 3
+    assert all(isinstance(e, RuntimeError) for e in failed)
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f" ✓ {name}")
@@ -0,0 +1,61 @@
+"""
+Offline tests for context packing.
+    python -m pytest test_context.py      (or: python test_context.py)
+"""
+import os
+import sys
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from chunking import Chunker
+from context_packing import ContextPacker, count_tokens
+from corpus import Corpus
+
+WIFI = "Connect to eduroam with your RIT username and password, then accept the certificate."
+
+
+def _hits(corpus: Corpus, query: str):
+    return [
+        {'chunk_id': h['chunk'].id, 'path': h['doc'].path, 'name': h['doc'].name,
+         'text': h['text'], 'score': h['score'], 'start': h['chunk'].start, 'end': h['chunk'].end}
+        for h in corpus.search(query, top_k=10)
+    ]
+
+
+def test_duplicates_dropped_and_adjacent_chunks_merged():
+    guide = "\n\n".join([f"Eduroam step {i}: open settings and pick eduroam option {i}." for i in range(3)])
+    corpus = Corpus.build(Chunker(60, 0, "paragraph"), [
+        {'path': '/rag/wifi.md', 'name': 'wifi.md', 'content': WIFI, 'size': 1, 'content_hash': 'a'},
+        {'path': '/rag/wifi-copy.md', 'name': 'wifi-copy.md', 'content': WIFI + " ", 'size': 1, 'content_hash': 'b'},
+        {'path': '/rag/guide.md', 'name': 'guide.md', 'content': guide, 'size': 1, 'content_hash': 'c'},
+    ])
+    hits = _hits(corpus, "eduroam")
+    assert len(hits) == 5
+
+    packed, report = ContextPacker(budget=1000).pack(hits)
+    assert report['duplicates'] == 1 and report['merged'] == 2
+    assert [h['path'] for h in packed].count('/rag/guide.md') == 1
+    guide_passage = next(h for h in packed if h['path'] == '/rag/guide.md')
+    assert guide_passage['text'] == guide
+    assert report['tokens_saved'] == report['tokens_in'] - report['tokens_out'] > 0
+
+
+def test_budget_keeps_best_ranked_passages():
+    hits = [
+        {'chunk_id': i * 10, 'path': f'/rag/{i}.md', 'name': f'{i}.md', 'text': f"topic{i} " * (20 + 40 * (i == 1)),
+         'score': 1.0 / (i + 1), 'start': 0, 'end': 0}
+        for i in range(4)
+    ]
+    budget = count_tokens(hits[0]['text']) + count_tokens(hits[2]['text'])
+    packed, report = ContextPacker(budget=budget).pack(hits)
+    # The long second hit does not fit; smaller, lower-ranked ones still can
+    assert [h['path'] for h in packed] == ['/rag/0.md', '/rag/2.md']
+    assert report['over_budget'] == 2 and report['tokens_out'] <= budget
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f" ✓ {name}")
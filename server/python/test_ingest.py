@@ -0,0 +1,534 @@
+"""
+Offline tests for Dropbox ingestion and search.
+Runs against fake_dropbox.FakeDropbox, so no token or network is needed:
+    python -m pytest test_ingest.py      (or: python test_ingest.py)
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Add current directory to path
+sys.path.insert(0, os.path.dirname(__file__))
+
+from chunking import Chunker
+from dropbox_rag import DropboxRAG, _file_signature
+from fake_dropbox import FakeDropbox
+from hybrid_search import HybridSearch
+from search_index import BM25Index, tokenize
+from snapshot import validate_snapshot
+
+FOLDER = "/rag_sources"
+
+
+def make_corpus(n: int):
+    """n small help articles keyed by Dropbox path."""
+    return {
+        f"{FOLDER}/article_{i:04d}.md": (
+            f"# Article {i}\n\nHow to reset topic{i} settings.\n\n"
+            f"Open the portal and choose topic{i} from the menu."
+        ).encode("utf-8")
+        for i in range(n)
+    }
+
+
+def make_rag(dbx) -> DropboxRAG:
+    rag = DropboxRAG(dbx=dbx)
+    rag.folder_path = FOLDER
+    return rag
+
+
+def test_parallel_load_is_bounded_and_faster_than_serial():
+    dbx = FakeDropbox(make_corpus(40), latency=0.02, page_size=10)
+    rag = make_rag(dbx)
+    rag.max_workers = 8
+
+    started = time.time()
+    loaded = rag.load_documents()
+    elapsed = time.time() - started
+
+    assert loaded == 40
+    assert rag.progress == {'listed': 40, 'loaded': 40, 'failed': 0, 'skipped': 0}
+    assert 1 < dbx.max_in_flight <= 8
+    # Serial would be ~40 downloads + 4 list calls at 20 ms each
+    assert elapsed < 44 * 0.02 * 0.6
+    assert [d.path for d in rag.documents] == sorted(make_corpus(40))
+
+
+def test_documents_are_indexed_as_they_arrive():
+    from corpus import Corpus
+
+    rag = make_rag(FakeDropbox(make_corpus(30), latency=0.005))
+    rag.max_workers = 2
+    started, unindexed = [], []
+    download, add_document = rag._download_entry, Corpus.add_document
+    rag._download_entry = lambda entry: started.append(entry.path_lower) or download(entry)
+
+    def counting_add_document(corpus, doc):
+        unindexed.append(len(started) - len(corpus.documents))
+        return add_document(corpus, doc)
+
+    Corpus.add_document = counting_add_document
+    try:
+        assert rag.load_documents() == 30
+    finally:
+        Corpus.add_document = add_document
+    # Only a window of downloaded texts waits for indexing, never the whole corpus
+    assert max(unindexed) <= 2 * rag.max_workers
+    assert [d.path for d in rag.documents] == sorted(make_corpus(30))
+
+def test_rate_limited_downloads_are_retried():
+    dbx = FakeDropbox(make_corpus(12), rate_limit_every=3)
+    rag = make_rag(dbx)
+
+    assert rag.load_documents() == 12
+    assert dbx.calls["rate_limited"] > 0
+    assert rag.progress['failed'] == 0
+
+
+def test_bm25_search_ranks_matching_chunk_first():
+    rag = make_rag(FakeDropbox(make_corpus(20)))
+    rag.load_documents()
+
+    results = rag.search_documents("reset topic7 settings", max_results=3)
+    assert results[0].startswith("[From article_0007.md]")
+    # Stopwords alone match nothing
+    assert rag.search_documents("how to the a")[0].startswith("No relevant documents")
+
+
+def test_tokenize_lowercases_and_drops_stopwords():
+    assert tokenize("How do I reset the VPN, then VPN_client?") == ["reset", "vpn", "vpn_client"]
+    assert tokenize("How to do it") == []
+
+
+def test_bm25_weights_rare_terms_term_frequency_and_length():
+    index = BM25Index()
+    texts = ["printer printer setup", "printer setup guide for the lab printers today", "vpn setup"]
+    for chunk_id, text in enumerate(texts):
+        index.add(chunk_id, tokenize(text))
+
+    # A term in every chunk weighs less than one in a single chunk
+    assert index.idf("vpn") > index.idf("printer") > index.idf("setup") > 0
+    assert index.search("setup vpn")[0][0] == 2
+    # More occurrences in a shorter chunk rank higher
+    ranked = index.search("printer")
+    assert [chunk_id for chunk_id, _ in ranked] == [0, 1] and ranked[0][1] > ranked[1][1]
+    assert index.search("printer", top_k=1) == ranked[:1]
+    assert index.search("the of and") == [] and index.search("unknown") == []
+
+
+def test_bm25_remove_matches_a_rebuilt_index():
+    texts = {0: "reset portal password", 1: "portal login help", 2: "password manager portal"}
+    index = BM25Index()
+    for chunk_id, text in texts.items():
+        index.add(chunk_id, tokenize(text))
+    updated = index.copy()  # Copy-on-write: the original keeps serving readers
+
+    updated.remove(0, tokenize(texts[0]))
+    updated.remove(0, tokenize(texts[0]))  # Removing twice is a no-op
+    assert "reset" not in updated.postings and 0 not in updated.doc_lengths
+    rebuilt = BM25Index()
+    for chunk_id in (1, 2):
+        rebuilt.add(chunk_id, tokenize(texts[chunk_id]))
+    assert updated.total_length == rebuilt.total_length and len(updated) == 2
+    for query in ("portal", "password", "reset portal"):
+        assert updated.search(query) == rebuilt.search(query), query
+    assert index.search("reset")[0][0] == 0 and len(index) == 3
+
+
+def test_chunks_overlap_by_whole_trailing_paragraphs():
+    content = "Alpha one.\n\nBravo two.\n\nCharlie three.\n\nDelta four."
+    spans = Chunker(size=25, overlap=12, strategy="paragraph").split(content)
+    assert [content[s:e] for s, e in spans] == \
+        ["Alpha one.\n\nBravo two.", "Bravo two.\n\nCharlie three.", "Delta four."]
+    # The repeated paragraph ends one chunk and starts the next
+    assert spans[1][0] < spans[0][1]
+    assert Chunker(size=25, overlap=0, strategy="paragraph").split(content) == [(0, 22), (24, 51)]
+
+
+def test_heading_strategy_starts_a_chunk_at_each_heading():
+    content = "# Setup\n\nInstall the app.\n\n## Troubleshooting\n\nRestart it.\n\n<h3>Contact</h3>\n\nCall us."
+    chunks = [content[s:e] for s, e in Chunker(size=500, overlap=0, strategy="heading").split(content)]
+    assert chunks == ["# Setup\n\nInstall the app.", "## Troubleshooting\n\nRestart it.",
+                      "<h3>Contact</h3>\n\nCall us."]
+    assert len(Chunker(size=500, overlap=0, strategy="paragraph").split(content)) == 1
+
+
+def test_oversized_paragraph_is_windowed_at_whitespace():
+    words = [f"word{i:02d}" for i in range(30)]
+    content = " ".join(words)
+    spans = Chunker(size=50, overlap=0, strategy="paragraph").split(content)
+    assert len(spans) > 1 and all(e - s <= 50 for s, e in spans)
+    # No word is cut in two, and nothing is lost
+    assert [w for s, e in spans for w in content[s:e].split()] == words
+    assert all(content[s:e] == content[s:e].strip() for s, e in spans)
+
+
+def test_incremental_refresh_only_touches_changed_files():
+    corpus = make_corpus(10)
+    dbx = FakeDropbox(corpus)
+    rag = make_rag(dbx)
+    rag.load_documents()
+    before = rag.corpus
+    downloads = dbx.calls["download"]
+
+    dbx.put(f"{FOLDER}/article_0001.md", b"# Article 1\n\nNow about eduroam wifi.")
+    dbx.put(f"{FOLDER}/article_0002.md", corpus[f"{FOLDER}/article_0002.md"])  # same content
+    dbx.delete(f"{FOLDER}/article_0003.md")
+    dbx.put(f"{FOLDER}/new.md", b"Duo two factor enrollment.")
+
+    assert rag.refresh() == 3
+    assert dbx.calls["download"] - downloads == 2
+    assert rag.search_documents("eduroam")[0].startswith("[From article_0001.md]")
+    assert rag.search_documents("duo enrollment")[0].startswith("[From new.md]")
+    assert f"{FOLDER}/article_0003.md" not in rag.corpus.documents
+    assert rag.corpus.version == before.version + 1
+    # The previous snapshot is untouched, so in-flight searches stay consistent
+    assert f"{FOLDER}/article_0003.md" in before.documents
+    assert before.search("eduroam") == []
+
+
+def test_longpoll_applies_changes_in_background():
+    dbx = FakeDropbox(make_corpus(3))
+    rag = make_rag(dbx)
+    rag.load_documents()
+    rag.start_auto_refresh(timeout=1)
+    try:
+        dbx.put(f"{FOLDER}/vpn.md", b"GlobalProtect VPN setup.")
+        deadline = time.time() + 3
+        while f"{FOLDER}/vpn.md" not in rag.corpus.documents and time.time() < deadline:
+            time.sleep(0.01)
+        assert f"{FOLDER}/vpn.md" in rag.corpus.documents
+    finally:
+        rag.stop_auto_refresh()
+
+
+
+def test_snapshot_round_trip_then_incremental_catch_up():
+    dbx = FakeDropbox(make_corpus(15))
+    rag = make_rag(dbx)
+    with tempfile.TemporaryDirectory() as tmp:
+        rag.snapshot_path = os.path.join(tmp, "corpus.bin")
+        rag.load_documents()
+        assert validate_snapshot(rag.snapshot_path) == []
+
+        restarted = make_rag(dbx)
+        restarted.snapshot_path = rag.snapshot_path
+        assert restarted.load_snapshot()
+        downloads = dbx.calls["download"]
+        assert restarted.search_documents("topic7") == rag.search_documents("topic7")
+
+        # Reconcile picks up only what changed after the snapshot was written
+        dbx.delete(f"{FOLDER}/article_0007.md")
+        assert restarted.refresh() == 1
+        assert dbx.calls["download"] == downloads
+        assert restarted.search_documents("topic7")[0].startswith("No relevant documents")
+
+        # Saving the mapped corpus read its postings in place, not onto the heap
+        deleted_terms = set(tokenize(make_corpus(15)[f"{FOLDER}/article_0007.md"].decode("utf-8")))
+        assert len(restarted.corpus.index.postings.decoded()) <= len(deleted_terms)
+        # A refresh with no changes only records the cursor; followers see no new snapshot
+        signature = _file_signature(restarted.snapshot_path)
+        dbx.put(f"{FOLDER}/article_0008.md", make_corpus(15)[f"{FOLDER}/article_0008.md"])  # Same content
+        assert restarted.refresh() == 0
+        assert _file_signature(restarted.snapshot_path) == signature
+        again = make_rag(dbx)
+        again.snapshot_path = rag.snapshot_path
+        assert again.load_snapshot() and again.cursor == restarted.cursor != rag.cursor
+
+        with open(rag.snapshot_path, "r+b") as f:
+            f.seek(-16, os.SEEK_END)
+            f.write(b"corrupted bytes!")
+        assert validate_snapshot(rag.snapshot_path)
+
+
+def test_vector_mode_embeds_incrementally_and_memory_maps():
+    dbx = FakeDropbox(make_corpus(12))
+    rag = make_rag(dbx)
+    rag.retrieval_mode = "vector"
+    with tempfile.TemporaryDirectory() as tmp:
+        rag.snapshot_path = os.path.join(tmp, "corpus.bin")
+        rag.load_documents()
+        assert rag.get_stats()['vector_count'] == len(rag.corpus.chunks)
+        assert rag.search("topic7", max_results=1)[0]['name'] == "article_0007.md"
+        # Word variants miss in BM25 but share character trigrams
+        assert rag.search("resetting portals", mode="keyword") == []
+        assert len(rag.search("resetting portals", max_results=3)) == 3
+
+        # Only the modified document's chunks are re-embedded
+        before = rag.corpus.vectors
+        dbx.put(f"{FOLDER}/article_0003.md", b"# Article 3\n\nPrinting with papercut.")
+        rag.refresh()
+        assert len(rag.corpus.vectors) == len(rag.corpus.chunks)
+        assert rag.search("papercut printing", max_results=1)[0]['name'] == "article_0003.md"
+        assert before is not rag.corpus.vectors
+
+        restarted = make_rag(dbx)
+        restarted.retrieval_mode = "vector"
+        restarted.snapshot_path = rag.snapshot_path
+        assert restarted.load_snapshot()
+        assert type(restarted.corpus.vectors.matrix).__name__ == "memmap"
+        ranked = lambda r: [(hit['path'], round(hit['score'], 5)) for hit in r.search("papercut printing")]
+        assert ranked(restarted) == ranked(rag)
+
+
+def test_hybrid_fuses_rankings_and_drops_slow_retrievers():
+    def slow(query, top_k):
+        time.sleep(0.3)
+        return [(99, 1.0)]
+
+    hybrid = HybridSearch(deadline=0.1, deadlines={'fast': 0.05})
+    started = time.time()
+    fused = hybrid.search("q", {
+        'keyword': lambda q, k: [(1, 9.0), (2, 5.0)],
+        'fast': lambda q, k: [(2, 0.9), (3, 0.8)],
+        'slow': slow,
+    }, top_k=3)
+    assert time.time() - started < 0.25
+    # Chunk 2 is ranked by both retrievers, so it wins
+    assert [c for c, _, _ in fused] == [2, 1, 3]
+    assert fused[0][2] == {'keyword': 2, 'fast': 1}
+    stats = hybrid.stats()
+    assert stats['slow']['timeouts'] == 1 and stats['keyword']['ok'] == 1
+    assert stats['fast']['sole_source'] == 1 and stats['keyword']['contributed'] == 2
+
+    rag = make_rag(FakeDropbox(make_corpus(12)))
+    rag.retrieval_mode = "hybrid"
+    rag.load_documents()
+    hits = rag.search("topic7 portals", max_results=3)
+    assert hits[0]['name'] == "article_0007.md"
+    assert set(hits[0]['retrievers']) == {'keyword', 'vector'}
+    assert rag.get_stats()['retrievers']['vector']['calls'] == 1 and not hasattr(hits, 'missing')
+
+    # A failed retriever leaves an incomplete ranking: hits are marked degraded (not cached)
+    rag.corpus.vectors.search = lambda query, top_k: 1 / 0
+    hits = rag.search("topic7 portals", max_results=3)
+    assert hits.missing == ('vector',) and hits and all(hit['degraded'] for hit in hits)
+
+
+def test_slow_retriever_does_not_hold_up_concurrent_callers():
+    from concurrent.futures import ThreadPoolExecutor
+
+    ran = []
+
+    def slow(query, top_k):
+        ran.append(query)
+        time.sleep(0.3)
+        return [(99, 1.0)]
+
+    hybrid = HybridSearch(deadline=0.1, max_workers=2)
+    retrievers = {'keyword': lambda q, k: [(1, 9.0)], 'vector': slow}
+    with ThreadPoolExecutor(4) as callers:
+        results = list(callers.map(lambda i: hybrid.search(f"q{i}", retrievers), range(16)))
+    # Keyword has its own threads, so it never waits behind the slow retriever
+    assert all([c for c, _, _ in fused] == [1] and fused.missing == ('vector',) for fused in results)
+    # Calls that were still queued at their deadline were dropped instead of run late
+    assert len(ran) < 16
+    assert hybrid.stats()['keyword']['ok'] == 16 and hybrid.stats()['vector']['timeouts'] == 16
+
+
+
+def test_compact_store_shares_text_and_compacts_replaced_documents():
+    import corpus as corpus_module
+    from chunking import Chunker
+    from corpus import Corpus
+    from snapshot import load_snapshot, save_snapshot
+
+    chunker = Chunker(60, 10, "paragraph")
+    docs = {f"/r/{i}.md": {'path': f"/r/{i}.md", 'name': f"{i}.md", 'size': 1, 'content_hash': str(i),
+                           'content': f"Café Wi‑Fi résumé guide {i}.\n\n" * 6 + f"Ünïcode topic{i} ✓"}
+            for i in range(4)}
+    corpus = Corpus.build(chunker, docs.values())
+    assert len(corpus.text) == corpus.text_bytes == sum(len(d['content'].encode()) for d in docs.values())
+    for chunk_id, chunk in corpus.chunks.items():
+        # Character offsets still index the original text, multi-byte characters included
+        assert corpus.chunk_text(chunk_id) == docs[chunk.doc]['content'][chunk.start:chunk.end]
+    assert corpus.search("topic2")[0]['doc'].path == "/r/2.md"
+    assert corpus.memory_usage()['bytes_per_document'] > 0
+
+    # Copies append to the shared buffer; the old snapshot keeps reading its own text
+    updated = corpus.copy()
+    updated.add_document(dict(docs["/r/0.md"], content="Replaced text about Zoom", content_hash="z"))
+    assert updated.text is corpus.text and len(corpus.text) > updated.text_bytes
+    assert corpus.document_text("/r/0.md") == docs["/r/0.md"]['content']
+    assert updated.document_text("/r/0.md") == "Replaced text about Zoom"
+    assert corpus.search("zoom") == [] and updated.search("zoom")[0]['doc'].path == "/r/0.md"
+
+    # Once replaced text outweighs live text, the next copy moves to compact stores
+    minimum, corpus_module.COMPACT_MIN_BYTES = corpus_module.COMPACT_MIN_BYTES, 0
+    try:
+        for path in ("/r/1.md", "/r/2.md", "/r/3.md"):
+            updated.add_document(dict(docs[path], content=f"Short {path}", content_hash="s"))
+        compacted = updated.copy()
+    finally:
+        corpus_module.COMPACT_MIN_BYTES = minimum
+    assert compacted.text is not updated.text and len(compacted.text) == compacted.text_bytes
+    assert sorted(compacted.chunks) == sorted(updated.chunks)
+    assert [compacted.chunk_text(c) for c in compacted.chunks] == [updated.chunk_text(c) for c in updated.chunks]
+    assert corpus.chunk_text(0) == docs["/r/0.md"]['content'][corpus.chunks[0].start:corpus.chunks[0].end]
+
+    # Snapshots map the text section directly and keep the offsets
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "corpus.bin")
+        save_snapshot(corpus, path)
+        loaded, _ = load_snapshot(path, chunker)
+        assert [loaded.document_text(p) for p in sorted(loaded.documents)] == [docs[p]['content'] for p in sorted(docs)]
+        assert loaded.search("topic3")[0]['text'] == corpus.search("topic3")[0]['text']
+        loaded.copy().remove_document("/r/3.md")  # Tokens of mapped chunks are re-derived
+
+
+def test_html_json_csv_are_indexed_as_extracted_text():
+    page = (b"<html><head><style>.nav{color:red}</style><script>trackVisitor()</script></head><body>"
+            b"<nav><a href='/'>Home</a> | <a href='/help'>Help</a></nav>"
+            b"<main><h1>Eduroam Wi-Fi</h1><p>Connect with your RIT&nbsp;username.</p></main>"
+            b"<footer>Copyright RIT</footer></body></html>")
+    dbx = FakeDropbox({
+        f"{FOLDER}/wifi.html": page,
+        f"{FOLDER}/faq.json": b'{"items": [{"id": 7, "question": "How do I enroll in Duo?", '
+                              b'"answer": "Use the self-service portal.", "updated": "2024-01-01"}]}',
+        f"{FOLDER}/contacts.csv": b"Service,Phone\nServiceNow desk,585-475-4357\n",
+    })
+    rag = make_rag(dbx)
+    rag.load_documents()
+
+    assert rag.corpus.document_text(f"{FOLDER}/wifi.html") == \
+        "# Eduroam Wi-Fi\n\nConnect with your RIT username."
+    assert rag.search_documents("trackvisitor")[0].startswith("No relevant documents")
+    assert rag.search_documents("copyright")[0].startswith("No relevant documents")
+    assert rag.corpus.document_text(f"{FOLDER}/faq.json") == \
+        "question: How do I enroll in Duo?\nanswer: Use the self-service portal."
+    assert rag.search_documents("servicenow phone")[0] == \
+        "[From contacts.csv]\nService: ServiceNow desk; Phone: 585-475-4357"
+    stats = rag.get_stats()['extraction']['formats']
+    assert stats['html']['bytes_removed'] > 0.5 * len(page) and stats['json']['bytes_removed'] > 0
+
+    # A full reload reuses the extracted text without downloading the files again
+    downloads = dbx.calls["download"]
+    rag.load_documents()
+    assert dbx.calls["download"] == downloads
+    stats = rag.get_stats()['extraction']['formats']
+    assert stats['html']['cached'] == stats['json']['cached'] == stats['csv']['cached'] == 1
+
+    # A moved file reuses the text too; the same bytes under another format are extracted anew
+    dbx.delete(f"{FOLDER}/wifi.html")
+    dbx.put(f"{FOLDER}/help/wifi.html", page)
+    dbx.put(f"{FOLDER}/wifi.txt", page)
+    downloads = dbx.calls["download"]
+    rag.refresh()
+    assert dbx.calls["download"] - downloads == 1
+    assert rag.corpus.document_text(f"{FOLDER}/help/wifi.html") == \
+        "# Eduroam Wi-Fi\n\nConnect with your RIT username."
+    assert "trackVisitor()" in rag.corpus.document_text(f"{FOLDER}/wifi.txt")
+
+
+def test_downloads_stream_in_blocks_and_skip_oversized_files():
+    text = "Café Wi‑Fi naïve résumé ✓ " * 40
+    dbx = FakeDropbox({
+        f"{FOLDER}/unicode.md": text.encode("utf-8"),
+        f"{FOLDER}/table.csv": ("Room,Note\n" + "".join(f"GOL-{i},Ünïcode row {i}\n" for i in range(50))).encode("utf-8"),
+        f"{FOLDER}/export.csv": b"a,b\n" + b"1,2\n" * 2000,
+    })
+    rag = make_rag(dbx)
+    rag.download_block_bytes = 7  # Splits multi-byte characters across blocks
+    rag.max_file_bytes = 4000
+    rag.load_documents()
+
+    assert rag.corpus.document_text(f"{FOLDER}/unicode.md") == text
+    assert "Room: GOL-49; Note: Ünïcode row 49" in rag.corpus.document_text(f"{FOLDER}/table.csv")
+    # Over the limit: listed but never downloaded
+    assert f"{FOLDER}/export.csv" not in rag.corpus.documents
+    assert rag.progress == {'listed': 3, 'loaded': 2, 'failed': 0, 'skipped': 1}
+    assert dbx.calls["download"] == 2
+
+
+def test_shared_index_followers_attach_and_hot_swap():
+    from search_index import MappedPostings
+
+    dbx = FakeDropbox(make_corpus(12))
+    with tempfile.TemporaryDirectory() as tmp:
+        workers = []
+        try:
+            for _ in range(3):
+                worker = make_rag(dbx)
+                worker.snapshot_path = os.path.join(tmp, "corpus.bin")
+                worker.index_mode, worker.index_poll_seconds = "shared", 0.05
+                worker.start()
+                workers.append(worker)
+            leader, followers = workers[0], workers[1:]
+            assert [w.role for w in workers] == ["leader", "follower", "follower"]
+            assert dbx.calls["download"] == 12  # Only the leader loaded from Dropbox
+
+            for follower in followers:
+                # Text, chunk rows and postings are read from the shared mapping
+                assert follower.corpus.text.mapped_bytes > 0 and follower.corpus.memory_usage()['text'] == 0
+                assert follower.search_documents("topic7") == leader.search_documents("topic7")
+                assert isinstance(follower.corpus.index.postings, MappedPostings)
+                assert follower.corpus.index.postings.decoded() == []
+
+            # The leader republishes after a refresh; followers swap it in
+            dbx.put(f"{FOLDER}/vpn.md", b"GlobalProtect VPN setup.")
+            assert leader.refresh() == 1
+            deadline = time.time() + 3
+            while any(f.index_swaps != 1 for f in followers) and time.time() < deadline:
+                time.sleep(0.01)
+            for follower in followers:
+                assert follower.corpus.version == leader.corpus.version and follower.index_swaps == 1
+                assert follower.search_documents("globalprotect")[0].startswith("[From vpn.md]")
+
+            # When the leader exits, one follower takes over publishing
+            leader.close()
+            deadline = time.time() + 3
+            while all(f.role == "follower" for f in followers) and time.time() < deadline:
+                time.sleep(0.01)
+            assert sorted(f.role for f in followers) == ["follower", "leader"]
+        finally:
+            # No watcher, reconcile thread or lock file may outlive the directory
+            for worker in workers:
+                worker.close()
+            assert not [t for t in threading.enumerate() if t.name in ("index-watch", "dropbox-reconcile")]
+
+
+def test_benchmark_corpus_is_deterministic_and_searchable():
+    import benchmark
+
+    files, titles = benchmark.synthetic_corpus(60, seed=3)
+    assert files == benchmark.synthetic_corpus(60, seed=3)[0]
+    result = benchmark.bench_ingest(files)
+    assert result['documents'] == 60 and result['memory_bytes'] > 0
+    instance = benchmark.new_instance(files)
+    instance.load_documents()
+    queries = benchmark.make_queries(titles, 30)
+    search = benchmark.bench_search(instance, queries, ["keyword"])
+    assert search['keyword']['queries'] == 30 and search['keyword']['p99_ms'] >= search['keyword']['p50_ms']
+    # Slower search is reported as a regression, faster is not
+    baseline = {"results": {"search": {"p50_ms": 1.0, "qps": 100.0}}}
+    assert benchmark.compare(baseline, {"results": {"search": {"p50_ms": 1.5, "qps": 120.0}}}, 0.2) == ["search.p50_ms"]
+
+
+def test_benchmark_compare_knows_which_direction_is_better():
+    import benchmark
+
+    assert benchmark._direction("ingest.1000.load_s") is False
+    assert benchmark._direction("ingest.1000.docs_per_s") is True  # Throughput, not a duration
+    assert benchmark._direction("search.keyword.p99_ms") is False
+    assert benchmark._direction("e2e.throughput_rps") is True
+    assert benchmark._direction("ingest.1000.bytes_per_doc") is False
+    assert benchmark._direction("e2e.mock_latency_s") is None
+    assert benchmark._direction("ingest.1000.documents") is None
+
+    baseline = {"results": {"ingest": {"load_s": 2.0, "docs_per_s": 500.0, "documents": 1000}}}
+    # Faster ingest improves both metrics
+    assert benchmark.compare(baseline, {"results": {"ingest": {"load_s": 1.0, "docs_per_s": 1000.0,
+                                                                "documents": 1000}}}, 0.2) == []
+    # Slower ingest regresses both; the document count is never compared
+    assert benchmark.compare(baseline, {"results": {"ingest": {"load_s": 4.0, "docs_per_s": 250.0,
+                                                                "documents": 10}}}, 0.2) == \
+        ["ingest.load_s", "ingest.docs_per_s"]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f" ✓ {name}")
@@ -0,0 +1,204 @@
+"""
+Local chat titles.
+extract_title() builds a sidebar title from the user's own words with
+RAKE-style keyphrase extraction (candidate phrases are runs of content
+words between stopwords and punctuation) and says how confident it is,
+so the caller only asks the model when the heuristic is unsure.
+
+TitleCache remembers titles by transcript prefix hash: a conversation
+that only grew by turns on the same topic keeps its existing title.
+"""
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional, Set, Tuple
+
+from search_index import STOPWORDS
+
+WORD_RE = re.compile(r"[A-Za-z0-9][\w'-]*")
+PHRASE_BREAK_RE = re.compile(r"[.,;:!?()\[\]\"/\n]")
+
+# Words that are common in help requests but make poor titles
+FILLER_WORDS = frozenset("""
+hi hello hey thanks thank please help need want know get got trying try tried
+able unable anyone someone something anything thing things way ways question
+questions also still really just like using use used make made can't cannot
+don't doesn't won't isn't it's i'm i've ok okay yes yeah
+""".split()) | STOPWORDS
+
+MIN_WORDS, MAX_WORDS = 3, 7
+
+
+def _title_case(word: str) -> str:
+    # Keep product names and acronyms as written (myCourses, VPN, eduroam -> Eduroam)
+    if any(c.isupper() for c in word[1:]):
+        return word
+    return word[:1].upper() + word[1:]
+
+
+def _user_lines(transcript: str) -> List[str]:
+    lines = [line[len("User:"):].strip() for line in transcript.splitlines() if line.startswith("User:")]
+    return lines or [transcript]
+
+
+def _candidate_phrases(text: str) -> List[List[str]]:
+    phrases = []
+    for fragment in PHRASE_BREAK_RE.split(text):
+        phrase = []
+        for word in WORD_RE.findall(fragment):
+            if word.lower() in FILLER_WORDS:
+                if phrase:
+                    phrases.append(phrase)
+                phrase = []
+            else:
+                phrase.append(word)
+        if phrase:
+            phrases.append(phrase)
+    return phrases
+
+
+def keywords(text: str) -> Set[str]:
+    """Lowercase content words of a text, as used for topic comparison."""
+    return {w.lower() for phrase in _candidate_phrases(text) for w in phrase if len(w) > 1}
+
+
+def extract_title(transcript: str) -> Tuple[str, float]:
+    """
+    (title, confidence 0..1) from a _serialize_transcript() string.
+    Confidence is low for greetings, very short or unfocused requests.
+    """
+    phrases = [p[:MAX_WORDS] for line in _user_lines(transcript) for p in _candidate_phrases(line)]
+    if not phrases:
+        return "", 0.0
+
+    # RAKE word score: degree / frequency, so words inside longer phrases win
+    freq: Dict[str, int] = {}
+    degree: Dict[str, int] = {}
+    for phrase in phrases:
+        for word in phrase:
+            key = word.lower()
+            freq[key] = freq.get(key, 0) + 1
+            degree[key] = degree.get(key, 0) + len(phrase)
+    scored = {}
+    for position, phrase in enumerate(phrases):
+        key = tuple(w.lower() for w in phrase)
+        if key not in scored:
+            scored[key] = (sum(degree[w] / freq[w] for w in key), position, phrase)
+    ranked = sorted(scored.values(), key=lambda item: item[0], reverse=True)
+
+    # Take the best phrases until the title is long enough, then put them
+    # back in the order the user wrote them
+    chosen = []
+    seen: Set[str] = set()
+    length = 0
+    for _, position, phrase in ranked:
+        if length >= MIN_WORDS:
+            break
+        new = [w for w in phrase if w.lower() not in seen]
+        if not new or length + len(new) > MAX_WORDS:
+            continue
+        chosen.append((position, new))
+        seen.update(w.lower() for w in new)
+        length += len(new)
+    if not chosen:
+        return "", 0.0
+    words = [w for _, new in sorted(chosen) for w in new]
+    used = len(chosen)
+
+    confidence = 0.0
+    if MIN_WORDS <= len(words) <= MAX_WORDS:
+        confidence += 0.4
+    if used == 1:
+        confidence += 0.3  # One coherent phrase rather than stitched fragments
+    if len(ranked) == 1 or ranked[0][0] >= 1.5 * ranked[1][0]:
+        confidence += 0.2  # Clear main topic
+    if any(freq[w.lower()] > 1 for w in words):
+        confidence += 0.1  # The user came back to it
+    return " ".join(_title_case(w) for w in words), round(min(1.0, confidence), 2)
+
+
+def _message_hashes(messages: List[Dict]) -> List[str]:
+    """Chained hash after each message: hashes[i] identifies messages[:i + 1]."""
+    hashes = []
+    digest = hashlib.sha256()
+    for m in messages:
+        digest.update(json.dumps([m.get("role"), (m.get("text") or "").strip()]).encode("utf-8"))
+        hashes.append(digest.copy().hexdigest()[:32])
+    return hashes
+
+
+class TitleCache:
+    """
+    Title per transcript prefix hash. lookup() finds the longest cached
+    prefix of a conversation and reuses its title if the user turns added
+    since then stay on its topic (share at least `overlap` of their
+    keywords with it, or add none).
+    """
+
+    def __init__(self, max_entries: int = 10000, overlap: float = 0.3):
+        self.max_entries = max_entries
+        self.overlap = overlap
+        self._entries: "OrderedDict[str, Tuple[str, frozenset]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, messages: List[Dict]) -> Optional[str]:
+        hashes = _message_hashes(messages)
+        with self._lock:
+            for i in range(len(hashes) - 1, -1, -1):
+                entry = self._entries.get(hashes[i])
+                if entry is None:
+                    continue
+                title, topic = entry
+                new_words = set()
+                for m in messages[i + 1:]:
+                    if m.get("role", "User") == "User":
+                        new_words |= keywords(m.get("text") or "")
+                if new_words and len(new_words & topic) / len(new_words) < self.overlap:
+                    return None  # The conversation moved on to something else
+                # Remember the longer transcript too, so the next lookup is direct
+                self._put(hashes[-1], title, topic | new_words)
+                return title
+        return None
+
+    def store(self, messages: List[Dict], title: str) -> None:
+        hashes = _message_hashes(messages)
+        if not hashes:
+            return
+        topic = set()
+        for m in messages:
+            if m.get("role", "User") == "User":
+                topic |= keywords(m.get("text") or "")
+        with self._lock:
+            self._put(hashes[-1], title, topic)
+
+    def _put(self, key: str, title: str, topic: Set[str]) -> None:
+        self._entries[key] = (title, frozenset(topic))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class TitleStats:
+    """Where titles came from (cache / local / llm) and recent latencies."""
+
+    def __init__(self, window: int = 1000):
+        self.counts = {'cache': 0, 'local': 0, 'llm': 0}
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, source: str, started: float) -> None:
+        with self._lock:
+            self.counts[source] += 1
+            self._latencies.append(time.perf_counter() - started)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = sum(self.counts.values())
+            ordered = sorted(self._latencies)
+        pct = lambda p: round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 2) if ordered else 0.0
+        return dict(self.counts, requests=total,
+                    llm_call_rate=round(self.counts['llm'] / total, 4) if total else 0.0,
+                    p50_ms=pct(50), p99_ms=pct(99))
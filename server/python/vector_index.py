@@ -0,0 +1,161 @@
+"""
+Dense vector index over corpus chunks.
+Chunk embeddings live in one contiguous float32 matrix (a row per chunk),
+so a query is scored with a single matrix-vector product and the top k
+rows are picked with argpartition. Like the corpus it belongs to, an index
+is never modified in place: updated() returns a new index that reuses the
+rows of unchanged chunks and embeds only the new ones.
+
+The matrix can be saved next to the corpus snapshot and memory-mapped
+back on startup (see save()/load()).
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+FORMAT_VERSION = 1
+
+
+def _snapshot_order(corpus) -> List[int]:
+    """Chunk ids in the order snapshot.py numbers them (sorted paths, then position)."""
+    return [chunk_id for path in sorted(corpus.documents) for chunk_id in corpus.documents[path].chunk_ids]
+
+
+def _chunk_fingerprint(corpus, chunk_ids: Iterable[int]) -> str:
+    """Identifies chunk contents independently of chunk id numbering."""
+    digest = hashlib.sha256()
+    for chunk_id in chunk_ids:
+        chunk = corpus.chunks[chunk_id]
+        doc = corpus.documents[chunk.doc]
+        digest.update(f"{doc.path}\0{doc.content_hash}\0{chunk.start}\0{chunk.end}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+class VectorIndex:
+    """
+    Args:
+        embedder: see embeddings.py
+        chunk_ids: int64 array, chunk id of each matrix row
+        matrix: float32 array (len(chunk_ids), embedder.dim), L2-normalized rows
+    """
+
+    def __init__(self, embedder, chunk_ids: np.ndarray, matrix: np.ndarray):
+        self.embedder = embedder
+        self.chunk_ids = chunk_ids
+        self.matrix = matrix
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    @staticmethod
+    def _embed_chunks(corpus, embedder, chunk_ids: List[int], batch_size: int) -> np.ndarray:
+        matrix = np.zeros((len(chunk_ids), embedder.dim), dtype=np.float32)
+        for start in range(0, len(chunk_ids), batch_size):
+            batch = chunk_ids[start:start + batch_size]
+            matrix[start:start + len(batch)] = embedder.embed([corpus.chunk_text(c) for c in batch])
+        return matrix
+
+    @classmethod
+    def build(cls, corpus, embedder, batch_size: int = 256) -> "VectorIndex":
+        """Embed every chunk of a corpus, batch_size chunks per embedder call."""
+        started = time.time()
+        chunk_ids = _snapshot_order(corpus)
+        matrix = cls._embed_chunks(corpus, embedder, chunk_ids, batch_size)
+        print(f" Embedded {len(chunk_ids)} chunks with {embedder.name} ({time.time() - started:.1f}s)")
+        return cls(embedder, np.asarray(chunk_ids, dtype=np.int64), matrix)
+
+    def updated(self, corpus, batch_size: int = 256) -> "VectorIndex":
+        """Index for an incrementally updated corpus: drop removed chunks, embed added ones."""
+        keep = np.fromiter((c in corpus.chunks for c in self.chunk_ids.tolist()), dtype=bool, count=len(self))
+        indexed = set(self.chunk_ids[keep].tolist())
+        added = [c for c in _snapshot_order(corpus) if c not in indexed]
+        new_rows = self._embed_chunks(corpus, self.embedder, added, batch_size)
+        return VectorIndex(
+            self.embedder,
+            np.concatenate([self.chunk_ids[keep], np.asarray(added, dtype=np.int64)]),
+            np.vstack([self.matrix[keep], new_rows]),
+        )
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[int, float]]:
+        """[(chunk_id, cosine similarity)] best first."""
+        if not len(self) or top_k <= 0:
+            return []
+        scores = self.matrix @ self.embedder.embed([query])[0]
+        if top_k < len(scores):
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(self.chunk_ids[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+    def search_many(self, queries: List[str], top_k: int = 5, block: int = 64) -> List[List[Tuple[int, float]]]:
+        """
+        search() for a batch: queries are embedded together and scored
+        `block` at a time with one matrix-matrix product per block.
+        """
+        if not len(self) or top_k <= 0:
+            return [[] for _ in queries]
+        results = []
+        for start in range(0, len(queries), block):
+            scores = self.matrix @ self.embedder.embed(queries[start:start + block]).T  # (chunks, queries)
+            if top_k < len(scores):
+                top = np.argpartition(-scores, top_k - 1, axis=0)[:top_k]
+            else:
+                top = np.broadcast_to(np.arange(len(scores))[:, None], scores.shape)
+            for column in range(scores.shape[1]):
+                rows = top[:, column]
+                rows = rows[np.argsort(-scores[rows, column], kind="stable")]
+                results.append([(int(self.chunk_ids[i]), float(scores[i, column]))
+                                for i in rows if scores[i, column] > 0])
+        return results
+
+    def save(self, path: str, corpus) -> None:
+        """
+        Write the matrix to `path` (.npy) and metadata to `path`.json, rows
+        in snapshot order so they line up with a corpus loaded from the
+        snapshot written alongside.
+        """
+        order = _snapshot_order(corpus)
+        row_of = {c: row for row, c in enumerate(self.chunk_ids.tolist())}
+        matrix = self.matrix[[row_of[c] for c in order]] if order else self.matrix[:0]
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(matrix, dtype=np.float32))
+        os.replace(tmp, path)
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'embedder': self.embedder.name,
+            'dim': self.embedder.dim,
+            'rows': len(order),
+            'chunks': _chunk_fingerprint(corpus, order),
+        }
+        with open(f"{path}.json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(f"{path}.json.tmp", f"{path}.json")
+
+    @classmethod
+    def load(cls, path: str, corpus, embedder) -> Optional["VectorIndex"]:
+        """
+        Memory-map a saved matrix for `corpus`. Returns None if it is missing
+        or was built with another embedder or for different chunks.
+        """
+        try:
+            with open(f"{path}.json") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        order = _snapshot_order(corpus)
+        if (meta.get('format_version') != FORMAT_VERSION or meta.get('embedder') != embedder.name
+                or meta.get('rows') != len(order) or meta.get('chunks') != _chunk_fingerprint(corpus, order)):
+            return None
+        try:
+            matrix = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        if matrix.shape != (len(order), embedder.dim) or matrix.dtype != np.float32:
+            return None
+        return cls(embedder, np.asarray(order, dtype=np.int64), matrix)